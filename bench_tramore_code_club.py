@@ -0,0 +1,1012 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for tramore_code_club.py
+
+Run a single benchmark with, for example:
+    python3 bench_tramore_code_club.py sync --files 5000
+"""
+
+import argparse
+import collections
+import contextlib
+import fnmatch
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+
+import tramore_code_club as tcc
+
+
+def make_tree(root, num_files, files_per_dir=50, file_size=2048):
+    """Create a student-like folder with num_files files spread over subfolders"""
+    for i in range(num_files):
+        folder = os.path.join(root, f"project{i // files_per_dir:03d}")
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, f"file{i:05d}.py"), "wb") as f:
+            f.write(os.urandom(file_size))
+
+
+def timed(label, func, *args, **kwargs):
+    """Run func, print how long it took and return its result"""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    print(f"  {label:<40} {elapsed * 1000:9.1f} ms")
+    return result
+
+
+def bench_sync(args):
+    """Compare a full copy with sync_folder on a large tree"""
+    temp_dir = tempfile.mkdtemp()
+    try:
+        with mock.patch.object(tcc, "WORK_DIR", temp_dir):
+            src = os.path.join(temp_dir, "student")
+            make_tree(src, args.files)
+            print(f"Sync benchmark: {args.files} files")
+
+            timed("copytree (full copy)", shutil.copytree,
+                  src, os.path.join(temp_dir, "copy"))
+
+            dest = os.path.join(temp_dir, "sync")
+            timed("sync_folder, first sync", tcc.sync_folder, src, dest)
+            stats = timed("sync_folder, nothing changed", tcc.sync_folder, src, dest)
+            print(f"    skipped {stats['skipped']} files / {stats['bytes_skipped']} bytes")
+
+            changed = max(1, args.files // 100)
+            for i in range(changed):
+                path = os.path.join(src, f"project{i // 50:03d}", f"file{i:05d}.py")
+                with open(path, "ab") as f:
+                    f.write(b"# edited\n")
+            stats = timed(f"sync_folder, {changed} files changed", tcc.sync_folder, src, dest)
+            print(f"    copied {stats['copied']} files / {stats['bytes_copied']} bytes, "
+                  f"skipped {stats['skipped']}")
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+class _CountingEntry:
+    """DirEntry stand-in that counts the stat calls that reach the OS"""
+
+    def __init__(self, entry, counts):
+        self._entry = entry
+        self._counts = counts
+        self._stat_seen = False
+
+    def stat(self, *, follow_symlinks=True):
+        # DirEntry caches its stat result, so only the first call is a syscall
+        if not self._stat_seen:
+            self._counts["stat"] += 1
+            self._stat_seen = True
+        return self._entry.stat(follow_symlinks=follow_symlinks)
+
+    def __getattr__(self, name):
+        return getattr(self._entry, name)
+
+    def __fspath__(self):
+        return self._entry.path
+
+
+class _CountingScandir:
+    def __init__(self, path, counts):
+        self._it = _real_scandir(path)
+        self._counts = counts
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return _CountingEntry(next(self._it), self._counts)
+
+    def close(self):
+        self._it.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_real_scandir = os.scandir
+
+
+@contextlib.contextmanager
+def count_syscalls():
+    """Count directory listings and stats made through the os module.
+
+    There's no strace here, so os.scandir, os.listdir, os.stat and os.lstat
+    are wrapped (os.walk and os.path.isdir go through them too).
+    """
+    counts = collections.Counter()
+    real = {name: getattr(os, name) for name in ("listdir", "stat", "lstat")}
+
+    def wrap(name):
+        def counted(*args, **kwargs):
+            counts["listdir" if name == "listdir" else "stat"] += 1
+            return real[name](*args, **kwargs)
+        return counted
+
+    def scandir(path="."):
+        counts["listdir"] += 1
+        return _CountingScandir(path, counts)
+
+    with mock.patch.object(os, "scandir", scandir), \
+            mock.patch.object(os, "listdir", wrap("listdir")), \
+            mock.patch.object(os, "stat", wrap("stat")), \
+            mock.patch.object(os, "lstat", wrap("lstat")):
+        yield counts
+
+
+def legacy_save_walks(folder):
+    """The folder walks one save made before the shared scanner"""
+    # Is there anything to save?
+    all_files = [f for _, _, files in os.walk(folder) for f in files]
+    # Backup and repo copy each built a manifest with os.walk + os.stat
+    for _ in range(2):
+        for root, dirs, files in os.walk(folder):
+            dirs[:] = [d for d in dirs if d not in tcc.EXCLUDE_DIRS]
+            for name in files:
+                os.stat(os.path.join(root, name))
+    # copy_all_files recursed with listdir + isdir
+    def listdir_walk(path):
+        for item in os.listdir(path):
+            if os.path.isdir(os.path.join(path, item)):
+                listdir_walk(os.path.join(path, item))
+    listdir_walk(folder)
+    # Count by type for the summary
+    for _, dirs, files in os.walk(folder):
+        pass
+    return len(all_files)
+
+
+def shared_scan(folder):
+    """The same information from one scan_folder snapshot"""
+    snapshot = tcc.scan_folder(folder)
+    snapshot.is_empty()
+    snapshot.count_by_type()
+    return len(snapshot.files)
+
+
+def bench_scan(args):
+    """Count the syscalls of the old per-step walks against one shared scan"""
+    temp_dir = tempfile.mkdtemp()
+    try:
+        src = os.path.join(temp_dir, "student")
+        make_tree(src, args.files, file_size=64)
+        print(f"Scan benchmark: {args.files} files in {args.files // 50} folders")
+        for label, func in (("separate walks per step (before)", legacy_save_walks),
+                            ("one shared scandir snapshot", shared_scan)):
+            with count_syscalls() as counts:
+                timed(label, func, src)
+            print(f"    {counts['listdir']} directory listings, {counts['stat']} stats")
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def make_virtualenv(path):
+    """Create a real virtualenv, with pip unless ensurepip is missing"""
+    result = subprocess.run([sys.executable, "-m", "venv", path], capture_output=True)
+    if result.returncode != 0:
+        subprocess.run([sys.executable, "-m", "venv", "--without-pip", path], check=True)
+
+
+def naive_ignores(patterns, rel):
+    """Try each rule in turn with fnmatch, as a loop over the rules would"""
+    ignored = False
+    for pattern in patterns:
+        negated = pattern.startswith("!")
+        pattern = pattern.lstrip("!").rstrip("/")
+        if fnmatch.fnmatchcase(rel.rpartition("/")[2], pattern) or fnmatch.fnmatchcase(rel, pattern):
+            ignored = not negated
+    return ignored
+
+
+def bench_ignore(args):
+    """Save-path work on a folder holding a real virtualenv, with and without ignore rules"""
+    temp_dir = tempfile.mkdtemp()
+    try:
+        with mock.patch.object(tcc, "WORK_DIR", temp_dir):
+            src = os.path.join(temp_dir, "student")
+            make_tree(src, args.files, file_size=512)
+            for project in os.listdir(src):
+                # What running the student's code leaves behind
+                cache = os.path.join(src, project, "__pycache__")
+                os.makedirs(cache)
+                for name in os.listdir(os.path.join(src, project)):
+                    if name.endswith(".py"):
+                        with open(os.path.join(cache, name[:-3] + ".cpython-311.pyc"), "wb") as f:
+                            f.write(os.urandom(512))
+            make_virtualenv(os.path.join(src, "venv"))
+            everything = tcc.scan_folder(src, rules=tcc.IgnoreRules(detect_virtualenvs=False))
+            print(f"Ignore benchmark: {args.files} student files, "
+                  f"{len(everything.files)} files in the folder (virtualenv and __pycache__)")
+
+            for label, rules in (("no rules (before)", tcc.IgnoreRules(detect_virtualenvs=False)),
+                                 ("default rules", tcc.get_ignore_rules(src))):
+                print(f"  {label}:")
+                snapshot = timed("scan", tcc.scan_folder, src, rules=rules)
+                timed("hash for the backup manifest", tcc.update_manifest,
+                      src, snapshot=snapshot)
+                dest = os.path.join(temp_dir, "copy")
+                stats = timed("copy", tcc.sync_folder, src, dest, snapshot=snapshot)
+                shutil.rmtree(dest)
+                print(f"    {stats['copied']} files copied, {len(snapshot.ignored)} paths pruned")
+
+            rules = tcc.get_ignore_rules(src)
+            paths = list(everything.files)
+            start = time.perf_counter()
+            for rel in paths:
+                naive_ignores(tcc.DEFAULT_IGNORE_RULES, rel)
+            naive = time.perf_counter() - start
+            start = time.perf_counter()
+            for rel in paths:
+                rules.ignores(rel)
+            compiled = time.perf_counter() - start
+            print(f"  matching {len(paths)} paths: fnmatch per rule {naive * 1000:.1f} ms, "
+                  f"compiled {compiled * 1000:.1f} ms")
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def bench_copy(args):
+    """The copies a save makes (backup and repo copy) with and without zero-copy"""
+    temp_dir = tempfile.mkdtemp()
+    try:
+        with mock.patch.object(tcc, "WORK_DIR", temp_dir):
+            src = os.path.join(temp_dir, "student")
+            make_tree(src, args.files)
+            os.makedirs(os.path.join(src, "media"))
+            for i in range(args.media):
+                with open(os.path.join(src, "media", f"video{i}.mp4"), "wb") as f:
+                    for _ in range(args.media_mb):
+                        f.write(os.urandom(1024 * 1024))
+            # Downloaded a while ago, like most of a student's media
+            past = time.time_ns() - 3600 * 10**9
+            for dirpath, _, files in os.walk(src):
+                for name in files:
+                    os.utime(os.path.join(dirpath, name), ns=(past, past))
+            print(f"Copy benchmark: {args.files} files and {args.media} x {args.media_mb} MiB of media")
+            timed("hash the folder (shared by both)", tcc.update_manifest, src)
+
+            store = tcc.store_backup_object
+            for run, (label, zero_copy) in enumerate((("read/write, copy rehashed (before)", False),
+                                                      ("zero-copy", True))):
+                before = tcc.copy_stats()
+                with mock.patch.object(tcc, "ZERO_COPY", zero_copy), \
+                        mock.patch.object(tcc, "BACKUP_DIR", os.path.join(temp_dir, f"backup{run}")), \
+                        mock.patch.object(tcc, "store_backup_object",
+                                          store if zero_copy else lambda path, digest, stat=None:
+                                          store(path, digest)):
+                    print(f"  {label}:")
+                    timed("backup", tcc.create_backup, src, "student")
+                    timed("repo copy", tcc.sync_folder, src, os.path.join(temp_dir, f"repo{run}"))
+                after = tcc.copy_stats()
+                print("    " + ", ".join(
+                    f"{strategy} {after[strategy]['files'] - before[strategy]['files']}"
+                    for strategy in tcc.COPY_STRATEGIES
+                    if after[strategy]["files"] != before[strategy]["files"]))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def folder_size(root):
+    """Total bytes of the files under root"""
+    return sum(os.path.getsize(os.path.join(dirpath, name))
+               for dirpath, _, files in os.walk(root) for name in files)
+
+
+def bench_backup(args):
+    """Time repeated backups and measure how much disk the store uses"""
+    temp_dir = tempfile.mkdtemp()
+    backup_dir = os.path.join(temp_dir, "backup")
+    try:
+        with mock.patch.object(tcc, "WORK_DIR", temp_dir), \
+                mock.patch.object(tcc, "BACKUP_DIR", backup_dir):
+            src = os.path.join(temp_dir, "student")
+            make_tree(src, args.files)
+            print(f"Backup benchmark: {args.files} files, {args.saves} saves")
+
+            timed("first backup", tcc.create_backup, src, "student")
+            for save in range(1, args.saves):
+                path = os.path.join(src, "project000", f"file{save % 50:05d}.py")
+                with open(path, "ab") as f:
+                    f.write(b"# edited\n")
+                timed(f"backup after 1 edit (save {save + 1})", tcc.create_backup, src, "student")
+
+            print(f"  student folder: {folder_size(src) / 1024:.0f} KiB, "
+                  f"backup store: {folder_size(backup_dir) / 1024:.0f} KiB "
+                  f"(full copies would be {folder_size(src) * args.saves / 1024:.0f} KiB)")
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def seed_remote(path, students, files_per_student=10, commits_per_student=1,
+                file_size=2048):
+    """Create a bare repository like the club's, with one branch per student.
+
+    Uses git fast-import so hundreds of students take seconds to create.
+    Returns a file:// URL for it (so partial clones work as against GitHub).
+    """
+    subprocess.run(["git", "init", "--bare", "-q", "-b", "main", path], check=True)
+    subprocess.run(["git", "config", "uploadpack.allowFilter", "true"], cwd=path, check=True)
+
+    def data(payload):
+        return b"data %d\n%s\n" % (len(payload), payload)
+
+    stream = [b"commit refs/heads/main\nmark :1\n",
+              b"committer Bench <bench@example.com> 1700000000 +0000\n",
+              data(b"Initial commit"),
+              b"M 100644 inline README.md\n", data(b"Tramore Code Club\n")]
+    for student in range(students):
+        name = f"student{student:04d}"
+        for commit in range(commits_per_student):
+            stream.append(f"commit refs/heads/student/{name}\n".encode())
+            stream.append(b"committer Bench <bench@example.com> 1700000000 +0000\n")
+            stream.append(data(f"Update from {name} #{commit}".encode()))
+            if commit == 0:
+                stream.append(b"from :1\n")
+            for i in range(files_per_student):
+                stream.append(f"M 100644 inline students/{name}/file{i:03d}.py\n".encode())
+                stream.append(data(os.urandom(file_size // 2).hex().encode()))
+    subprocess.run(["git", "fast-import", "--quiet"], cwd=path, input=b"".join(stream),
+                   check=True)
+    return f"file://{path}"
+
+
+def bench_clone(args):
+    """Compare a full clone with a blobless, sparse clone of a large club"""
+    temp_dir = tempfile.mkdtemp()
+    try:
+        url = seed_remote(os.path.join(temp_dir, "remote.git"), args.students,
+                          args.files, args.commits)
+        print(f"Clone benchmark: {args.students} students x {args.files} files "
+              f"x {args.commits} commits")
+
+        full = os.path.join(temp_dir, "full")
+        timed("full clone", subprocess.run, ["git", "clone", "-q", "--no-local", url, full],
+              check=True)
+        subprocess.run(["git", "checkout", "-q", "student/student0000"], cwd=full, check=True)
+
+        work_dir = os.path.join(temp_dir, "work")
+        os.makedirs(work_dir)
+        with mock.patch.object(tcc, "WORK_DIR", work_dir), \
+                mock.patch.object(tcc, "REPO_URL", url), \
+                mock.patch.object(tcc, "REPO_NAME", "sparse"), \
+                mock.patch.object(tcc, "_git_session", None):
+            timed("partial + sparse clone", tcc.clone_repository, work_dir)
+            timed("first student: sparse set + checkout", tcc.setup_student_branch,
+                  "student/student0000")
+            timed("switch to another student", tcc.setup_student_branch,
+                  "student/student0001")
+        sparse = os.path.join(work_dir, "sparse")
+
+        for label, path in (("full clone", full), ("partial + sparse clone", sparse)):
+            print(f"  {label:<24} .git {folder_size(os.path.join(path, '.git')) / 1024:8.0f} KiB"
+                  f", checked out {folder_size(path) / 1024 - folder_size(os.path.join(path, '.git')) / 1024:6.0f} KiB")
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def add_remote_commits(remote, branches, week):
+    """One new commit on each branch of the bare remote, as students saving in a week"""
+    def data(payload):
+        return b"data %d\n%s\n" % (len(payload), payload)
+
+    stream = []
+    for branch in branches:
+        name = branch.rpartition("/")[2]
+        stream.append(f"commit refs/heads/{branch}\n".encode())
+        stream.append(f"committer Bench <bench@example.com> {1700000000 + week * 604800} +0000\n"
+                      .encode())
+        stream.append(data(f"Week {week} from {name}".encode()))
+        stream.append(f"from refs/heads/{branch}^0\n".encode())
+        stream.append(f"M 100644 inline students/{name}/week{week:02d}.py\n".encode())
+        stream.append(data(os.urandom(512).hex().encode()))
+    subprocess.run(["git", "fast-import", "--quiet"], cwd=remote, input=b"".join(stream),
+                   check=True)
+
+
+def time_git(session, args, repeat):
+    """Median milliseconds for a git command"""
+    timings = []
+    for _ in range(repeat):
+        session.git(*args)
+        timings.append(session.calls[-1].seconds * 1000)
+    return sorted(timings)[len(timings) // 2]
+
+
+def bench_maintenance(args):
+    """Common git operations on a clone after a term of use, before and after maintenance"""
+    temp_dir = tempfile.mkdtemp()
+    try:
+        remote = os.path.join(temp_dir, "remote.git")
+        url = seed_remote(remote, args.students, args.files, args.commits)
+        work_dir = os.path.join(temp_dir, "work")
+        os.makedirs(work_dir)
+        with quiet_module(temp_dir), \
+                mock.patch.object(tcc, "WORK_DIR", work_dir), \
+                mock.patch.object(tcc, "REPO_URL", url), \
+                mock.patch.object(tcc, "_git_session", None):
+            tcc.clone_repository(work_dir)
+            repo = os.path.join(work_dir, tcc.REPO_NAME)
+            session = tcc.GitSession(repo)
+            branches = [f"student/student{i:04d}" for i in range(args.students)]
+            # Every student has logged in on this laptop at some point
+            session.git("update-ref", "--stdin", input="".join(
+                f"create refs/heads/{b} refs/remotes/origin/{b}\n" for b in branches))
+            for week in range(args.weeks):
+                active = branches[week * args.active % args.students:][:args.active]
+                add_remote_commits(remote, active, week)
+                session.git("fetch", "--prune", "origin")
+                # Saves made on this laptop
+                session.git("update-ref", "--stdin", input="".join(
+                    f"update refs/heads/{b} refs/remotes/origin/{b}\n" for b in active))
+
+            maintenance = tcc.GitMaintenance(repo, os.path.join(temp_dir, "maintenance.json"))
+            operations = dict(tcc.MAINTENANCE_PROBES)
+            operations["fetch (nothing new)"] = ("fetch", "--prune", "origin")
+            operations["merge-base"] = ("merge-base", "--is-ancestor", tcc.MAIN_BRANCH,
+                                        f"origin/{branches[0]}")
+
+            def describe():
+                return (f"{maintenance._loose_refs()[0]} loose refs, "
+                        f"{maintenance._loose_objects()} loose objects, "
+                        f"{maintenance._packs()} packs, "
+                        f"{len(session.git('branch', '--list')[1].splitlines())} local branches")
+
+            print(f"Maintenance benchmark: {args.students} students, {args.weeks} weeks "
+                  f"of {args.active} saves")
+            print(f"  before: {describe()}")
+            before = {name: time_git(session, command, args.repeat)
+                      for name, command in operations.items()}
+            start = time.perf_counter()
+            ran = maintenance.run_tasks(args.budget)
+            elapsed = time.perf_counter() - start
+            for task in ran:
+                print(f"  {task:<24} {maintenance.state['tasks'][task]['seconds'] * 1000:9.1f} ms")
+            print(f"  maintenance total          {elapsed * 1000:9.1f} ms "
+                  f"(budget {args.budget:.0f} s)")
+            print(f"  after:  {describe()}")
+            after = {name: time_git(session, command, args.repeat)
+                     for name, command in operations.items()}
+            print(f"  {'operation':<24} {'before ms':>10} {'after ms':>10}")
+            for name in operations:
+                print(f"  {name:<24} {before[name]:>10.1f} {after[name]:>10.1f}")
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def bench_fetch(args):
+    """Bytes and time for a student's login: fetching every branch vs only theirs and main"""
+    temp_dir = tempfile.mkdtemp()
+    try:
+        remote = os.path.join(temp_dir, "remote.git")
+        url = seed_remote(remote, args.students, args.files, args.commits)
+        branches = [f"student/student{i:04d}" for i in range(args.students)]
+        student = branches[0]
+        # Count what the remote sends by teeing upload-pack's output to a file
+        received = os.path.join(temp_dir, "received")
+        wrapper = os.path.join(temp_dir, "upload-pack")
+        with open(wrapper, "w") as f:
+            f.write(f'#!/bin/sh\ngit upload-pack "$@" | tee -a "{received}"\n')
+        os.chmod(wrapper, 0o755)
+        env = {"GIT_CONFIG_COUNT": "1", "GIT_CONFIG_KEY_0": "remote.origin.uploadpack",
+               "GIT_CONFIG_VALUE_0": wrapper}
+        git = tcc.GitSession.git
+
+        def git_with_wrapper(self, *git_args, **kwargs):
+            # clone ignores remote.origin.uploadpack, so it's given the wrapper directly
+            if "clone" in git_args:
+                at = git_args.index("clone") + 1
+                git_args = git_args[:at] + ("-u", wrapper) + git_args[at:]
+            return git(self, *git_args, **kwargs)
+
+        def measure(func, *func_args):
+            open(received, "wb").close()
+            start = time.perf_counter()
+            func(*func_args)
+            return (time.perf_counter() - start) * 1000, os.path.getsize(received)
+
+        def login():
+            session = tcc.get_git_session()
+            session.reset()
+            session.fetch()
+            session.has_remote_branch(student)
+
+        modes = {"all branches": (False, None), "main + student": (True, None)}
+        if args.depth:
+            modes[f"main + student, depth {args.depth}"] = (True, args.depth)
+        results = {}
+        week = 0
+        for label, (narrow, depth) in modes.items():
+            work_dir = os.path.join(temp_dir, f"work{len(results)}")
+            os.makedirs(work_dir)
+            with quiet_module(temp_dir), mock.patch.dict(os.environ, env), \
+                    mock.patch.object(tcc, "WORK_DIR", work_dir), \
+                    mock.patch.object(tcc, "REPO_URL", url), \
+                    mock.patch.object(tcc, "NARROW_FETCH", narrow), \
+                    mock.patch.object(tcc, "FETCH_DEPTH", depth), \
+                    mock.patch.object(tcc, "REF_INDEX_TTL", 0), \
+                    mock.patch.object(tcc.GitSession, "git", git_with_wrapper), \
+                    mock.patch.object(tcc, "_git_session", None):
+                first = measure(lambda: (tcc.clone_repository(work_dir), login()))
+                # A week of saves from every student, then the next login
+                week += 1
+                add_remote_commits(remote, branches, week)
+                results[label] = (first, measure(login))
+
+        print(f"Fetch benchmark: {args.students} students x {args.files} files "
+              f"x {args.commits} commits, logging in as {student}")
+        print(f"  {'':<28} {'first login':>22} {'next week':>22}")
+        for label, ((first_ms, first_bytes), (next_ms, next_bytes)) in results.items():
+            print(f"  {label:<28} {first_ms:8.1f} ms {first_bytes / 1024:7.0f} KiB"
+                  f" {next_ms:8.1f} ms {next_bytes / 1024:7.0f} KiB")
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def bench_save(args):
+    """Time a full save against the already-saved pre-check"""
+    temp_dir = tempfile.mkdtemp()
+    try:
+        url = seed_remote(os.path.join(temp_dir, "remote.git"), 0)
+        work_dir = os.path.join(temp_dir, "work")
+        make_tree(os.path.join(work_dir, "student"), args.files, file_size=256)
+        print(f"Save benchmark: {args.files} files")
+        print(f"Commits made with {'porcelain' if args.porcelain else 'plumbing'}")
+        with mock.patch.object(tcc, "WORK_DIR", work_dir), \
+                mock.patch.object(tcc, "BACKUP_DIR", os.path.join(temp_dir, "backup")), \
+                mock.patch.object(tcc, "REPO_URL", url), \
+                mock.patch.object(tcc, "PLUMBING_COMMIT", not args.porcelain), \
+                mock.patch.object(tcc, "_git_session", None), \
+                mock.patch.object(tcc, "print", create=True):
+            tcc.setup_repository()
+            tcc.setup_student_branch("student/student")
+            timed("first save", tcc.save_work, "Student", "student/student")
+            # As between two saves in a session: files are older than the save
+            past = time.time() - 3600
+            for root, _, files in os.walk(os.path.join(work_dir, "student")):
+                for name in files:
+                    os.utime(os.path.join(root, name), (past, past))
+            timed("full save, nothing changed", tcc.save_work, "Student", "student/student")
+            timed("save again: already-saved pre-check", tcc.save_work,
+                  "Student", "student/student")
+            for i in range(args.changed):
+                with open(os.path.join(work_dir, "student", f"project{i // 50:03d}",
+                                       f"file{i:05d}.py"), "a") as f:
+                    f.write("edited\n")
+            timed(f"save after editing {args.changed} files", tcc.save_work,
+                  "Student", "student/student")
+            tcc.get_push_worker().flush(30)
+            tcc.get_push_worker().stop()
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def log_pipeline(kind, log_dir, write_delay=0.0):
+    """Set the module's logger up as before (synchronous file at DEBUG) or with the queue"""
+    handlers, level = tcc.logger.handlers[:], tcc.logger.level
+    tcc.logger.handlers = []
+    real_emit = logging.FileHandler.emit
+
+    def slow_emit(handler, record):
+        # A log folder on a slow or synced disk
+        time.sleep(write_delay)
+        real_emit(handler, record)
+    try:
+        with mock.patch.object(tcc, "LOG_DIR", log_dir), \
+                mock.patch.object(logging.FileHandler, "emit", slow_emit):
+            if kind == "before":
+                handler = logging.FileHandler(os.path.join(log_dir, tcc.LOG_FILE))
+                handler.setFormatter(logging.Formatter(
+                    '%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+                tcc.logger.addHandler(handler)
+                tcc.logger.setLevel(logging.DEBUG)
+            else:
+                tcc.setup_logging(logging.DEBUG if kind == "queue, --debug" else None)
+            yield
+    finally:
+        tcc.stop_logging()
+        for handler in tcc.logger.handlers:
+            handler.close()
+        tcc.logger.handlers, tcc.logger.level = handlers, level
+
+
+def bench_logging(args):
+    """Time spent logging on the save path, for each logging pipeline"""
+    temp_dir = tempfile.mkdtemp()
+    try:
+        url = seed_remote(os.path.join(temp_dir, "remote.git"), 0)
+        work_dir = os.path.join(temp_dir, "work")
+        student = os.path.join(work_dir, "student")
+        make_tree(student, args.files, file_size=256)
+        print(f"Logging benchmark: {args.saves} saves of {args.files} files, "
+              f"{args.changed} edited before each, {args.write_delay_ms} ms per log write")
+        spent = [0.0]
+        real_log = logging.Logger._log
+
+        def timed_log(logger, *log_args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return real_log(logger, *log_args, **kwargs)
+            finally:
+                spent[0] += time.perf_counter() - start
+
+        with mock.patch.object(tcc, "WORK_DIR", work_dir), \
+                mock.patch.object(tcc, "BACKUP_DIR", os.path.join(temp_dir, "backup")), \
+                mock.patch.object(tcc, "REPO_URL", url), \
+                mock.patch.object(tcc, "_git_session", None), \
+                mock.patch.object(tcc, "print", create=True), \
+                mock.patch.object(tcc, "queue_push"):
+            tcc.setup_repository()
+            tcc.setup_student_branch("student/student")
+            tcc.save_work("Student", "student/student")
+            print(f"  {'pipeline':<22} {'records':>8} {'logging ms':>11} {'save ms':>9}  (per save)")
+            edit = 0
+            for kind in ("before", "queue, --debug", "queue"):
+                log_dir = os.path.join(temp_dir, kind.replace(", ", "-"))
+                os.makedirs(log_dir)
+                records, spent[0], total = 0, 0.0, 0.0
+                with log_pipeline(kind, log_dir, args.write_delay_ms / 1000), \
+                        mock.patch.object(logging.Logger, "_log", timed_log):
+                    for _ in range(args.saves):
+                        for _ in range(args.changed):
+                            with open(os.path.join(student, f"project{edit % (args.files // 50):03d}",
+                                                   f"file{edit % args.files:05d}.py"), "a") as f:
+                                f.write("edited\n")
+                            edit += 51
+                        before = tcc.get_git_session().spawn_count
+                        start = time.perf_counter()
+                        tcc.save_work("Student", "student/student")
+                        total += time.perf_counter() - start
+                        assert tcc.get_git_session().spawn_count > before
+                records = sum(1 for _ in open(os.path.join(log_dir, tcc.LOG_FILE)))
+                print(f"  {kind:<22} {records / args.saves:8.0f} "
+                      f"{spent[0] * 1000 / args.saves:11.2f} {total * 1000 / args.saves:9.1f}")
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def quiet_module(temp_dir):
+    """Keep the module's prints, screen clears, console warnings and git config out of the way"""
+    env = {"GIT_CONFIG_GLOBAL": os.path.join(temp_dir, "gitconfig"), "GIT_CONFIG_NOSYSTEM": "1"}
+    console = [h for h in tcc.logger.handlers if type(h) is logging.StreamHandler]
+    levels = [h.level for h in console]
+    for handler in console:
+        handler.setLevel(logging.CRITICAL)
+    try:
+        with mock.patch.dict(os.environ, env), \
+                mock.patch.object(tcc, "print", create=True), \
+                mock.patch.object(tcc, "clear_screen"):
+            yield
+    finally:
+        for handler, level in zip(console, levels):
+            handler.setLevel(level)
+
+
+@contextlib.contextmanager
+def count_subprocesses(all_threads=False):
+    """Count the subprocesses the module starts from this thread (or from any)"""
+    counts = collections.Counter()
+    lock = threading.Lock()
+    real_run = subprocess.run
+    caller = threading.current_thread()
+
+    def run(*args, **kwargs):
+        if all_threads or threading.current_thread() is caller:
+            with lock:
+                counts["spawns"] += 1
+        return real_run(*args, **kwargs)
+
+    with mock.patch.object(tcc.subprocess, "run", run):
+        yield counts
+
+
+def classroom_cycle(name, new_student, phases):
+    """One student's session: login, load, edit, save, save again, upload, next login"""
+    safe_name = tcc.get_safe_name(name)
+    branch = f"{tcc.STUDENT_BRANCH_PREFIX}{safe_name}"
+
+    def phase(label, func, *args):
+        # Uploads happen on the background worker
+        with count_subprocesses(all_threads=label == "upload") as counts:
+            start = time.perf_counter()
+            func(*args)
+            phases[label]["ms"].append((time.perf_counter() - start) * 1000)
+        phases[label]["spawns"].append(counts["spawns"])
+
+    def login():
+        answers = iter([name, "y"] if new_student else [name])
+        with mock.patch("builtins.input", lambda prompt="": next(answers)):
+            tcc.show_welcome_screen()
+        tcc.setup_student_branch(branch)
+
+    phase("login", login)
+    phase("load", tcc.load_student_code, name)
+    folder = os.path.join(tcc.WORK_DIR, safe_name)
+    with open(os.path.join(folder, "bench_edit.py"), "a") as f:
+        f.write(f"print({time.time()})\n")
+    # Files were edited during the session, not in the second before saving
+    past = time.time() - 600
+    for root, _, files in os.walk(folder):
+        for file_name in files:
+            os.utime(os.path.join(root, file_name), (past, past))
+    phase("save", tcc.save_work, name, branch)
+    phase("save_unchanged", tcc.save_work, name, branch)
+    phase("upload", lambda: tcc.get_push_worker().flush(60))
+
+    # Next week: a fresh run of the program on the same laptop
+    tcc._git_session = None
+    tcc._folder_indexes.clear()
+    phase("next_login", login)
+
+
+def run_classroom(args, temp_dir):
+    """Seed a club, run the cycle for some students and return per-phase results"""
+    url = seed_remote(os.path.join(temp_dir, "remote.git"), args.students, args.files,
+                      args.commits)
+    work_dir = os.path.join(temp_dir, "work")
+    os.makedirs(work_dir)
+    phases = collections.defaultdict(lambda: {"ms": [], "spawns": []})
+    with quiet_module(temp_dir), \
+            mock.patch.object(tcc, "WORK_DIR", work_dir), \
+            mock.patch.object(tcc, "BACKUP_DIR", os.path.join(temp_dir, "backup")), \
+            mock.patch.object(tcc, "REPO_URL", url), \
+            mock.patch.object(tcc, "_git_session", None), \
+            mock.patch.object(tcc, "_push_worker", None), \
+            mock.patch.dict(tcc._folder_indexes, clear=True):
+        returning = min(args.logins, args.students)
+        for i in range(returning):
+            classroom_cycle(f"student{i:04d}", False, phases)
+        for i in range(args.new):
+            classroom_cycle(f"New Student {i}", True, phases)
+        if tcc._push_worker:
+            tcc._push_worker.stop()
+
+    return {
+        "workload": {"students": args.students, "files": args.files, "commits": args.commits,
+                     "logins": returning, "new": args.new},
+        "phases": {
+            label: {
+                "p50_ms": round(tcc._percentile(data["ms"], 50), 1),
+                "p95_ms": round(tcc._percentile(data["ms"], 95), 1),
+                "spawns": max(data["spawns"]),
+            }
+            for label, data in phases.items()
+        },
+    }
+
+
+def compare_to_baseline(results, baseline, tolerance, min_ms):
+    """Print results beside the baseline and return the regressed phases"""
+    regressions = []
+    print(f"  {'phase':<16} {'p50 ms':>9} {'base':>9} {'p95 ms':>9} {'spawns':>7} {'base':>5}")
+    for label, stats in results["phases"].items():
+        base = baseline.get("phases", {}).get(label) if baseline else None
+        flags = []
+        if base:
+            slower = stats["p50_ms"] - base["p50_ms"]
+            if slower > min_ms and stats["p50_ms"] > base["p50_ms"] * (1 + tolerance):
+                flags.append(f"slower by {slower:.0f} ms")
+            if stats["spawns"] > base["spawns"]:
+                flags.append(f"{stats['spawns'] - base['spawns']} more subprocess(es)")
+        if flags:
+            regressions.append(label)
+        print(f"  {label:<16} {stats['p50_ms']:>9.1f} "
+              f"{base['p50_ms'] if base else '-':>9} {stats['p95_ms']:>9.1f} "
+              f"{stats['spawns']:>7} {base['spawns'] if base else '-':>5}"
+              f"{'  REGRESSION: ' + ', '.join(flags) if flags else ''}")
+    return regressions
+
+
+def bench_classroom(args):
+    """Script the login/load/save/pull cycle against a seeded local remote"""
+    temp_dir = tempfile.mkdtemp()
+    try:
+        print(f"Classroom benchmark: {args.students} students x {args.files} files x "
+              f"{args.commits} commits, {args.logins} returning and {args.new} new logins")
+        results = run_classroom(args, temp_dir)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("workload") != results["workload"]:
+            print("  (baseline was recorded with a different workload; timings not comparable)")
+            baseline = None
+    regressions = compare_to_baseline(results, baseline, args.tolerance, args.min_ms)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+        print(f"Baseline saved to {args.baseline}")
+    elif regressions:
+        print(f"Regressions in: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+def make_roster_names(count):
+    """count distinct student names built from common first names and surnames"""
+    first = ["aoife", "ciara", "sean", "liam", "emma", "niamh", "conor", "jack", "grace", "saoirse",
+             "oisin", "cian", "fionn", "roisin", "aisling", "darragh", "eoin", "orla", "tadhg", "cara"]
+    last = ["murphy", "kelly", "byrne", "ryan", "walsh", "oneill", "power", "dunne", "doyle",
+            "brennan", "burke", "collins", "keane", "quinn", "nolan"]
+    names = [f"{f}-{l}" for f in first for l in last]
+    return [names[i % len(names)] + (f"-{i // len(names)}" if i >= len(names) else "")
+            for i in range(count)]
+
+
+def bench_roster(args):
+    """Fuzzy name lookups: the deletion index against comparing with every name"""
+    names = make_roster_names(args.students)
+    typos = [name[:1] + name[2] + name[1] + name[3:] for name in names[::max(1, len(names) // 200)]]
+    print(f"Roster benchmark: {len(names)} students, {len(typos)} mistyped lookups")
+    roster = timed("build roster index", tcc.StudentRoster, names)
+
+    def scan_all():
+        for typo in typos:
+            sorted((tcc._edit_distance(typo, name, roster.max_distance), name) for name in names)
+
+    def indexed():
+        for typo in typos:
+            roster.suggest(typo)
+
+    timed("compare with every name", scan_all)
+    timed("deletion index", indexed)
+
+
+def time_to_prompt(command, env, prompt="What is your name?"):
+    """Seconds from starting command until it prints prompt"""
+    start = time.perf_counter()
+    process = subprocess.Popen(command, env=env, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL, text=True)
+    try:
+        for line in process.stdout:
+            if prompt in line:
+                break
+        return time.perf_counter() - start
+    finally:
+        process.kill()
+        process.wait()
+
+
+def bench_startup(args):
+    """Median time from process start to the welcome prompt"""
+    temp_dir = tempfile.mkdtemp()
+    try:
+        script = os.path.abspath(args.script)
+        env = dict(os.environ, HOME=temp_dir, PYTHONUNBUFFERED="1")
+        module_dir = os.path.dirname(script)
+        module = os.path.splitext(os.path.basename(script))[0]
+        print(f"Startup benchmark: median of {args.runs} runs of {script}")
+        for label, command, prompt in (
+                ("python interpreter only", [sys.executable, "-c", "print('ready')"], "ready"),
+                ("import the module", [sys.executable, "-c",
+                                       f"import sys; sys.path.insert(0, {module_dir!r}); "
+                                       f"import {module}; print('ready')"], "ready"),
+                ("run to the welcome prompt", [sys.executable, script], "What is your name?")):
+            times = sorted(time_to_prompt(command, env, prompt) for _ in range(args.runs))
+            print(f"  {label:<28} {times[len(times) // 2] * 1000:7.1f} ms")
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Tramore Code Club benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    sync_parser = subparsers.add_parser("sync", help="incremental folder sync")
+    sync_parser.add_argument("--files", type=int, default=5000)
+    sync_parser.set_defaults(func=bench_sync)
+
+    scan_parser = subparsers.add_parser("scan", help="folder walks vs one shared scan")
+    scan_parser.add_argument("--files", type=int, default=5000)
+    scan_parser.set_defaults(func=bench_scan)
+
+    ignore_parser = subparsers.add_parser("ignore", help="ignore rules on a folder with a virtualenv")
+    ignore_parser.add_argument("--files", type=int, default=500)
+    ignore_parser.set_defaults(func=bench_ignore)
+
+    copy_parser = subparsers.add_parser("copy", help="zero-copy backups and repo copies")
+    copy_parser.add_argument("--files", type=int, default=1000)
+    copy_parser.add_argument("--media", type=int, default=4, help="large media files")
+    copy_parser.add_argument("--media-mb", type=int, default=64)
+    copy_parser.set_defaults(func=bench_copy)
+
+    logging_parser = subparsers.add_parser("logging", help="per-save logging overhead")
+    logging_parser.add_argument("--files", type=int, default=2000)
+    logging_parser.add_argument("--saves", type=int, default=20)
+    logging_parser.add_argument("--changed", type=int, default=5)
+    logging_parser.add_argument("--write-delay-ms", type=float, default=0,
+                                help="simulate a slow log disk by delaying each write")
+    logging_parser.set_defaults(func=bench_logging)
+
+    backup_parser = subparsers.add_parser("backup", help="deduplicated backups")
+    backup_parser.add_argument("--files", type=int, default=2000)
+    backup_parser.add_argument("--saves", type=int, default=5)
+    backup_parser.set_defaults(func=bench_backup)
+
+    save_parser = subparsers.add_parser("save", help="full save vs already-saved check")
+    save_parser.add_argument("--files", type=int, default=5000)
+    save_parser.add_argument("--changed", type=int, default=10,
+                             help="files edited before the last save")
+    save_parser.add_argument("--porcelain", action="store_true",
+                             help="commit with git add and git commit, as before")
+    save_parser.set_defaults(func=bench_save)
+
+    classroom_parser = subparsers.add_parser(
+        "classroom", help="login/load/save/pull cycle for a seeded club, against a baseline")
+    classroom_parser.add_argument("--students", type=int, default=30)
+    classroom_parser.add_argument("--files", type=int, default=20)
+    classroom_parser.add_argument("--commits", type=int, default=3)
+    classroom_parser.add_argument("--logins", type=int, default=5,
+                                  help="returning students to run the cycle for")
+    classroom_parser.add_argument("--new", type=int, default=2,
+                                  help="first-time students to run the cycle for")
+    classroom_parser.add_argument("--baseline", default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json"))
+    classroom_parser.add_argument("--save-baseline", action="store_true",
+                                  help="record this run as the new baseline")
+    classroom_parser.add_argument("--tolerance", type=float, default=0.5,
+                                  help="fraction slower than baseline that counts as a regression")
+    classroom_parser.add_argument("--min-ms", type=float, default=50,
+                                  help="ignore slowdowns smaller than this")
+    classroom_parser.set_defaults(func=bench_classroom)
+
+    roster_parser = subparsers.add_parser("roster", help="fuzzy student name lookups")
+    roster_parser.add_argument("--students", type=int, default=2000)
+    roster_parser.set_defaults(func=bench_roster)
+
+    startup_parser = subparsers.add_parser("startup", help="process start to the welcome prompt")
+    startup_parser.add_argument("--runs", type=int, default=15)
+    startup_parser.add_argument("--script", default=tcc.__file__,
+                                help="copy of tramore_code_club.py to time")
+    startup_parser.set_defaults(func=bench_startup)
+
+    clone_parser = subparsers.add_parser("clone", help="full vs partial, sparse clone")
+    clone_parser.add_argument("--students", type=int, default=200)
+    clone_parser.add_argument("--files", type=int, default=10)
+    clone_parser.add_argument("--commits", type=int, default=3)
+    clone_parser.set_defaults(func=bench_clone)
+
+    fetch_parser = subparsers.add_parser(
+        "fetch", help="fetching every branch vs only main and the student's")
+    fetch_parser.add_argument("--students", type=int, default=200)
+    fetch_parser.add_argument("--files", type=int, default=10)
+    fetch_parser.add_argument("--commits", type=int, default=3)
+    fetch_parser.add_argument("--depth", type=int, default=1,
+                              help="also time a shallow fetch this deep (0 to skip)")
+    fetch_parser.set_defaults(func=bench_fetch)
+
+    maintenance_parser = subparsers.add_parser(
+        "maintenance", help="git operations after a term of use, before and after maintenance")
+    maintenance_parser.add_argument("--students", type=int, default=200)
+    maintenance_parser.add_argument("--files", type=int, default=10)
+    maintenance_parser.add_argument("--commits", type=int, default=3)
+    maintenance_parser.add_argument("--weeks", type=int, default=12)
+    maintenance_parser.add_argument("--active", type=int, default=30,
+                                    help="students saving each week")
+    maintenance_parser.add_argument("--repeat", type=int, default=5,
+                                    help="runs of each operation (the median is shown)")
+    maintenance_parser.add_argument("--budget", type=float, default=tcc.MAINTENANCE_EXIT_BUDGET)
+    maintenance_parser.set_defaults(func=bench_maintenance)
+
+    args = parser.parse_args()
+    return args.func(args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,33 @@
 #!/usr/bin/env python3
 
 import os
+import re
+import errno
+import atexit
 import sys
 import subprocess
 import time
 import shutil
+import tempfile
 import datetime
 import logging
+import argparse
+import bisect
+import threading
+import concurrent.futures
+import json
+import hashlib
+import math
+import contextlib
+import collections
+import socket
+import select
+import struct
+import unicodedata
+import functools
+import itertools
 from pathlib import Path
-from typing import Tuple, Optional, Dict
+from typing import Callable, Iterable, Tuple, Optional, Dict, List, NamedTuple
 
 # Configuration - will be replaced during setup
 REPO_NAME = "tramore-code-club-python"
@@ -23,33 +42,181 @@ STUDENTS_SUBDIR = "students"
 DEFAULT_GIT_NAME = "Tramore Code Club"
 DEFAULT_GIT_EMAIL = "tramore.code.club@example.com"
 EXCLUDE_DIRS = ['.git']
+IGNORE_FILE = ".codeclubignore"  # In a student's folder: extra rules, written like .gitignore
+DEFAULT_IGNORE_RULES = [  # Never saved, backed up or copied (a student's rules can re-include with "!")
+    "__pycache__/", "*.py[cod]", ".venv/", ".ipynb_checkpoints/", ".pytest_cache/",
+    ".mypy_cache/", ".ruff_cache/", ".tox/", "*.egg-info/", "node_modules/", ".idea/",
+    "*.zip", "*.swp", "*~", ".DS_Store", "Thumbs.db", "desktop.ini",
+]
+VIRTUALENV_MARKER = "pyvenv.cfg"  # A folder holding this is a virtualenv, whatever its name
+SPARSE_CLONE = True  # Blobless clone that only checks out the logged-in student's folder
+USE_WORKTREES = True  # Check each student's branch out in its own git worktree
+WORKTREES_SUBDIR = "worktrees"  # Under the state folder
+REF_INDEX_FILE = "codeclub-ref-index.json"  # Kept inside the clone's .git folder
+REF_INDEX_TTL = 60  # Seconds a fetch stays fresh across restarts
+NARROW_FETCH = True  # Only fetch main and the logged-in student's branch; the rest are only listed
+FETCH_DEPTH = None  # Commits of history to fetch per branch, e.g. 1; None fetches all of it
+STATE_SUBDIR = ".codeclub"  # Hidden folder under WORK_DIR for caches and manifests
+HASH_CHUNK_SIZE = 1024 * 1024
+BACKUP_OBJECTS_SUBDIR = ".objects"  # Under BACKUP_DIR: one file per unique content
+BACKUP_SNAPSHOTS_SUBDIR = ".snapshots"  # Under BACKUP_DIR: <safe_name>/<id>.json
+BACKUP_KEEP_LAST = 10  # Always keep this many of the newest backups
+BACKUP_KEEP_DAILY = 7  # Plus the newest backup from each of this many days
+BACKUP_KEEP_WEEKLY = 12  # Plus the newest backup from each of this many weeks
+PUSH_QUEUE_FILE = "push_queue.json"  # In the state folder
+PUSH_RETRY_BASE = 5  # Seconds before the first retry of a failed upload
+PUSH_RETRY_MAX = 300  # Longest wait between upload retries
+PUSH_FLUSH_TIMEOUT = 15  # Seconds to wait for uploads when the program exits
+SAVE_ALL_WORKERS = 8  # Students backed up and committed at once by --save-all
+PLUMBING_COMMIT = True  # Commit saves straight from the student's folder with git plumbing
+ZERO_COPY = True  # Copy files with reflinks or inside the kernel where the filesystem allows
+COPY_STRATEGIES = ("reflink", "hardlink", "copy_file_range", "sendfile", "copy")  # Tried in this order
+COPY_CHUNK_SIZE = 64 * 1024 * 1024  # Largest piece copy_file_range or sendfile is asked for at once
+FICLONE = 0x40049409  # Linux ioctl that makes a reflink
+FLEET_URL = None  # Classroom coordinator, e.g. "http://mentor-laptop:8765"; None turns fleet mode off
+FLEET_MIRROR_URL = None  # Classroom git mirror, e.g. "git://mentor-laptop/tramore-code-club-python.git"
+FLEET_PORT = 8765  # Port the coordinator listens on
+FLEET_SLOTS = 4  # Laptops allowed to clone or fetch at the same time
+FLEET_LEASE = 180  # Seconds before a slot that was never given back is reclaimed
+FLEET_POLL = 20  # Seconds one request waits at the coordinator for a slot
+FLEET_WAIT_TIMEOUT = 300  # Give up waiting for a slot and go ahead after this long
+FLEET_SYNC_INTERVAL = 60  # Seconds between the coordinator's mirror syncs with GitHub
+FLEET_STATS_WINDOW = 60  # Seconds of history used for the coordinator's throughput
+FOLDER_INDEX_SUBDIR = "indexes"  # Under the state folder: <safe_name>.json per student
+FOLDER_INDEX_JOURNAL = 200  # Recent file changes kept in each index
+FOLDER_INDEX_WATCH = True  # Keep the index live with inotify where available (Linux)
+TRACE_ENABLED = True  # Write a JSON line per timed operation for --profile
+TRACE_FILE = "trace.jsonl"  # In the state folder
+TRACE_MAX_BYTES = 5 * 1024 * 1024  # Then the trace moves to trace.jsonl.1 and starts again
+ROSTER_MAX_DISTANCE = 2  # Typos (letters added, missed or changed) forgiven when suggesting a name
+ROSTER_MIN_PREFIX = 3  # Letters needed before a name is suggested from its start
+NAME_REGISTRY_FILE = "names.json"  # In the state folder: typed name -> safe name
+SAFE_NAME_MAX_LENGTH = 40  # Longest folder/branch name made from a student's name
+LOG_FILE = "tramore_code_club.log"  # In LOG_DIR
+LOG_LEVEL = logging.INFO  # Lowest level logged; --debug also logs every git command and scan
+LOG_MAX_BYTES = 2 * 1024 * 1024  # Then the log is rotated
+LOG_BACKUP_COUNT = 10  # Rotated logs kept, gzipped (tramore_code_club.log.1.gz is the newest)
+LOG_ROTATE_DAILY = True  # Also rotate on the first message of each day
+MAINTENANCE_ENABLED = True  # Tidy the clone up while the student is at the menu, and after exit
+MAINTENANCE_IDLE_DELAY = 5  # Seconds at the menu before maintenance starts
+MAINTENANCE_IDLE_BUDGET = 20  # Seconds of maintenance per session while students are at the menu
+MAINTENANCE_EXIT_BUDGET = 60  # Seconds for the run left going when the program exits
+MAINTENANCE_FILE = "maintenance.json"  # In the state folder: task history and before/after timings
+MAINTENANCE_LOCK_FILE = "maintenance.lock"  # In the state folder: there while a --maintenance run works
+MAINTENANCE_LOCK_STALE = 300  # Seconds after which a lock no task has touched was left by a killed run
+SESSION_STAMP_FILE = "session.stamp"  # In the state folder: touched as each session starts
+MAINTENANCE_HISTORY = 20  # Runs whose before/after timings are kept
+MAINTENANCE_LOOSE_REFS = 50  # Pack refs once this many are loose files
+MAINTENANCE_LOOSE_OBJECTS = 100  # Pack loose objects once there are this many (as git maintenance)
+MAINTENANCE_MAX_PACKS = 10  # Combine packs once there are this many (as git maintenance)
+MAINTENANCE_PRUNE_INTERVAL = 24 * 3600  # Seconds between looks for stale branches
+MAINTENANCE_STALE_DAYS = 30  # Delete a local student branch with no commits for this long
+
+
+def _next_midnight(timestamp: float) -> float:
+    day = datetime.date.fromtimestamp(timestamp) + datetime.timedelta(days=1)
+    return datetime.datetime.combine(day, datetime.time.min).timestamp()
+
+def make_log_file_handler(path: str) -> logging.Handler:
+    """Create the handler that writes the log file.
+
+    The log is rotated when it reaches LOG_MAX_BYTES and, with
+    LOG_ROTATE_DAILY, on the first message of a new day, so each club
+    session starts a fresh file. Rotated logs are gzipped and the newest
+    LOG_BACKUP_COUNT are kept. (logging.handlers and gzip are only
+    imported once logging is set up.)
 
-# Make sure directories exist
-os.makedirs(WORK_DIR, exist_ok=True)
-os.makedirs(BACKUP_DIR, exist_ok=True)
-os.makedirs(LOG_DIR, exist_ok=True)
+    Args:
+        path: Log file to write
+
+    Returns:
+        The file handler
+    """
+    import gzip
+    import logging.handlers
+
+    class CompressedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+        def __init__(self, filename: str):
+            super().__init__(filename, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                             encoding="utf-8", delay=True)
+            self.namer = lambda name: f"{name}.gz"
+            self.rotator = self._compress
+            try:
+                started = os.path.getmtime(filename)
+            except OSError:
+                started = time.time()
+            self.rollover_at = _next_midnight(started)
+
+        @staticmethod
+        def _compress(source: str, dest: str):
+            with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+                shutil.copyfileobj(f_in, f_out)
+            os.remove(source)
+
+        def shouldRollover(self, record: logging.LogRecord) -> bool:
+            if LOG_ROTATE_DAILY and record.created >= self.rollover_at:
+                try:
+                    if os.path.getsize(self.baseFilename):
+                        return True
+                except OSError:
+                    pass
+                self.rollover_at = _next_midnight(record.created)
+            return bool(super().shouldRollover(record))
+
+        def doRollover(self):
+            super().doRollover()
+            self.rollover_at = _next_midnight(time.time())
+
+    return CompressedRotatingFileHandler(path)
+
+_log_listener = None
+
+def setup_logging(level: Optional[int] = None):
+    """Configure logging with both file and console handlers.
+
+    Messages are put on a queue and written to the log file by a background
+    thread, so a save never waits for the disk. Warnings and errors are
+    also printed straight away. Messages below the level (LOG_LEVEL unless
+    given) are dropped before they are formatted.
 
-# Setup logging
-def setup_logging():
-    """Configure logging with both file and console handlers."""
-    log_file = os.path.join(LOG_DIR, "tramore_code_club.log")
+    Args:
+        level: Lowest level to log, e.g. logging.DEBUG for --debug
+    """
+    global _log_listener
+    import logging.handlers
+    import queue
+
+    class LogQueueHandler(logging.handlers.QueueHandler):
+        def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+            # Only fill the message in now (its arguments could change before
+            # the listener gets to it); the rest of the formatting is left to
+            # the listener. The record isn't pickled, so needn't be copied.
+            if record.args:
+                record.msg = record.getMessage()
+                record.args = None
+            return record
 
     # Create logger
     logger = logging.getLogger("TramoreCodeClub")
-    logger.setLevel(logging.DEBUG)
+    logger.setLevel(LOG_LEVEL if level is None else level)
 
     # Prevent duplicate handlers
     if logger.handlers:
         return logger
 
-    # File handler - detailed logging
-    file_handler = logging.FileHandler(log_file)
-    file_handler.setLevel(logging.DEBUG)
+    os.makedirs(LOG_DIR, exist_ok=True)
+
+    # File handler - detailed logging, written from the listener's thread
+    file_handler = make_log_file_handler(os.path.join(LOG_DIR, LOG_FILE))
     file_formatter = logging.Formatter(
         '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S'
     )
     file_handler.setFormatter(file_formatter)
+    log_queue = queue.SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(log_queue, file_handler)
+    _log_listener.start()
+    atexit.register(stop_logging)
 
     # Console handler - only errors and warnings
     console_handler = logging.StreamHandler()
@@ -57,48 +224,842 @@ def setup_logging():
     console_formatter = logging.Formatter('%(levelname)s: %(message)s')
     console_handler.setFormatter(console_formatter)
 
-    logger.addHandler(file_handler)
+    logger.addHandler(LogQueueHandler(log_queue))
     logger.addHandler(console_handler)
 
     return logger
 
-logger = setup_logging()
+def stop_logging():
+    """Write out any queued log messages and close the log file."""
+    global _log_listener
+    listener, _log_listener = _log_listener, None
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+
+# Handlers are added by setup_logging() when the program starts, not on import
+logger = logging.getLogger("TramoreCodeClub")
+
+
+class AppContext:
+    """What one run of the program sets up, each part once and only when needed.
+
+    Importing this module has no side effects. main() calls start() to
+    create the folders and the log file; the repository is set up the first
+    time something needs it and not again for the rest of the run.
+
+    prefetch() does the repository setup in the background while the
+    student types their name. Anything that needs the repository holds
+    the lock, so it waits for that work instead of repeating it.
+    """
+
+    def __init__(self):
+        self.work_dir = WORK_DIR
+        self.started = False
+        self.repo_ready = False
+        self.repo_setups = 0
+        self.known_branches: set = set()
+        self.remote_refs_known = False  # known_branches is from this run's fetch
+        self._lock = threading.RLock()
+        self._prefetcher: Optional[threading.Thread] = None
+        self._pulls: Dict[str, threading.Thread] = {}
+        self._pulls_lock = threading.Lock()
+        self._roster: Optional["StudentRoster"] = None
+
+    def start(self, log_level: Optional[int] = None):
+        """Create the program's folders and set up logging.
+
+        Args:
+            log_level: Lowest level to log (default: LOG_LEVEL)
+        """
+        with self._lock:
+            if self.started:
+                return
+            for folder in (WORK_DIR, BACKUP_DIR, LOG_DIR):
+                os.makedirs(folder, exist_ok=True)
+            setup_logging(log_level)
+            start_tracing(get_trace_path())
+            self.started = True
+
+    def ensure_repository(self, quiet: bool = False) -> bool:
+        """Set up the repository, unless this run already has.
+
+        A failed setup can be tried again (e.g. after the Wi-Fi comes back).
+
+        Args:
+            quiet: Only log, print nothing (for setup in the background)
+
+        Returns:
+            True if repository is ready to use
+        """
+        with self._lock:
+            if self.repo_ready and os.path.isdir(os.path.join(WORK_DIR, REPO_NAME)):
+                return True
+            self.repo_setups += 1
+            self.repo_ready = setup_repository(quiet=quiet)
+            return self.repo_ready
+
+    def ensure_remote_refs(self, quiet: bool = False) -> bool:
+        """Set up the repository and fetch the remote's branch list.
+
+        Args:
+            quiet: Only log, print nothing (for setup in the background)
+
+        Returns:
+            True if repository is ready to use
+        """
+        with self._lock:
+            if not self.ensure_repository(quiet):
+                return False
+            session = get_git_session()
+            session.fetch()
+            self.known_branches = set(session.remote_index.branches)
+            self.remote_refs_known = True
+            return True
+
+    def roster(self) -> "StudentRoster":
+        """Every student known to this run, rebuilt only after a new fetch."""
+        with self._lock:
+            self.ensure_remote_refs()
+            fetched_at = get_git_session().remote_index.fetched_at if self.repo_ready else 0.0
+            if self._roster is None or self._roster.fetched_at != fetched_at:
+                self._roster = StudentRoster.from_repository()
+                self._roster.fetched_at = fetched_at
+            return self._roster
+
+    def has_work(self, safe_name: str) -> bool:
+        """True if a safe name has a folder here, a known branch or is on the roster.
+
+        Doesn't wait for the fetch: the branches are what's known so far.
+        """
+        if os.path.isdir(os.path.join(WORK_DIR, safe_name)) \
+                or f"{STUDENT_BRANCH_PREFIX}{safe_name}" in self.known_branches:
+            return True
+        roster = self._roster
+        return roster is not None and safe_name in roster
+
+    def student_added(self, safe_name: str):
+        """Record a student created during this run."""
+        with self._lock:
+            if self._roster is not None:
+                self._roster.add(safe_name)
+
+    def prefetch(self):
+        """Start the repository setup and remote fetch in the background."""
+        with self._lock:
+            if self._prefetcher is not None:
+                return
+            # Branches from the last run, so a returning student is
+            # recognised even before this run's fetch has finished
+            index = RemoteRefIndex(os.path.join(WORK_DIR, REPO_NAME, ".git", REF_INDEX_FILE))
+            index.load()
+            self.known_branches = set(index.branches)
+            # Quiet: the student is typing their name meanwhile
+            self._prefetcher = threading.Thread(target=self._run_in_background,
+                                                args=("prefetch", self.ensure_remote_refs, True),
+                                                name="prefetch", daemon=True)
+            self._prefetcher.start()
+
+    def _run_in_background(self, name: str, func: Callable, *args):
+        with TraceSpan(name, background=True):
+            try:
+                func(*args)
+            except Exception:
+                logger.exception(f"Background {name} failed")
+
+    def wait_for_prefetch(self, timeout: Optional[float] = None) -> bool:
+        """Wait for prefetch() to finish.
+
+        Returns:
+            True if there is no background setup still running
+        """
+        if self._prefetcher is not None:
+            self._prefetcher.join(timeout)
+            return not self._prefetcher.is_alive()
+        return True
+
+    def start_pull(self, student_name: str, branch_name: str) -> bool:
+        """Start pulling a returning student's files in the background.
+
+        Only done for a branch the remote is known to have, so the guess
+        can't create anything for a name that turns out to be new. Doesn't
+        wait for prefetch(): the pull is queued behind it instead.
+
+        Returns:
+            True if a pull was started (or already running)
+        """
+        with self._pulls_lock:
+            if branch_name in self._pulls:
+                return True
+            if branch_name not in self.known_branches:
+                return False
+            logger.info(f"Speculatively pulling {branch_name}")
+            thread = threading.Thread(target=self._run_in_background,
+                                      args=("speculative_pull", self._pull,
+                                            student_name, branch_name),
+                                      name=f"pull-{branch_name}", daemon=True)
+            self._pulls[branch_name] = thread
+            thread.start()
+            return True
+
+    def _pull(self, student_name: str, branch_name: str):
+        if self.ensure_remote_refs(quiet=True):
+            pull_student_files(student_name, branch_name)
+
+    def finish_pull(self, student_name: str, branch_name: str):
+        """Wait for the pull started by start_pull(), or pull now if there wasn't one."""
+        with self._pulls_lock:
+            thread = self._pulls.pop(branch_name, None)
+        if thread is None:
+            pull_student_files(student_name, branch_name)
+        else:
+            thread.join()
+
+
+_app: Optional[AppContext] = None
+
+def get_app() -> AppContext:
+    """Get the context for this run of the program."""
+    global _app
+    if _app is None or _app.work_dir != WORK_DIR:
+        _app = AppContext()
+    return _app
 
 def clear_screen():
     """Clear the terminal screen."""
-    os.system('clear')
+    # An escape sequence rather than running `clear`, which costs a process
+    if sys.stdout.isatty():
+        print("\033[H\033[2J", end="", flush=True)
     logger.debug("Screen cleared")
 
-def run_command(command: str, working_dir: Optional[str] = None) -> Tuple[bool, str]:
-    """Run a shell command and return the output.
+_URL_CREDENTIALS = re.compile(r"\b([a-z][a-z0-9+.-]*://)[^/@\s]+@", re.IGNORECASE)
 
-    Args:
-        command: Shell command to execute
-        working_dir: Directory to run command in (optional)
+def redact_credentials(text: str) -> str:
+    """Hide the user:token part of any URL in text, before it is logged or traced."""
+    return _URL_CREDENTIALS.sub(r"\1***@", text)
 
-    Returns:
-        Tuple of (success: bool, output: str)
+class TraceSpan:
+    """One timed operation, written to the trace file as a JSON line.
+
+    Spans nest: a span opened while another is open in the same thread
+    records it as its parent, so a slow login can be traced down to the
+    git command that made it slow. Use as a context manager:
+
+        with TraceSpan("create_backup", student=safe_name) as span:
+            ...
+            span.add("bytes_copied", written)
     """
-    logger.debug(f"Running command: {command} in {working_dir or 'current directory'}")
-    try:
-        result = subprocess.run(
-            command,
-            shell=True,
-            check=True,
-            text=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            cwd=working_dir
+
+    _ids = itertools.count(1)
+    _local = threading.local()
+    host = socket.gethostname()
+    run_id = f"{host}-{os.getpid()}-{int(time.time())}"
+
+    def __init__(self, name: str, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.id = next(self._ids)
+        self.parent = None
+        self.ok = True
+
+    @classmethod
+    def current(cls) -> Optional["TraceSpan"]:
+        """The innermost open span in this thread, if any."""
+        stack = getattr(cls._local, "stack", None)
+        return stack[-1] if stack else None
+
+    def set(self, **attrs):
+        """Record extra fields, e.g. exit_code."""
+        self.attrs.update(attrs)
+
+    def add(self, key: str, amount: int):
+        """Add to a counter field, e.g. bytes_copied."""
+        self.attrs[key] = self.attrs.get(key, 0) + amount
+
+    def __enter__(self) -> "TraceSpan":
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        self.parent = stack[-1].id if stack else None
+        stack.append(self)
+        self._started = time.time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self._start
+        self._local.stack.remove(self)
+        if exc_type is not None:
+            self.ok = False
+            self.attrs["error"] = exc_type.__name__
+        write_trace({
+            "ts": round(self._started, 3),
+            "run": self.run_id,
+            "host": self.host,
+            "thread": threading.current_thread().name,
+            "span": self.id,
+            "parent": self.parent,
+            "name": self.name,
+            "ms": round(elapsed * 1000, 3),
+            "ok": self.ok,
+            **self.attrs,
+        })
+        return False
+
+
+def get_trace_path() -> str:
+    """Path of this laptop's trace file."""
+    return os.path.join(WORK_DIR, STATE_SUBDIR, TRACE_FILE)
+
+class TraceWriter:
+    """The trace file, opened on the first span and kept open for the run.
+
+    Spans are written from every thread (git calls, prefetch, uploads,
+    maintenance), so each one costs a single line-buffered write: the
+    folder is made and the size read once, when the file is opened.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def write(self, line: str):
+        """Append a line, moving the file to .1 once it passes TRACE_MAX_BYTES."""
+        with self._lock:
+            try:
+                if self._file is not None and self._size > TRACE_MAX_BYTES:
+                    self._file.close()
+                    self._file = None
+                    os.replace(self.path, f"{self.path}.1")
+                if self._file is None:
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                    self._file = open(self.path, "a", encoding="utf-8", buffering=1)
+                    self._size = self._file.tell()
+                self._file.write(line)
+                self._size += len(line)
+            except OSError as e:
+                logger.debug("Could not write trace: %s", e)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+_trace_writer: Optional[TraceWriter] = None
+
+def start_tracing(path: str):
+    """Send spans to a trace file from now on (AppContext.start() does this for the run)."""
+    global _trace_writer
+    writer, _trace_writer = _trace_writer, TraceWriter(path)
+    if writer is not None:
+        writer.close()
+
+def write_trace(record: Dict):
+    """Append one span to the trace file (errors are logged, tracing is optional)."""
+    if not TRACE_ENABLED:
+        return
+    if _trace_writer is None:
+        # Nothing has started tracing, e.g. a function called on its own
+        start_tracing(get_trace_path())
+    _trace_writer.write(redact_credentials(json.dumps(record, default=str)) + "\n")
+
+def traced(name: Optional[str] = None):
+    """Decorator that runs a function inside a TraceSpan.
+
+    A function that returns False (this file's way of reporting failure)
+    is recorded as not ok.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with TraceSpan(name or func.__name__) as span:
+                result = func(*args, **kwargs)
+                if result is False:
+                    span.ok = False
+                return result
+        return wrapper
+    return decorator
+
+def trace_add(key: str, amount: int):
+    """Add to a counter on the innermost open span, if there is one."""
+    span = TraceSpan.current()
+    if span is not None:
+        span.add(key, amount)
+
+class GitCall(NamedTuple):
+    """One git process spawned by a GitSession."""
+    command: str
+    seconds: float
+    success: bool
+
+
+class RemoteRefIndex:
+    """Branch tips on the remote as of the last fetch.
+
+    The index lives in memory for the session and is mirrored to a small
+    JSON file so a restart within REF_INDEX_TTL seconds doesn't need to
+    contact the remote again.
+
+    The upload worker records its pushes here while the menu reads it, so
+    changes replace `branches` with a new dict instead of editing it.
+    """
+
+    def __init__(self, path: str, ttl: Optional[float] = None):
+        self.path = path
+        self.ttl = REF_INDEX_TTL if ttl is None else ttl
+        self.fetched_at = 0.0
+        self.branches: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def is_fresh(self) -> bool:
+        """True if the index was filled less than ttl seconds ago."""
+        return self.fetched_at > 0 and time.time() - self.fetched_at < self.ttl
+
+    def load(self) -> bool:
+        """Load the on-disk index.
+
+        Returns:
+            True if a fresh index was loaded
+        """
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.fetched_at = float(data["fetched_at"])
+            self.branches = dict(data["branches"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        return self.is_fresh()
+
+    def save(self):
+        """Write the index to disk, ignoring errors (it's only a cache)."""
+        with self._lock:
+            try:
+                with open(self.path, "w", encoding="utf-8") as f:
+                    json.dump({"fetched_at": self.fetched_at, "branches": self.branches}, f)
+            except OSError as e:
+                logger.warning(f"Could not write ref index {self.path}: {e}")
+
+    def update(self, branches: Dict[str, str]):
+        """Replace the index with freshly fetched branch tips."""
+        with self._lock:
+            self.branches = dict(branches)
+            self.fetched_at = time.time()
+        self.save()
+
+    def set_branch(self, branch_name: str, sha: str):
+        """Record a branch tip we pushed ourselves."""
+        with self._lock:
+            self.branches = {**self.branches, branch_name: sha}
+        self.save()
+
+    def has_branch(self, branch_name: str) -> bool:
+        return branch_name in self.branches
+
+
+class GitSession:
+    """Shared git state for one run of the program.
+
+    Every git call made while a student is logged in goes through `git()`,
+    which runs git directly (no shell), times the call and records it in
+    `calls`. Repository state that only our own commands can change - the
+    current branch, the config and the local refs - is read once and cached,
+    so repeated branch checks, config lookups and no-op checkouts don't
+    spawn anything.
+    """
+
+    def __init__(self, repo_path: str):
+        self.repo_path = repo_path
+        self.calls: List[GitCall] = []
+        self._config: Optional[Dict[str, str]] = None
+        self._refs: Optional[Dict[str, str]] = None
+        self._current_branch: Optional[str] = None
+        self._pulled: set = set()
+        self._fetched = False
+        self._sparse_paths: Optional[List[str]] = None
+        self.remote_index = RemoteRefIndex(os.path.join(repo_path, ".git", REF_INDEX_FILE))
+
+    @property
+    def spawn_count(self) -> int:
+        """Number of git processes started in this session."""
+        return len(self.calls)
+
+    @property
+    def total_seconds(self) -> float:
+        """Total wall time spent waiting on git in this session."""
+        return sum(call.seconds for call in self.calls)
+
+    def git(self, *args: str, cwd: Optional[str] = None,
+            input: Optional[str] = None) -> Tuple[bool, str]:
+        """Run a git command and return the output.
+
+        Args:
+            *args: Arguments passed to git
+            cwd: Directory to run git in (default: the repository)
+            input: Text sent to the command's stdin
+
+        Returns:
+            Tuple of (success: bool, output: str)
+        """
+        # The remote URL can carry a token, so it never reaches the log or trace
+        command = redact_credentials("git " + " ".join(args))
+        working_dir = cwd or self.repo_path
+        logger.debug("Running command: %s in %s", command, working_dir)
+        start = time.perf_counter()
+        # Spans are named after the subcommand, past any "-c name=value" options
+        subcommand = next((arg for i, arg in enumerate(args)
+                           if arg != "-c" and (i == 0 or args[i - 1] != "-c")), None)
+        with TraceSpan(f"git {subcommand}" if subcommand else "git", command=command) as span:
+            try:
+                result = subprocess.run(
+                    ["git", *args],
+                    text=True,
+                    input=input,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    cwd=working_dir
+                )
+                success = result.returncode == 0
+                span.set(exit_code=result.returncode)
+                # Failures like "nothing to commit" are reported on stdout
+                output = result.stdout if success else result.stdout + result.stderr
+            except OSError as e:
+                logger.exception(f"Unexpected error running command: {command}")
+                success, output = False, str(e)
+            span.ok = success
+        elapsed = time.perf_counter() - start
+        self.calls.append(GitCall(command, elapsed, success))
+
+        if success:
+            logger.debug("Command succeeded in %.3fs with output: %s", elapsed, output[:100])
+        else:
+            logger.error(f"Command failed: {command}")
+            logger.error(f"Error output: {redact_credentials(output)}")
+        return success, output
+
+    def invalidate(self):
+        """Forget cached refs so the next lookup re-reads them.
+
+        The current branch is kept: only checkout() moves HEAD to another
+        branch, and it updates the cache itself.
+        """
+        self._refs = None
+
+    def set_ref(self, refname: str, sha: str):
+        """Record a ref we just moved ourselves, so the cache stays valid."""
+        if self._refs is not None:
+            self._refs[refname] = sha
+
+    def reset(self):
+        """Forget everything cached, e.g. after the repository is re-cloned."""
+        self.invalidate()
+        self._current_branch = None
+        self._config = None
+        self._pulled.clear()
+        self._fetched = False
+        self._sparse_paths = None
+        self.remote_index = RemoteRefIndex(self.remote_index.path)
+
+    def _load_refs(self):
+        """Read all refs and the current branch with a single git call."""
+        success, output = self.git(
+            "for-each-ref", "--format=%(HEAD)%09%(objectname)%09%(refname)"
         )
-        logger.debug(f"Command succeeded with output: {result.stdout[:100]}")
-        return True, result.stdout
-    except subprocess.CalledProcessError as e:
-        logger.error(f"Command failed: {command}")
-        logger.error(f"Error output: {e.stderr}")
-        return False, e.stderr
-    except Exception as e:
-        logger.exception(f"Unexpected error running command: {command}")
-        return False, str(e)
+        self._refs = {}
+        self._current_branch = ""
+        if not success:
+            return
+        for line in output.splitlines():
+            head, sha, refname = line.split("\t", 2)
+            self._refs[refname] = sha
+            if head == "*" and refname.startswith("refs/heads/"):
+                self._current_branch = refname[len("refs/heads/"):]
+
+    def refs(self) -> Dict[str, str]:
+        """Return a mapping of ref name to commit id, cached per session."""
+        if self._refs is None:
+            self._load_refs()
+        return self._refs
+
+    def current_branch(self) -> str:
+        """Return the checked out branch, or "" when HEAD is detached."""
+        if self._current_branch is None:
+            self._load_refs()
+        return self._current_branch
+
+    def has_local_branch(self, branch_name: str) -> bool:
+        """Check the cached refs for a local branch."""
+        return f"refs/heads/{branch_name}" in self.refs()
+
+    def index_remote_refs(self):
+        """Fill the remote ref index from the remote-tracking refs."""
+        prefix = "refs/remotes/origin/"
+        branches = {
+            refname[len(prefix):]: sha
+            for refname, sha in self.refs().items()
+            if refname.startswith(prefix) and refname != prefix + "HEAD"
+        }
+        self.remote_index.update(branches)
+        self._fetched = True
+
+    def list_remote_branches(self) -> Tuple[Optional[Dict[str, str]], str]:
+        """Ask origin for its branch tips, without fetching any objects.
+
+        With protocol v2 the server only advertises refs/heads/.
+
+        Returns:
+            Tuple of (branch name -> commit id, or None on failure; output)
+        """
+        success, output = self.git("-c", "protocol.version=2", "ls-remote", "--heads", "origin")
+        if not success:
+            return None, output
+        branches = {}
+        for line in output.splitlines():
+            sha, _, refname = line.partition("\t")
+            if refname.startswith("refs/heads/"):
+                branches[refname[len("refs/heads/"):]] = sha
+        return branches, output
+
+    def fetch_branches(self, branches: List[str]) -> bool:
+        """Fetch some of origin's branches, skipping any already up to date.
+
+        A branch whose remote-tracking ref already matches the remote ref
+        index isn't asked for. The rest are fetched with one refspec each,
+        so protocol v2 only advertises and sends those branches.
+
+        Args:
+            branches: Branch names (ones the remote doesn't have are skipped)
+
+        Returns:
+            True unless the fetch failed
+        """
+        refs = self.refs()
+        wanted = [branch for branch in branches if self.remote_index.has_branch(branch)
+                  and refs.get(f"refs/remotes/origin/{branch}") != self.remote_index.branches[branch]]
+        if not wanted:
+            return True
+        args = ["-c", "protocol.version=2", "fetch", "--no-tags"]
+        if FETCH_DEPTH:
+            args += ["--depth", str(FETCH_DEPTH)]
+        args.append("origin")
+        args += [f"+refs/heads/{branch}:refs/remotes/origin/{branch}" for branch in wanted]
+        success, output = self.git(*args)
+        self.invalidate()
+        if not success:
+            logger.warning(f"Could not fetch {', '.join(wanted)}: {output}")
+        return success
+
+    def fetch(self) -> bool:
+        """Fetch from origin at most once per session.
+
+        With NARROW_FETCH, only the remote's branch list is downloaded, plus
+        main; a student's branch is fetched when has_remote_branch() or
+        pull() asks for it. Otherwise every branch is fetched.
+
+        A fetch made by an earlier run less than REF_INDEX_TTL seconds ago
+        is reused from disk without contacting the remote.
+
+        Returns:
+            True if the remote ref index is usable
+        """
+        if self._fetched:
+            return True
+        if self.remote_index.load():
+            logger.debug("Remote ref index is fresh, skipping fetch")
+            self._fetched = True
+            return True
+
+        if NARROW_FETCH:
+            branches, output = self.list_remote_branches()
+            if branches is None:
+                logger.warning(f"Could not list remote branches, using last known ones: {output}")
+                return False
+            self.remote_index.update(branches)
+            self._fetched = True
+            self.fetch_branches([MAIN_BRANCH])
+            return True
+
+        success, output = self.git("fetch", "--prune", "origin")
+        self.invalidate()
+        if not success:
+            # Offline: answer from whatever we last knew about the remote
+            logger.warning(f"Fetch failed, using last known remote branches: {output}")
+            return False
+        self.index_remote_refs()
+        return True
+
+    def has_remote_branch(self, branch_name: str) -> bool:
+        """Check the remote ref index for a branch, fetching once if needed.
+
+        Whatever asks is about to use origin/<branch>, so with NARROW_FETCH
+        a branch the remote has is fetched here if it isn't up to date.
+        """
+        self.fetch()
+        if not self.remote_index.has_branch(branch_name):
+            return False
+        if NARROW_FETCH:
+            self.fetch_branches([branch_name])
+        return True
+
+    def record_push(self, branch_name: str, sha: Optional[str] = None):
+        """Update the remote ref index after pushing a branch.
+
+        Args:
+            branch_name: The branch that was pushed
+            sha: The commit pushed, if the caller has read it already; the
+                upload worker reads it with its own session, so it doesn't
+                touch this session's ref cache from another thread
+        """
+        if sha is None:
+            sha = self.refs().get(f"refs/heads/{branch_name}")
+        if sha:
+            self.remote_index.set_branch(branch_name, sha)
+
+    def config_get(self, key: str) -> str:
+        """Look up a config value, reading the whole config only once."""
+        if self._config is None:
+            success, output = self.git("config", "--list")
+            self._config = {}
+            if success:
+                for line in output.splitlines():
+                    name, _, value = line.partition("=")
+                    # Later entries (local over global) win, as in git itself
+                    self._config[name.lower()] = value
+        return self._config.get(key.lower(), "")
+
+    def config_set_global(self, key: str, value: str) -> bool:
+        """Set a global config value and update the cache."""
+        success, _ = self.git("config", "--global", key, value)
+        if success and self._config is not None:
+            self._config[key.lower()] = value
+        return success
+
+    def sparse_paths(self) -> Optional[List[str]]:
+        """Return the folders checked out by sparse checkout.
+
+        Returns:
+            List of folders, or None if the working copy isn't sparse
+        """
+        if self.config_get("core.sparsecheckout") != "true":
+            return None
+        if self._sparse_paths is None:
+            success, output = self.git("sparse-checkout", "list")
+            self._sparse_paths = output.split() if success else []
+        return self._sparse_paths
+
+    def set_sparse_paths(self, paths: List[str]) -> Tuple[bool, str]:
+        """Limit the working copy to the given folders (plus top-level files).
+
+        Skipped if those are already the folders checked out.
+        """
+        if self.sparse_paths() == paths:
+            logger.debug("Sparse checkout already set to %s", paths)
+            return True, ""
+        success, output = self.git("sparse-checkout", "set", "--cone", *paths)
+        if success:
+            self._sparse_paths = list(paths)
+            if self._config is not None:
+                self._config["core.sparsecheckout"] = "true"
+        return success, output
+
+    def checkout(self, branch_name: str, create: bool = False,
+                 start_point: Optional[str] = None) -> Tuple[bool, str]:
+        """Check out a branch, skipping the call if it is already current.
+
+        Args:
+            branch_name: Branch to check out
+            create: Create the branch (from start_point or HEAD)
+            start_point: Where a newly created branch should start
+
+        Returns:
+            Tuple of (success: bool, output: str)
+        """
+        if not create and self.current_branch() == branch_name:
+            logger.debug("Already on %s, skipping checkout", branch_name)
+            return True, ""
+
+        args = ["checkout"]
+        if create:
+            args.append("-b")
+        args.append(branch_name)
+        if start_point:
+            args.append(start_point)
+
+        success, output = self.git(*args)
+        if success:
+            if create:
+                # The new branch points wherever HEAD or the start point did
+                self._refs = None
+            self._current_branch = branch_name
+        return success, output
+
+    def pull(self, branch_name: Optional[str] = None,
+             cwd: Optional[str] = None) -> Tuple[bool, str]:
+        """Bring the current branch up to date with origin once per session.
+
+        Uses the session's single fetch and fast-forwards from the
+        remote-tracking branch, so no extra round trip is made. A second
+        pull of the same branch moments later can't bring anything new in a
+        classroom session, so it is skipped.
+
+        Args:
+            branch_name: Remote branch to merge (default: the current branch)
+            cwd: Worktree to update (default: the repository)
+
+        Returns:
+            Tuple of (success: bool, output: str)
+        """
+        key = branch_name or self.current_branch()
+        if key in self._pulled:
+            logger.debug("%s already pulled this session, skipping pull", key)
+            return True, ""
+
+        if not self.fetch() and not self.remote_index.has_branch(key):
+            return False, "Could not reach the remote"
+        if not self.remote_index.has_branch(key):
+            # Nothing to pull for a branch the remote doesn't have
+            self._pulled.add(key)
+            return True, ""
+        if NARROW_FETCH:
+            self.fetch_branches([key])
+
+        success, output = self.git("merge", "--ff-only", f"origin/{key}", cwd=cwd)
+        if success:
+            self._pulled.add(key)
+            self.invalidate()
+        return success, output
+
+    def mark_pulled(self, branch_name: str):
+        """Record that a branch is already up to date for this session."""
+        self._pulled.add(branch_name)
+
+    def log_summary(self):
+        """Log how many git processes ran and how long they took."""
+        logger.info(
+            f"Git session: {self.spawn_count} process(es), "
+            f"{self.total_seconds:.2f}s total"
+        )
+        for call in self.calls:
+            logger.debug("  %8.1f ms  %s  %s", call.seconds * 1000,
+                         'ok  ' if call.success else 'FAIL', call.command)
+
+
+_git_session: Optional[GitSession] = None
+
+def get_git_session() -> GitSession:
+    """Get the git session shared by every function in this run.
+
+    Returns:
+        The GitSession for the repository under WORK_DIR
+    """
+    global _git_session
+    repo_path = os.path.join(WORK_DIR, REPO_NAME)
+    if _git_session is None or _git_session.repo_path != repo_path:
+        _git_session = GitSession(repo_path)
+    return _git_session
 
 def configure_git_identity(repo_path: str) -> bool:
     """Configure Git identity if not already set.
@@ -109,75 +1070,1160 @@ def configure_git_identity(repo_path: str) -> bool:
     Returns:
         True if configuration was successful or already set
     """
-    logger.debug(f"Configuring Git identity for {repo_path}")
+    logger.debug("Configuring Git identity for %s", repo_path)
     try:
-        _, has_name = run_command("git config --get user.name", working_dir=repo_path)
-        _, has_email = run_command("git config --get user.email", working_dir=repo_path)
+        session = get_git_session()
+        has_name = session.config_get("user.name")
+        has_email = session.config_get("user.email")
 
         # If not set, use defaults
         if not has_name.strip():
             logger.info(f"Setting default Git name: {DEFAULT_GIT_NAME}")
-            run_command(f"git config --global user.name \"{DEFAULT_GIT_NAME}\"", working_dir=repo_path)
+            session.config_set_global("user.name", DEFAULT_GIT_NAME)
         if not has_email.strip():
             logger.info(f"Setting default Git email: {DEFAULT_GIT_EMAIL}")
-            run_command(f"git config --global user.email \"{DEFAULT_GIT_EMAIL}\"", working_dir=repo_path)
+            session.config_set_global("user.email", DEFAULT_GIT_EMAIL)
 
         return True
     except Exception as e:
         logger.exception("Failed to configure Git identity")
         return False
 
-def clone_repository(target_dir: str) -> bool:
+def get_remote_url() -> str:
+    """URL laptops clone, fetch and push: the classroom mirror if there is one."""
+    return FLEET_MIRROR_URL or REPO_URL
+
+def clone_repository(target_dir: str, quiet: bool = False) -> bool:
     """Clone the repository to the target directory.
 
     Args:
         target_dir: Directory where repository should be cloned
+        quiet: Only log, print nothing (for a clone in the background)
 
     Returns:
         True if clone was successful
     """
     logger.info(f"Cloning repository to {target_dir}")
-    print("Setting up code storage... please wait...")
-    success, output = run_command(f"git clone {REPO_URL}", working_dir=target_dir)
+    if not quiet:
+        print("Setting up code storage... please wait...")
+    os.makedirs(target_dir, exist_ok=True)
+    session = get_git_session()
+    args = ["-c", "protocol.version=2", "clone"]
+    if SPARSE_CLONE:
+        # Only download commits and trees now; file contents are fetched
+        # when needed, and only for the folders that are checked out
+        args += ["--filter=blob:none", "--sparse"]
+    if NARROW_FETCH:
+        # Students' branches are fetched one at a time, as they log in
+        args += ["--single-branch", "--branch", MAIN_BRANCH]
+    if FETCH_DEPTH:
+        args += ["--depth", str(FETCH_DEPTH)]
+    success, output = session.git(*args, get_remote_url(), REPO_NAME, cwd=target_dir)
+    session.reset()
+    if success:
+        if NARROW_FETCH:
+            # Map every branch again, so pushes update origin/<branch> and
+            # branches' upstreams resolve; fetches still name their branches
+            session.git("config", "remote.origin.fetch", "+refs/heads/*:refs/remotes/origin/*")
+            session.fetch()
+        else:
+            # A fresh clone is as up to date as a fetch and pull would make it
+            session.index_remote_refs()
+        session.mark_pulled(MAIN_BRANCH)
     if not success:
         logger.error(f"Failed to clone repository: {output}")
-        print("Could not connect to code storage.")
+        if not quiet:
+            print("Could not connect to code storage.")
         return False
     logger.info("Repository cloned successfully")
     return True
 
-def setup_repository() -> bool:
-    """Setup or update the repository.
+def update_main_branch() -> Tuple[bool, str]:
+    """Check out main and bring it up to date with origin.
 
-    This function handles both initial clone and updates of existing repository.
+    Returns:
+        Tuple of (success: bool, output: str)
+    """
+    session = get_git_session()
+    success, output = session.checkout(MAIN_BRANCH)
+    if success:
+        success, output = session.pull()
+    return success, output
+
+def find_unsent_branches() -> List[str]:
+    """Find local branches with commits that were never pushed.
 
     Returns:
-        True if repository is ready to use
+        Names of branches that have no upstream or are ahead of it
     """
-    repo_path = os.path.join(WORK_DIR, REPO_NAME)
-    logger.debug(f"Setting up repository at {repo_path}")
+    success, output = get_git_session().git(
+        "for-each-ref", "refs/heads",
+        "--format=%(refname:short)%09%(upstream)%09%(upstream:track)"
+    )
+    if not success:
+        return []
+    unsent = []
+    for line in output.splitlines():
+        branch, upstream, track = line.split("\t")
+        if (not upstream and branch != MAIN_BRANCH) or "ahead" in track or "gone" in track:
+            unsent.append(branch)
+    return unsent
+
+def reset_main_to_origin() -> bool:
+    """Force main to match origin/main, keeping any local-only main commits.
 
-    # Check if repo directory exists
-    if os.path.exists(repo_path):
-        logger.debug("Repository exists, attempting to update")
-        # Try to pull main branch
-        success, output = run_command(f"git checkout {MAIN_BRANCH} && git pull", working_dir=repo_path)
+    Commits on main that origin doesn't have are kept on a rescue/ branch
+    rather than thrown away.
+
+    Returns:
+        True if main is now checked out and matches origin
+    """
+    session = get_git_session()
+    if session.has_local_branch(MAIN_BRANCH):
+        success, _ = session.git("merge-base", "--is-ancestor", MAIN_BRANCH, f"origin/{MAIN_BRANCH}")
         if not success:
-            logger.warning(f"Pull failed, re-cloning repository. Error: {output}")
-            print("Updating code storage... please wait...")
-            # If pull fails, delete and re-clone
+            rescue = f"rescue/{MAIN_BRANCH}-{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            session.git("branch", "-f", rescue, MAIN_BRANCH)
+            logger.warning(f"Kept unsent commits from {MAIN_BRANCH} on {rescue}")
+
+    success, output = session.git("checkout", "-f", "-B", MAIN_BRANCH, f"origin/{MAIN_BRANCH}")
+    session.reset()
+    if not success:
+        logger.error(f"Could not reset {MAIN_BRANCH}: {output}")
+        return False
+    session.mark_pulled(MAIN_BRANCH)
+    return True
+
+def _repair_reset() -> bool:
+    """Repair step 1: clear locks and half-finished operations, stash changes."""
+    session = get_git_session()
+    git_dir = os.path.join(session.repo_path, ".git")
+
+    # A crashed git leaves its lock behind and blocks every later command
+    lock_path = os.path.join(git_dir, "index.lock")
+    if os.path.exists(lock_path):
+        os.remove(lock_path)
+        logger.info("Removed stale index.lock")
+
+    for marker, command in (("MERGE_HEAD", "merge"), ("rebase-merge", "rebase"),
+                            ("rebase-apply", "rebase"), ("CHERRY_PICK_HEAD", "cherry-pick")):
+        if os.path.exists(os.path.join(git_dir, marker)):
+            session.git(command, "--abort")
+
+    # Keep uncommitted changes in the stash rather than discarding them
+    session.git("stash", "push", "--include-untracked", "-m", "Tramore Code Club auto-repair")
+    session.reset()
+
+    if update_main_branch()[0]:
+        return True
+    return reset_main_to_origin()
+
+def _repair_refetch() -> bool:
+    """Repair step 2: fetch again from the remote and reset main to it."""
+    session = get_git_session()
+    success, output = session.git("fetch", "--prune", "origin")
+    if not success:
+        logger.error(f"Re-fetch failed: {output}")
+        return False
+    session.invalidate()
+    session.index_remote_refs()
+    return reset_main_to_origin()
+
+def _repair_objects() -> bool:
+    """Repair step 3: check the object store, re-download it if damaged, compact it."""
+    session = get_git_session()
+    success, output = session.git("fsck", "--connectivity-only")
+    if not success:
+        logger.warning(f"Repository check found problems: {output}")
+        # Download every object again, as a fresh clone would, but in place
+        success, output = session.git("fetch", "--refetch", "origin")
+        if not success:
+            logger.error(f"Refetch failed: {output}")
+            return False
+    session.git("gc", "--quiet")
+    session.invalidate()
+    return reset_main_to_origin()
+
+def _repair_reclone(quiet: bool = False) -> bool:
+    """Repair step 4: clone again, bringing unsent student commits across."""
+    session = get_git_session()
+    repo_path = session.repo_path
+    unsent = find_unsent_branches()
+
+    # Move the old copy aside instead of deleting it, so nothing is lost if
+    # the clone fails or its commits can't be copied over
+    stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    old_path = f"{repo_path}.old-{stamp}"
+    os.rename(repo_path, old_path)
+    if not clone_repository(WORK_DIR, quiet):
+        shutil.rmtree(repo_path, ignore_errors=True)
+        os.rename(old_path, repo_path)
+        session.reset()
+        return False
+
+    kept_all = True
+    for branch in unsent:
+        target = branch
+        if branch == MAIN_BRANCH:
+            target = f"rescue/{MAIN_BRANCH}-{stamp}"
+        success, output = session.git("fetch", old_path, f"+refs/heads/{branch}:refs/heads/{target}")
+        if success:
+            logger.info(f"Kept unsent commits on {target}")
+        else:
+            kept_all = False
+            logger.error(f"Could not copy unsent branch {branch}: {output}")
+    session.invalidate()
+
+    if kept_all:
+        shutil.rmtree(old_path, ignore_errors=True)
+    else:
+        logger.error(f"Old repository kept at {old_path} so no work is lost")
+    return True
+
+@traced()
+def repair_repository(quiet: bool = False) -> bool:
+    """Fix a working copy that can't be updated, as cheaply as possible.
+
+    Tries progressively more expensive steps and stops at the first one
+    that leaves main checked out and up to date: resetting the working copy,
+    fetching again, checking and re-downloading objects, and only then
+    cloning again. Every step is timed and logged, and commits that were
+    never pushed are kept.
+
+    Args:
+        quiet: Only log, print nothing (for a repair in the background)
+
+    Returns:
+        True if the repository is ready to use
+    """
+    steps = [
+        ("reset working copy", _repair_reset),
+        ("re-fetch", _repair_refetch),
+        ("check objects", _repair_objects),
+        ("re-clone", functools.partial(_repair_reclone, quiet)),
+    ]
+    # The re-clone moves the clone aside: uploads and maintenance wait
+    _repo_activity.pause()
+    try:
+        for name, step in steps:
+            start = time.perf_counter()
             try:
-                shutil.rmtree(repo_path, ignore_errors=True)
-                logger.info("Removed old repository directory")
+                fixed = step()
             except Exception as e:
-                logger.exception(f"Failed to remove old repository: {e}")
+                logger.exception(f"Repair step '{name}' failed: {e}")
+                fixed = False
+            elapsed = time.perf_counter() - start
+            if fixed:
+                logger.info(f"Repair step '{name}' fixed the repository in {elapsed:.2f}s")
+                return True
+            logger.warning(f"Repair step '{name}' did not fix the repository ({elapsed:.2f}s)")
+    finally:
+        _repo_activity.resume()
+
+    logger.error("Could not repair the repository")
+    return False
+
+# Git commands timed before and after maintenance: the reads that login,
+# status checks and fetch negotiation repeat all term
+MAINTENANCE_PROBES = {
+    "for-each-ref": ("for-each-ref", "--format=%(objectname) %(refname)"),
+    "status": ("status", "--porcelain"),
+    "rev-list": ("rev-list", "--count", "--all"),
+}
+
+# In the order they run: branches are deleted before the refs are packed,
+# and both before the commit-graph is written from the refs
+MAINTENANCE_TASKS = ("prune-branches", "pack-refs", "commit-graph", "repack")
+
+def _mtime(path: str) -> float:
+    """A file's modification time, or 0.0 if it doesn't exist."""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return 0.0
+
+def mark_session_started():
+    """Tell a --maintenance run left going by the last session to stop after its task."""
+    path = os.path.join(get_state_dir(), SESSION_STAMP_FILE)
+    try:
+        with open(path, "a", encoding="utf-8"):
+            pass
+        os.utime(path, None)
+    except OSError as e:
+        logger.warning(f"Could not mark the session as started: {e}")
+
+def _maintenance_lock_owner() -> Optional[str]:
+    """The pid in the maintenance lock file, or None if there is no lock.
+
+    A lock nobody has touched for MAINTENANCE_LOCK_STALE seconds was left by
+    a run that was killed, and is removed.
+    """
+    path = os.path.join(WORK_DIR, STATE_SUBDIR, MAINTENANCE_LOCK_FILE)
+    try:
+        age = time.time() - os.stat(path).st_mtime
+        with open(path, "r", encoding="utf-8") as f:
+            owner = f.read()
+    except OSError:
+        return None
+    if age > MAINTENANCE_LOCK_STALE:
+        logger.warning(f"Removing a maintenance lock left {age:.0f}s ago")
+        with contextlib.suppress(OSError):
+            os.remove(path)
+        return None
+    return owner
+
+def wait_for_detached_maintenance():
+    """Wait while a --maintenance run in another process is in the middle of a task.
 
-            if not clone_repository(WORK_DIR):
+    The run checks for a new session between tasks (see
+    mark_session_started()), so this is at most one task's wait.
+    """
+    waited = False
+    while True:
+        owner = _maintenance_lock_owner()
+        if owner is None or owner == str(os.getpid()):
+            # No run, or the run's own tasks
+            return
+        if not waited:
+            logger.info("Waiting for the maintenance run from the last session")
+            waited = True
+        time.sleep(0.1)
+
+@contextlib.contextmanager
+def detached_maintenance_lock():
+    """Hold the maintenance lock file for a --maintenance run.
+
+    Yields:
+        A function to call before each task: it refreshes the lock and
+        returns False once another session has started, or None if another
+        run holds the lock
+    """
+    path = os.path.join(get_state_dir(), MAINTENANCE_LOCK_FILE)
+    started = time.time()
+    _maintenance_lock_owner()  # Clears a stale lock
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError:
+        yield None
+        return
+    os.write(fd, str(os.getpid()).encode())
+    os.close(fd)
+
+    def keep_going() -> bool:
+        # The lock is refreshed before the stamp is read, and a session
+        # touches the stamp before reading the lock, so one always sees the other
+        os.utime(path, None)
+        try:
+            return os.stat(os.path.join(get_state_dir(), SESSION_STAMP_FILE)).st_mtime < started
+        except OSError:
+            return True
+    try:
+        yield keep_going
+    finally:
+        with contextlib.suppress(OSError):
+            os.remove(path)
+
+
+class RepoActivity:
+    """Keeps maintenance and the saves and uploads that write to the clone apart.
+
+    Any number of saves and uploads can be in flight together. A
+    maintenance task or a repair only starts once none is (and no other
+    task or repair is running), and a save or upload that starts meanwhile
+    waits for it to finish. Both also wait for a
+    task of a --maintenance run in another process (see
+    wait_for_detached_maintenance()).
+    """
+
+    def __init__(self):
+        self._changed = threading.Condition()
+        self._active = 0
+        self._maintaining = False
+
+    @contextlib.contextmanager
+    def using(self):
+        """Mark a save or upload as in flight (also works as a decorator)."""
+        wait_for_detached_maintenance()
+        with self._changed:
+            self._changed.wait_for(lambda: not self._maintaining)
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._changed:
+                self._active -= 1
+                self._changed.notify_all()
+
+    def pause(self, keep_going: Optional[Callable[[], bool]] = None) -> bool:
+        """Wait for the saves and uploads in flight, then hold new ones back.
+
+        Args:
+            keep_going: Checked while waiting; give up when it returns False
+
+        Returns:
+            True if maintenance may go ahead (call resume() after it)
+        """
+        wait_for_detached_maintenance()
+        with self._changed:
+            while self._active or self._maintaining:
+                if keep_going is not None and not keep_going():
+                    return False
+                self._changed.wait(0.1)
+            self._maintaining = True
+            return True
+
+    def resume(self):
+        """Let the saves and uploads held back by pause() go ahead."""
+        with self._changed:
+            self._maintaining = False
+            self._changed.notify_all()
+
+_repo_activity = RepoActivity()
+
+class GitMaintenance(threading.Thread):
+    """Background thread that tidies the clone up while nobody is using it.
+
+    Over a term the clone collects loose refs, loose objects, packs and the
+    branches of every student who ever logged in, and git commands slow
+    down. Whether each task is due is worked out from the files in `.git`,
+    without running git. Due tasks run in order while the student sits at
+    the menu, for at most MAINTENANCE_IDLE_BUDGET seconds per session, and
+    a task whose last run took longer than the time left is skipped. The
+    rest is left to a detached `--maintenance` run when the program exits.
+
+    Each task is one git command that takes git's own locks and never
+    deletes an object. A task only starts when no save or upload is in
+    flight, and one that starts meanwhile waits for it (see RepoActivity).
+    A task that has started is allowed to finish when the student picks a
+    menu option; no new one starts until they are back at the menu.
+    """
+
+    def __init__(self, repo_path: str, state_path: str):
+        super().__init__(name="GitMaintenance", daemon=True)
+        # Its own session, so the menu's cached state isn't touched mid-call
+        self.session = GitSession(repo_path)
+        self.git_dir = os.path.join(repo_path, ".git")
+        self.state_path = state_path
+        self.state: Dict = {}
+        self.protected: set = set()
+        self.budget_left = float(MAINTENANCE_IDLE_BUDGET)
+        self._idle = threading.Event()
+        self._idle_since = 0.0
+        self._stopping = threading.Event()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                self.state = json.load(f)
+        except (OSError, ValueError):
+            self.state = {}
+        self.state.setdefault("tasks", {})
+        self.state.setdefault("history", [])
+
+    def _save(self):
+        tmp_path = f"{self.state_path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.state, f)
+            os.replace(tmp_path, self.state_path)
+        except OSError as e:
+            logger.warning(f"Could not save maintenance state: {e}")
+
+    def _loose_refs(self) -> Tuple[int, float]:
+        """Number of refs kept as loose files, and when the newest changed."""
+        count, newest = 0, 0.0
+        for root, _, files in os.walk(os.path.join(self.git_dir, "refs")):
+            for name in files:
+                count += 1
+                newest = max(newest, _mtime(os.path.join(root, name)))
+        return count, newest
+
+    def _loose_objects(self) -> int:
+        objects = os.path.join(self.git_dir, "objects")
+        count = 0
+        try:
+            for entry in os.scandir(objects):
+                if len(entry.name) == 2 and entry.is_dir():
+                    count += len(os.listdir(entry.path))
+        except OSError:
+            pass
+        return count
+
+    def _packs(self, suffix: str = ".pack") -> int:
+        try:
+            return sum(name.endswith(suffix)
+                       for name in os.listdir(os.path.join(self.git_dir, "objects", "pack")))
+        except OSError:
+            return 0
+
+    def _stale_worktrees(self) -> bool:
+        """True if a worktree's folder was deleted but git still lists it."""
+        worktrees = os.path.join(self.git_dir, "worktrees")
+        try:
+            names = os.listdir(worktrees)
+        except OSError:
+            return False
+        for name in names:
+            try:
+                with open(os.path.join(worktrees, name, "gitdir"), "r", encoding="utf-8") as f:
+                    if not os.path.exists(f.read().strip()):
+                        return True
+            except OSError:
+                return True
+        return False
+
+    def due_tasks(self) -> List[str]:
+        """Tasks that would make a difference now, in the order they run."""
+        tasks = self.state["tasks"]
+        due = set()
+        last_prune = tasks.get("prune-branches", {}).get("last_run", 0)
+        if time.time() - last_prune >= MAINTENANCE_PRUNE_INTERVAL:
+            due.add("prune-branches")
+        loose_refs, refs_changed = self._loose_refs()
+        if loose_refs >= MAINTENANCE_LOOSE_REFS:
+            due.add("pack-refs")
+        # New commits arrive with a fetch or a ref update
+        refs_changed = max(refs_changed, _mtime(os.path.join(self.git_dir, "FETCH_HEAD")),
+                           _mtime(os.path.join(self.git_dir, "packed-refs")))
+        graph = max(_mtime(os.path.join(self.git_dir, "objects", "info", "commit-graph")),
+                    _mtime(os.path.join(self.git_dir, "objects", "info", "commit-graphs",
+                                        "commit-graph-chain")))
+        if not graph or refs_changed > max(graph, tasks.get("commit-graph", {}).get("last_run", 0)):
+            due.add("commit-graph")
+        if (self._loose_objects() >= MAINTENANCE_LOOSE_OBJECTS
+                or self._packs() >= MAINTENANCE_MAX_PACKS):
+            due.add("repack")
+        return [task for task in MAINTENANCE_TASKS if task in due]
+
+    def prune_branches(self) -> List[str]:
+        """Delete local student branches that nobody has committed to for MAINTENANCE_STALE_DAYS.
+
+        Only a branch that matches its copy on the remote is deleted, so
+        nothing is lost: it is made again from the remote at the student's
+        next login. Branches that are checked out, waiting to be uploaded or
+        in self.protected (the logged-in student's) are kept.
+
+        Returns:
+            The branches deleted
+        """
+        if self._stale_worktrees():
+            # Frees the branches of worktree folders that were deleted
+            self.session.git("worktree", "prune")
+        prefix = STUDENT_BRANCH_PREFIX.rstrip("/")
+        success, output = self.session.git(
+            "for-each-ref",
+            "--format=%(refname)%09%(objectname)%09%(committerdate:unix)%09%(worktreepath)",
+            f"refs/heads/{prefix}", f"refs/remotes/origin/{prefix}")
+        if not success:
+            return []
+        remote, local = {}, []
+        for line in output.splitlines():
+            refname, sha, date, worktree = line.split("\t", 3)
+            if refname.startswith("refs/remotes/origin/"):
+                remote[refname[len("refs/remotes/origin/"):]] = sha
+            else:
+                local.append((refname[len("refs/heads/"):], sha, int(date or 0), worktree))
+
+        queue = PushQueue(os.path.join(get_state_dir(), PUSH_QUEUE_FILE))
+        cutoff = time.time() - MAINTENANCE_STALE_DAYS * 24 * 3600
+        stale = [branch for branch, sha, date, worktree in local
+                 if date < cutoff and not worktree and remote.get(branch) == sha
+                 and branch not in self.protected and not queue.saves(branch)]
+        if not stale:
+            return []
+        # `branch -D` refuses to delete a branch checked out anywhere, and
+        # removes the branch's upstream settings along with it
+        success, output = self.session.git("branch", "-D", *stale)
+        if not success:
+            logger.warning(f"Could not delete stale branches: {output}")
+            return []
+        logger.info(f"Deleted {len(stale)} stale local branch(es)")
+        return stale
+
+    def _run_task(self, task: str) -> bool:
+        if task == "prune-branches":
+            self.prune_branches()
+            return True
+        if task == "pack-refs":
+            success, _ = self.session.git("pack-refs", "--all", "--prune")
+        elif task == "commit-graph":
+            success, _ = self.session.git("commit-graph", "write", "--reachable", "--split",
+                                          "--no-progress")
+        elif self._packs(".promisor"):
+            # Git (2.39 at least) can't roll packs up geometrically in a
+            # partial clone, but a blobless clone is small enough to repack
+            # whole. Unreachable objects are kept: a save may be writing them.
+            success, _ = self.session.git("repack", "-a", "-d", "-q", "--keep-unreachable")
+        else:
+            # Only merges the smaller packs, and loose objects, into bigger ones
+            success, _ = self.session.git("repack", "-d", "-q", "--geometric=2", "--write-midx")
+        return success
+
+    def probe(self) -> Dict[str, float]:
+        """Time each of MAINTENANCE_PROBES once, in milliseconds."""
+        timings = {}
+        for name, args in MAINTENANCE_PROBES.items():
+            success, _ = self.session.git(*args)
+            if success:
+                timings[name] = round(self.session.calls[-1].seconds * 1000, 1)
+        return timings
+
+    @traced("maintenance")
+    def run_tasks(self, budget: float, keep_going: Optional[Callable[[], bool]] = None) -> List[str]:
+        """Run the due tasks that fit in a time budget.
+
+        The probes are timed before the first task and after the last, and
+        both are kept in the history with what ran.
+
+        Args:
+            budget: Seconds available
+            keep_going: Checked before each task; stop when it returns False
+
+        Returns:
+            The tasks that ran
+        """
+        deadline = time.monotonic() + budget
+        due = self.due_tasks()
+        if not due:
+            return []
+        tasks = self.state["tasks"]
+        record = {"at": round(time.time(), 3), "due": due, "ran": {}, "before": self.probe()}
+        for task in due:
+            if keep_going is not None and not keep_going():
+                break
+            estimate = tasks.get(task, {}).get("seconds", 0.0)
+            if time.monotonic() + estimate > deadline:
+                logger.info(f"Maintenance: {task} took {estimate:.1f}s last time, leaving it for later")
+                continue
+            if not _repo_activity.pause(keep_going):
+                break
+            start = time.monotonic()
+            try:
+                with TraceSpan(f"maintenance {task}") as span:
+                    span.ok = self._run_task(task)
+            finally:
+                _repo_activity.resume()
+            seconds = round(time.monotonic() - start, 3)
+            tasks[task] = {"last_run": round(time.time(), 3), "seconds": seconds, "ok": span.ok}
+            record["ran"][task] = seconds
+        if record["ran"]:
+            record["after"] = self.probe()
+            self.state["history"] = (self.state["history"] + [record])[-MAINTENANCE_HISTORY:]
+            changes = ", ".join(f"{name} {before:.1f} -> {record['after'][name]:.1f} ms"
+                                for name, before in record["before"].items() if name in record["after"])
+            logger.info(f"Maintenance ran {', '.join(record['ran'])} in "
+                        f"{sum(record['ran'].values()):.2f}s; {changes}")
+        self._save()
+        return list(record["ran"])
+
+    def idle(self):
+        """The student is at the menu: maintenance may start after MAINTENANCE_IDLE_DELAY."""
+        self._idle_since = time.monotonic()
+        self._idle.set()
+
+    def busy(self):
+        """The student picked something: start no new task until they are back."""
+        self._idle.clear()
+
+    def is_idle(self) -> bool:
+        return self._idle.is_set() and not self._stopping.is_set()
+
+    def stop(self):
+        """Ask the thread to finish after its current task."""
+        self._stopping.set()
+        self._idle.set()
+
+    def run(self):
+        while not self._stopping.is_set() and self.budget_left > 0:
+            self._idle.wait()
+            wait = self._idle_since + MAINTENANCE_IDLE_DELAY - time.monotonic()
+            if wait > 0:
+                self._stopping.wait(wait)
+                continue
+            if not self.is_idle():
+                continue
+            start = time.monotonic()
+            try:
+                self.run_tasks(self.budget_left, self.is_idle)
+            except Exception as e:
+                logger.exception(f"Maintenance error: {e}")
+                return
+            self.budget_left -= time.monotonic() - start
+            if self.is_idle():
+                # Everything due has run, or didn't fit in the budget
+                return
+
+
+_maintenance: Optional[GitMaintenance] = None
+
+def get_maintenance() -> GitMaintenance:
+    """Get the idle-time maintenance thread, starting it if needed."""
+    global _maintenance
+    repo_path = os.path.join(WORK_DIR, REPO_NAME)
+    if _maintenance is None or _maintenance.session.repo_path != repo_path:
+        _maintenance = GitMaintenance(repo_path, os.path.join(get_state_dir(), MAINTENANCE_FILE))
+        _maintenance.start()
+    return _maintenance
+
+def finish_maintenance() -> bool:
+    """Stop idle-time maintenance and leave whatever is still due to a detached run.
+
+    The run is a separate process in its own session, so it carries on
+    after the program (and its terminal window) has closed. None is started
+    while uploads are still waiting.
+
+    Returns:
+        True if a detached run was started
+    """
+    if _maintenance is not None:
+        _maintenance.stop()
+        _maintenance.join(timeout=1)
+    repo_path = os.path.join(WORK_DIR, REPO_NAME)
+    if not MAINTENANCE_ENABLED or not os.path.isdir(os.path.join(repo_path, ".git")):
+        return False
+    if _push_worker and len(_push_worker.queue):
+        # The next session uploads them as it starts, while a detached run
+        # could be repacking
+        logger.info("Leaving maintenance until the waiting uploads are done")
+        return False
+    maintenance = _maintenance or GitMaintenance(
+        repo_path, os.path.join(get_state_dir(), MAINTENANCE_FILE))
+    if not maintenance.due_tasks():
+        return False
+    try:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), "--maintenance",
+                          "--budget", str(MAINTENANCE_EXIT_BUDGET)],
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL, start_new_session=True)
+    except OSError as e:
+        logger.warning(f"Could not start maintenance: {e}")
+        return False
+    logger.info("Started maintenance to run after exit")
+    return True
+
+def run_maintenance_command(budget: float) -> int:
+    """Run the due maintenance tasks within a time budget (--maintenance).
+
+    Returns:
+        Process exit code
+    """
+    repo_path = os.path.join(WORK_DIR, REPO_NAME)
+    if not os.path.isdir(os.path.join(repo_path, ".git")):
+        print("There is no repository on this laptop yet.")
+        return 1
+    maintenance = GitMaintenance(repo_path, os.path.join(get_state_dir(), MAINTENANCE_FILE))
+    # The next session may start meanwhile: it waits for the task in hand,
+    # and no more are started
+    with detached_maintenance_lock() as keep_going:
+        if keep_going is None:
+            print("Maintenance is already running.")
+            return 0
+        ran = maintenance.run_tasks(budget, keep_going)
+    if not ran:
+        print("Nothing to do.")
+        return 0
+    record = maintenance.state["history"][-1]
+    for task, seconds in record["ran"].items():
+        print(f"  {task:<16} {seconds * 1000:9.1f} ms")
+    for name, before in record["before"].items():
+        after = record["after"].get(name)
+        if after is not None:
+            print(f"  {name:<16} {before:9.1f} ms -> {after:.1f} ms")
+    return 0
+
+def _percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of values (0.0 for an empty list)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+class FleetCoordinator:
+    """Hands out a fixed number of start slots to the classroom's laptops.
+
+    Laptops ask for a slot before cloning or fetching and give it back
+    afterwards, so at most `slots` of them talk to the remote at once.
+    Waiting laptops are served first come, first served. A slot that
+    isn't given back within the lease (a laptop was closed mid-clone)
+    is reclaimed.
+    """
+
+    def __init__(self, slots: Optional[int] = None, lease: Optional[float] = None):
+        self.slots = slots or FLEET_SLOTS
+        self.lease = lease or FLEET_LEASE
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._next_ticket = 0
+        self._active: Dict[str, Tuple[str, float]] = {}
+        self.started = time.time()
+        self.granted = 0
+        self.completed = 0
+        self.failed = 0
+        self.expired = 0
+        self.timed_out = 0
+        self.max_active = 0
+        self.waits: List[float] = []
+        self.holds: List[float] = []
+        self._finished = collections.deque()
+
+    def _expire_leases(self):
+        now = time.time()
+        for token, (client, granted_at) in list(self._active.items()):
+            if now - granted_at > self.lease:
+                logger.warning(f"Reclaiming slot from {client} after {now - granted_at:.0f}s")
+                del self._active[token]
+                self.expired += 1
+                self._cond.notify_all()
+
+    def acquire(self, client: str, timeout: float) -> Optional[str]:
+        """Wait up to timeout seconds for a slot.
+
+        Returns:
+            A token to pass to release(), or None if no slot came free in time
+        """
+        start = time.time()
+        deadline = start + timeout
+        with self._cond:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            self._queue.append(ticket)
+            while True:
+                self._expire_leases()
+                if self._queue[0] == ticket and len(self._active) < self.slots:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._queue.remove(ticket)
+                    self.timed_out += 1
+                    self._cond.notify_all()
+                    return None
+                self._cond.wait(min(remaining, self.lease))
+            self._queue.popleft()
+            token = f"{client}#{ticket}"
+            self._active[token] = (client, time.time())
+            self.granted += 1
+            self.max_active = max(self.max_active, len(self._active))
+            self.waits.append(time.time() - start)
+            # The next laptop in line may fit in a free slot too
+            self._cond.notify_all()
+        logger.debug("Slot granted to %s after %.2fs", client, time.time() - start)
+        return token
+
+    def release(self, token: str, ok: bool = True) -> bool:
+        """Give a slot back.
+
+        Returns:
+            False if the token wasn't holding a slot (e.g. it had expired)
+        """
+        with self._cond:
+            held = self._active.pop(token, None)
+            if held is None:
                 return False
-    else:
-        logger.debug("Repository doesn't exist, cloning")
-        if not clone_repository(WORK_DIR):
+            now = time.time()
+            self.holds.append(now - held[1])
+            self._finished.append(now)
+            if ok:
+                self.completed += 1
+            else:
+                self.failed += 1
+            self._cond.notify_all()
+        return True
+
+    def stats(self) -> Dict[str, float]:
+        """Counters, queue wait and throughput for the mentor."""
+        with self._cond:
+            now = time.time()
+            while self._finished and now - self._finished[0] > FLEET_STATS_WINDOW:
+                self._finished.popleft()
+            window = min(FLEET_STATS_WINDOW, max(now - self.started, 1e-6))
+            return {
+                "slots": self.slots,
+                "active": len(self._active),
+                "waiting": len(self._queue),
+                "granted": self.granted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "expired": self.expired,
+                "timed_out": self.timed_out,
+                "max_active": self.max_active,
+                "throughput_per_min": len(self._finished) * 60 / window,
+                "wait_avg": sum(self.waits) / len(self.waits) if self.waits else 0.0,
+                "wait_p95": _percentile(self.waits, 95),
+                "wait_max": max(self.waits, default=0.0),
+                "hold_avg": sum(self.holds) / len(self.holds) if self.holds else 0.0,
+                "uptime": now - self.started,
+            }
+
+
+class FleetMirror:
+    """A bare copy of the club's repository on the mentor's laptop.
+
+    Laptops clone, fetch and push against the mirror over the classroom
+    network; the coordinator brings GitHub's changes in and sends the
+    students' branches up in one bulk push.
+    """
+
+    def __init__(self, path: str, upstream_url: str):
+        self.path = path
+        self.upstream_url = upstream_url
+        self.session = GitSession(path)
+        self._lock = threading.Lock()
+        self.last_sync: Dict[str, object] = {}
+
+    def ensure(self) -> bool:
+        """Create the mirror from upstream if it doesn't exist yet."""
+        if os.path.exists(self.path):
+            return True
+        logger.info(f"Creating classroom mirror at {self.path}")
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        success, output = self.session.git("clone", "--bare", self.upstream_url, self.path,
+                                           cwd=os.path.dirname(self.path) or ".")
+        if not success:
+            logger.error(f"Could not create mirror: {output}")
             return False
+        # Laptops make blobless clones of the mirror
+        self.session.git("config", "uploadpack.allowFilter", "true")
+        self.session.git("config", "receive.denyDeletes", "true")
+        return True
+
+    def push_upstream(self) -> Dict[str, bool]:
+        """Send every student branch to upstream in a single git push."""
+        success, output = self.session.git(
+            "push", "--porcelain", "origin",
+            f"refs/heads/{STUDENT_BRANCH_PREFIX}*:refs/heads/{STUDENT_BRANCH_PREFIX}*")
+        results = parse_push_results(output)
+        if not success and not results:
+            logger.warning(f"Mirror push failed: {output}")
+        return results
+
+    def fetch_upstream(self) -> bool:
+        """Bring upstream's branches into the mirror.
+
+        Not forced: a branch a laptop pushed that upstream hasn't seen
+        yet is left alone rather than rewound.
+        """
+        success, output = self.session.git("fetch", "origin", "refs/heads/*:refs/heads/*")
+        if not success:
+            logger.warning(f"Mirror fetch was incomplete: {output}")
+        return success
+
+    def sync(self) -> Dict[str, object]:
+        """Push students' work up, then fetch upstream's changes down."""
+        with self._lock:
+            start = time.perf_counter()
+            pushed = self.push_upstream()
+            fetched = self.fetch_upstream()
+            self.last_sync = {
+                "at": time.time(),
+                "seconds": time.perf_counter() - start,
+                "pushed": sorted(b for b, ok in pushed.items() if ok),
+                "rejected": sorted(b for b, ok in pushed.items() if not ok),
+                "fetched": fetched,
+            }
+            logger.info(f"Mirror sync: {len(self.last_sync['pushed'])} branch(es) pushed, "
+                        f"{len(self.last_sync['rejected'])} rejected, "
+                        f"in {self.last_sync['seconds']:.2f}s")
+            return self.last_sync
+
+
+class _FleetRequestHandlerMixin:
+    """JSON API for FleetCoordinator: /acquire, /release, /stats and /sync.
+
+    Mixed into http.server's request handler by make_fleet_server(), so
+    http.server is only imported on the coordinator.
+    """
+
+    def _reply(self, status: int, body: Dict):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self) -> Dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            return json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return {}
+
+    def do_GET(self):
+        if self.path == "/stats":
+            stats = self.server.coordinator.stats()
+            if self.server.mirror:
+                stats["mirror"] = self.server.mirror.last_sync
+            self._reply(200, stats)
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def do_POST(self):
+        body = self._read_body()
+        coordinator = self.server.coordinator
+        if self.path == "/acquire":
+            wait = min(float(body.get("wait", FLEET_POLL)), FLEET_POLL)
+            token = coordinator.acquire(str(body.get("client", self.client_address[0])), wait)
+            self._reply(200, {"token": token})
+        elif self.path == "/release":
+            self._reply(200, {"released": coordinator.release(str(body.get("token")),
+                                                              bool(body.get("ok", True)))})
+        elif self.path == "/sync" and self.server.mirror:
+            self._reply(200, self.server.mirror.sync())
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def log_message(self, format, *args):
+        logger.debug("Coordinator %s: " + format, self.client_address[0], *args)
+
+
+def make_fleet_server(coordinator: FleetCoordinator, host: str = "", port: Optional[int] = None,
+                      mirror: Optional[FleetMirror] = None):
+    """Create the coordinator's HTTP server (port 0 picks a free port)."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class FleetServer(ThreadingHTTPServer):
+        daemon_threads = True
+        # The whole room connects within the same second; the default backlog
+        # of 5 would refuse most of them
+        request_queue_size = 128
+
+    class FleetRequestHandler(_FleetRequestHandlerMixin, BaseHTTPRequestHandler):
+        pass
+
+    server = FleetServer((host, FLEET_PORT if port is None else port), FleetRequestHandler)
+    server.coordinator = coordinator
+    server.mirror = mirror
+    return server
+
+
+def _fleet_request(path: str, body: Optional[Dict] = None, timeout: float = 10) -> Dict:
+    """Call the coordinator at FLEET_URL and return its JSON reply."""
+    import urllib.request  # Slow to import, and only needed in fleet mode
+    data = None if body is None else json.dumps(body).encode("utf-8")
+    request = urllib.request.Request(f"{FLEET_URL.rstrip('/')}{path}", data=data,
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+@contextlib.contextmanager
+def fleet_slot(purpose: str):
+    """Hold a coordinator start slot around a clone or fetch.
+
+    Does nothing when FLEET_URL isn't set. If the coordinator can't be
+    reached, or no slot comes free within FLEET_WAIT_TIMEOUT, the laptop
+    goes ahead anyway: a slow start beats no start.
+    """
+    if not FLEET_URL:
+        yield
+        return
+    client = f"{socket.gethostname()}-{os.getpid()}"
+    token = None
+    start = time.time()
+    try:
+        while token is None and time.time() - start < FLEET_WAIT_TIMEOUT:
+            wait = min(FLEET_POLL, FLEET_WAIT_TIMEOUT - (time.time() - start))
+            token = _fleet_request("/acquire", {"client": client, "wait": wait},
+                                   timeout=wait + 10).get("token")
+        if token:
+            logger.info(f"Got a fleet slot for {purpose} after {time.time() - start:.1f}s")
+        else:
+            logger.warning(f"No fleet slot for {purpose} after {time.time() - start:.0f}s, going ahead")
+    except (OSError, ValueError) as e:
+        logger.warning(f"Fleet coordinator unavailable ({e}), going ahead without a slot")
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        if token:
+            try:
+                _fleet_request("/release", {"token": token, "ok": ok})
+            except (OSError, ValueError) as e:
+                logger.warning(f"Could not give fleet slot back: {e}")
+
+
+def run_fleet_coordinator(port: int, slots: int, mirror_path: Optional[str] = None) -> int:
+    """Run the classroom coordinator until Ctrl+C, for the mentor's laptop.
+
+    With a mirror, laptops should use it as FLEET_MIRROR_URL; serve it with
+    e.g. `git daemon --export-all --enable=receive-pack --base-path=<folder>`.
+
+    Returns:
+        Process exit code
+    """
+    mirror = None
+    if mirror_path:
+        mirror = FleetMirror(os.path.abspath(mirror_path), REPO_URL)
+        if not mirror.ensure():
+            print("Could not create the classroom mirror.")
+            return 1
+    coordinator = FleetCoordinator(slots)
+    server = make_fleet_server(coordinator, port=port, mirror=mirror)
+    threading.Thread(target=server.serve_forever, name="FleetServer", daemon=True).start()
+    print(f"Coordinator listening on port {server.server_address[1]} with {slots} slot(s)")
+    logger.info(f"Fleet coordinator started on port {server.server_address[1]}, {slots} slots")
+    try:
+        while True:
+            time.sleep(FLEET_SYNC_INTERVAL)
+            if mirror:
+                mirror.sync()
+            stats = coordinator.stats()
+            print(f"{stats['completed']} done, {stats['active']} active, "
+                  f"{stats['waiting']} waiting, {stats['throughput_per_min']:.1f}/min, "
+                  f"wait p95 {stats['wait_p95']:.1f}s")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        if mirror:
+            mirror.sync()
+        logger.info(f"Fleet coordinator stopped: {coordinator.stats()}")
+    return 0
+
+@traced()
+def setup_repository(quiet: bool = False) -> bool:
+    """Setup or update the repository.
+
+    This function handles both initial clone and updates of existing repository.
+
+    Args:
+        quiet: Only log, print nothing. The prefetch sets up the repository
+            while the student types their name, and mustn't print over it.
+
+    Returns:
+        True if repository is ready to use
+    """
+    repo_path = os.path.join(WORK_DIR, REPO_NAME)
+    logger.debug("Setting up repository at %s", repo_path)
+    # The last session's maintenance run may be repacking the clone
+    wait_for_detached_maintenance()
+
+    # In a classroom, wait our turn so the whole room doesn't clone at once
+    with fleet_slot("setup"):
+        # Check if repo directory exists
+        if os.path.exists(repo_path):
+            logger.debug("Repository exists, attempting to update")
+            session = get_git_session()
+            if session.config_get("remote.origin.url") != get_remote_url():
+                # Switched to or from the classroom mirror
+                session.git("remote", "set-url", "origin", get_remote_url())
+                session.reset()
+            # Try to pull main branch
+            success, output = update_main_branch()
+            if not success:
+                logger.warning(f"Pull failed, repairing repository. Error: {output}")
+                if not quiet:
+                    print("Updating code storage... please wait...")
+                if not repair_repository(quiet):
+                    return False
+        else:
+            logger.debug("Repository doesn't exist, cloning")
+            if not clone_repository(WORK_DIR, quiet):
+                return False
 
     # Configure Git identity
     if not configure_git_identity(repo_path):
@@ -196,10 +2242,9 @@ def branch_exists_remote(branch_name: str, repo_path: str) -> bool:
     Returns:
         True if branch exists on remote
     """
-    logger.debug(f"Checking if branch {branch_name} exists on remote")
-    success, output = run_command(f"git ls-remote --heads origin {branch_name}", working_dir=repo_path)
-    exists = success and bool(output.strip())
-    logger.debug(f"Branch {branch_name} {'exists' if exists else 'does not exist'} on remote")
+    logger.debug("Checking if branch %s exists on remote", branch_name)
+    exists = get_git_session().has_remote_branch(branch_name)
+    logger.debug("Branch %s %s on remote", branch_name, 'exists' if exists else 'does not exist')
     return exists
 
 def branch_exists_local(branch_name: str, repo_path: str) -> bool:
@@ -212,12 +2257,152 @@ def branch_exists_local(branch_name: str, repo_path: str) -> bool:
     Returns:
         True if branch exists locally
     """
-    logger.debug(f"Checking if branch {branch_name} exists locally")
-    success, output = run_command(f"git branch --list {branch_name}", working_dir=repo_path)
-    exists = success and bool(output.strip())
-    logger.debug(f"Branch {branch_name} {'exists' if exists else 'does not exist'} locally")
+    logger.debug("Checking if branch %s exists locally", branch_name)
+    exists = get_git_session().has_local_branch(branch_name)
+    logger.debug("Branch %s %s locally", branch_name, 'exists' if exists else 'does not exist')
     return exists
 
+def _name_key(student_name: str) -> str:
+    """The form of a name the registry files it under: case and spacing don't matter."""
+    return " ".join(unicodedata.normalize("NFKC", student_name).casefold().split())
+
+def _name_hash(key: str, length: int) -> str:
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:length]
+
+def make_safe_name(student_name: str) -> str:
+    """Turn a name into lowercase letters, digits and single hyphens.
+
+    Accents are dropped ("Seán" -> "sean") and anything else that isn't a
+    letter or digit becomes a hyphen, so the result is always a legal git
+    branch name and folder name on every laptop.
+
+    Args:
+        student_name: The student's name
+
+    Returns:
+        Safe name, before any collision suffix
+    """
+    decomposed = unicodedata.normalize("NFKD", student_name)
+    plain = "".join(c for c in decomposed if not unicodedata.combining(c)).lower()
+    safe = re.sub(r"[^a-z0-9]+", "-", plain.encode("ascii", "ignore").decode())
+    safe = safe[:SAFE_NAME_MAX_LENGTH].strip("-")
+    if not safe:
+        # Nothing left in ASCII (e.g. a name written in another script)
+        safe = f"student-{_name_hash(_name_key(student_name), 8)}"
+    return safe
+
+def _legacy_safe_name(student_name: str) -> str:
+    """The safe name older versions made, which existing work may still be under."""
+    return student_name.strip().lower().replace(' ', '-')
+
+
+class NameRegistry:
+    """Which safe name (and so folder and branch) each student name uses.
+
+    Names are compared by _name_key(), so "Aoife" and "aoife " are the same
+    student, and a name registered here keeps the safe name it was given.
+    A new name gets make_safe_name(), or the name older versions made if
+    that is where the student's work is (a folder on this laptop or a
+    branch on the remote). Only when a different name registered here
+    already has the safe name ("Mary Kate" and then "Mary-Kate") is a
+    suffix from a hash of the name added, so laptops that see the same
+    clash pick the same one.
+
+    The registry records how each student first typed their name, for
+    display. Lookups are memoised; only register() writes the file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.names: Dict[str, str] = {}  # name key -> safe name, for students registered here
+        self.display: Dict[str, str] = {}  # safe name -> name as first registered
+        self._memo: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.names = dict(data["names"])
+            self.display = dict(data["display"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    def save(self):
+        """Write the registry to disk."""
+        tmp_path = f"{self.path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"names": self.names, "display": self.display}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Could not save name registry {self.path}: {e}")
+
+    def _assign(self, student_name: str, key: str) -> Tuple[str, bool]:
+        """Work out the safe name for a name that isn't registered here.
+
+        Returns:
+            Tuple of (safe name, whether it is final); an answer that could
+            still change to an older version's name once the remote's
+            branches are known isn't final
+        """
+        safe = make_safe_name(student_name)
+        candidates = [safe]
+        # One with a "/" was never a folder
+        legacy = _legacy_safe_name(student_name)
+        if legacy != safe and "/" not in legacy and not legacy.startswith("."):
+            candidates.append(legacy)
+        taken = {name for other, name in self.names.items() if other != key}
+        app = get_app()
+        for name in candidates:
+            if name not in taken and app.has_work(name):
+                return name, True
+        if safe in taken:
+            safe = f"{safe[:SAFE_NAME_MAX_LENGTH - 5].rstrip('-')}-{_name_hash(key, 4)}"
+        return safe, len(candidates) == 1 or app.remote_refs_known
+
+    def lookup(self, student_name: str) -> str:
+        """Get the safe name for a student without registering them."""
+        key = _name_key(student_name)
+        safe = self.names.get(key) or self._memo.get(student_name)
+        if safe is None:
+            safe, final = self._assign(student_name, key)
+            if final:
+                self._memo[student_name] = safe
+            logger.debug("Converted '%s' to safe name '%s'", student_name, safe)
+        return safe
+
+    def register(self, student_name: str) -> str:
+        """Record a student's safe name for good (on login or when they're created)."""
+        with self._lock:
+            key = _name_key(student_name)
+            if key in self.names:
+                return self.names[key]
+            safe = self.lookup(student_name)
+            self.names[key] = safe
+            self.display.setdefault(safe, " ".join(student_name.split()))
+            # Another name's answer may have been the safe name just taken
+            self._memo.clear()
+            self.save()
+            return safe
+
+    def display_name(self, safe_name: str) -> str:
+        """The name a safe name was registered for, or the safe name itself."""
+        return self.display.get(safe_name, safe_name)
+
+
+_name_registry: Optional[NameRegistry] = None
+
+def get_name_registry() -> NameRegistry:
+    """Get the name registry for WORK_DIR, loading it once per run."""
+    global _name_registry
+    path = os.path.join(WORK_DIR, STATE_SUBDIR, NAME_REGISTRY_FILE)
+    if _name_registry is None or _name_registry.path != path:
+        _name_registry = NameRegistry(path)
+    return _name_registry
+
 def get_safe_name(student_name: str) -> str:
     """Get a safe folder/branch name from a student name.
 
@@ -231,10 +2416,61 @@ def get_safe_name(student_name: str) -> str:
         logger.warning("Empty student name provided")
         return "unknown"
 
-    safe = student_name.lower().replace(' ', '-')
-    logger.debug(f"Converted '{student_name}' to safe name '{safe}'")
-    return safe
+    return get_name_registry().lookup(student_name)
+
+def find_display_name(safe_name: str) -> str:
+    """Find a student's name from their safe name, e.g. for a suggested spelling.
+
+    Tries the name registered on this laptop, then the name in the latest
+    "Update from <name> on ..." commit on their branch, then the safe name's
+    words capitalised. Only a name that makes the same safe name again is
+    used, since the rest of the program works the safe name out from it.
+
+    Args:
+        safe_name: Safe name for the student
+
+    Returns:
+        A name for the student whose safe name is safe_name
+    """
+    candidates = [get_name_registry().display.get(safe_name)]
+    branch_name = f"{STUDENT_BRANCH_PREFIX}{safe_name}"
+    if os.path.isdir(os.path.join(WORK_DIR, REPO_NAME)):
+        session = get_git_session()
+        session.has_remote_branch(branch_name)
+        refs = session.refs()
+        ref = next((r for r in (f"refs/remotes/origin/{branch_name}", f"refs/heads/{branch_name}")
+                    if r in refs), None)
+        if ref:
+            success, output = session.git("log", "-1", "--format=%s", "--grep=^Update from ", ref)
+            match = re.match(r"Update from (.+) on \d{4}-\d\d-\d\d \d\d:\d\d$", output.strip())
+            if success and match:
+                candidates.append(match.group(1))
+    candidates.append(" ".join(word.capitalize() for word in safe_name.split("-")))
+    for name in candidates:
+        if name and get_safe_name(name) == safe_name:
+            return name
+    return safe_name
+
+def use_student_sparse_checkout(safe_name: str) -> bool:
+    """Limit the shared working copy to one student's folder.
+
+    Called whenever a student logs in, so a laptop shared by several
+    students switches to whoever is using it now.
+
+    Args:
+        safe_name: Safe name for the student
+
+    Returns:
+        True if the sparse checkout is set (or sparse clones are disabled)
+    """
+    if not SPARSE_CLONE:
+        return True
+    success, output = get_git_session().set_sparse_paths([f"{STUDENTS_SUBDIR}/{safe_name}"])
+    if not success:
+        logger.warning(f"Could not limit checkout to {safe_name}: {output}")
+    return success
 
+@traced()
 def check_student_exists(student_name: str) -> bool:
     """Check if a student already exists by checking both folder and branch.
 
@@ -253,71 +2489,876 @@ def check_student_exists(student_name: str) -> bool:
         logger.info(f"Student folder exists at {student_folder}")
         return True
 
-    # Setup repo if needed to check branches
-    if not setup_repository():
+    # Setup repo if needed to check branches (usually prefetched by now)
+    app = get_app()
+    if not app.ensure_remote_refs():
         logger.error("Failed to setup repository for student check")
         return False
 
-    # Check if the branch exists remotely
-    branch_name = f"{STUDENT_BRANCH_PREFIX}{safe_name}"
-    repo_path = os.path.join(WORK_DIR, REPO_NAME)
-
-    # Update remote info first
-    run_command("git fetch", working_dir=repo_path)
-
-    # Check remote branches
-    if branch_exists_remote(branch_name, repo_path):
-        logger.info(f"Student branch {branch_name} exists on remote")
-        return True
-
-    # Check local branches too
-    if branch_exists_local(branch_name, repo_path):
-        logger.info(f"Student branch {branch_name} exists locally")
+    # Remote and local branches, from the fetch made once per session. With
+    # them known, the name may turn out to be one an older version made.
+    safe_name = get_safe_name(student_name)
+    if safe_name in app.roster():
+        logger.info(f"Student branch {STUDENT_BRANCH_PREFIX}{safe_name} exists")
         return True
 
     logger.info(f"Student '{student_name}' does not exist")
     return False
 
-def copy_all_files(src_dir: str, dest_dir: str, exclude_dirs: Optional[list] = None) -> int:
-    """Copy all files recursively from src to dest directory, excluding certain directories.
+def _edit_distance(a: str, b: str, limit: int) -> int:
+    """Levenshtein distance between a and b, or limit + 1 once it's over limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        left = best = i
+        for j, char_b in enumerate(b):
+            cost = previous[j] if char_a == char_b else previous[j] + 1
+            if left + 1 < cost:
+                cost = left + 1
+            if previous[j + 1] + 1 < cost:
+                cost = previous[j + 1] + 1
+            current.append(cost)
+            left = cost
+            if cost < best:
+                best = cost
+        if best > limit:
+            return limit + 1
+        previous = current
+    return min(previous[-1], limit + 1)
+
+def _deletions(word: str, distance: int) -> set:
+    """Every string made by deleting up to distance letters from word."""
+    results = {word}
+    frontier = {word}
+    for _ in range(distance):
+        frontier = {w[:i] + w[i + 1:] for w in frontier for i in range(len(w))}
+        results |= frontier
+    return results
+
+
+def _without_suffix(safe_name: str) -> Tuple[str, ...]:
+    """A safe name, and the name before its hash suffix if it looks like it has one."""
+    match = re.fullmatch(r"(.+)-[0-9a-f]{4}", safe_name)
+    return (safe_name, match.group(1)) if match else (safe_name,)
+
+
+class StudentRoster:
+    """Every student known to the club, by safe name, for looking up typed names.
+
+    Exact lookups are a set lookup. For typos, each name is also filed
+    under every way of deleting up to max_distance letters from it; two
+    names within that edit distance always share one of those, so near
+    misses are found from the typed name's own deletions without comparing
+    it against the whole roster.
+    """
+
+    def __init__(self, names=(), max_distance: Optional[int] = None):
+        self.max_distance = ROSTER_MAX_DISTANCE if max_distance is None else max_distance
+        self.fetched_at = 0.0
+        self.names: set = set()
+        self._sorted: List[str] = []
+        self._deletes: Dict[str, List[str]] = collections.defaultdict(list)
+        for name in names:
+            self.add(name)
+
+    @classmethod
+    def from_repository(cls) -> "StudentRoster":
+        """Build the roster from the fetched and local branches and this laptop's folders."""
+        names = []
+        if os.path.isdir(os.path.join(WORK_DIR, REPO_NAME)):
+            session = get_git_session()
+            names.extend(session.remote_index.branches)
+            names.extend(ref[len("refs/heads/"):] for ref in session.refs()
+                         if ref.startswith("refs/heads/"))
+        names = [name[len(STUDENT_BRANCH_PREFIX):] for name in names
+                 if name.startswith(STUDENT_BRANCH_PREFIX)]
+        if os.path.isdir(WORK_DIR):
+            names.extend(find_student_folders())
+        return cls(names)
+
+    def __contains__(self, safe_name: str) -> bool:
+        return safe_name in self.names
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def add(self, safe_name: str):
+        """Add a student to the roster."""
+        if not safe_name or safe_name in self.names:
+            return
+        self.names.add(safe_name)
+        bisect.insort(self._sorted, safe_name)
+        # A name with a hash suffix is also found by the rest of it
+        forms = _without_suffix(safe_name)
+        variants = _deletions(forms[0], self.max_distance)
+        if len(forms) > 1:
+            variants |= _deletions(forms[1], self.max_distance)
+        for variant in variants:
+            self._deletes[variant].append(safe_name)
+
+    def suggest(self, name: str, limit: int = 3) -> List[str]:
+        """Find the students a mistyped name most likely belongs to.
+
+        Args:
+            name: Name as typed (safe or not)
+            limit: Most suggestions to return
+
+        Returns:
+            Safe names, closest first; [name] itself if it's on the roster
+        """
+        safe_name = get_safe_name(name)
+        if safe_name in self.names:
+            return [safe_name]
+        # Typos are compared without any hash suffix the typed name got
+        safe_name = make_safe_name(name)
+        distances = {}
+        for variant in _deletions(safe_name, self.max_distance):
+            for candidate in self._deletes.get(variant, ()):
+                if candidate not in distances:
+                    distances[candidate] = min(_edit_distance(safe_name, form, self.max_distance)
+                                               for form in _without_suffix(candidate))
+        matches = {candidate: distance for candidate, distance in distances.items()
+                   if distance <= self.max_distance}
+        # Someone who only typed the start of their name
+        if len(safe_name) >= ROSTER_MIN_PREFIX:
+            start = bisect.bisect_left(self._sorted, safe_name)
+            for candidate in itertools.islice(self._sorted, start, start + limit):
+                if not candidate.startswith(safe_name):
+                    break
+                matches.setdefault(candidate, 1)
+        return sorted(matches, key=lambda candidate: (matches[candidate], candidate))[:limit]
+
+class IgnoreRule(NamedTuple):
+    """One line of an ignore file, parsed the way git parses .gitignore."""
+    pattern: str  # Without the "!" or the trailing "/"
+    negated: bool
+    dir_only: bool
+    anchored: bool  # Matched against the whole path, not just the last part
+
+
+def _ignore_pattern_regex(pattern: str) -> str:
+    """Translate a gitignore glob into a regular expression for a relative path."""
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        # "**" is only special as a whole part of the path
+        whole = pattern.startswith("**", i) and (i == 0 or pattern[i - 1] == "/")
+        if whole and pattern.startswith("**/", i):
+            # Any number of folders, including none
+            out.append("(?:.*/)?")
+            i += 3
+            continue
+        if whole and i + 2 == n:
+            out.append(".*")
+            i += 2
+            continue
+        if c == "*":
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "\\" and i + 1 < n:
+            i += 1
+            out.append(re.escape(pattern[i]))
+        elif c == "[":
+            j = i + 1
+            if j < n and pattern[j] == "!":
+                j += 1
+            if j < n and pattern[j] == "]":
+                j += 1
+            j = pattern.find("]", j)
+            if j < 0:
+                out.append("\\[")
+            else:
+                body = pattern[i + 1:j].replace("\\", "\\\\")
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                elif body.startswith("^"):
+                    body = "\\" + body
+                out.append(f"[{body}]")
+                i = j
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return "".join(out)
+
+
+class IgnoreRules:
+    """Files and folders left out of saves, backups and copies.
+
+    Rules are written like a .gitignore: DEFAULT_IGNORE_RULES first, then
+    the lines of the student's own IGNORE_FILE, and the last rule that
+    matches a path decides. They are compiled into one regular expression
+    for files and one for folders, so checking a path costs one match
+    however many rules there are.
+
+    Callers check each folder before listing it and skip everything inside
+    an ignored one. As with git, a file can't be re-included from inside an
+    ignored folder. Folders holding a VIRTUALENV_MARKER are skipped too.
+    """
+
+    def __init__(self, lines: Iterable[str] = (), detect_virtualenvs: bool = True):
+        self.rules: List[IgnoreRule] = []
+        self.detect_virtualenvs = detect_virtualenvs
+        for line in lines:
+            rule = self.parse(line)
+            if rule:
+                self.rules.append(rule)
+        self.fingerprint = hashlib.sha1(
+            repr((self.rules, detect_virtualenvs)).encode()).hexdigest()
+        self._files = self._compile([rule for rule in self.rules if not rule.dir_only])
+        self._dirs = self._compile(self.rules)
+
+    @staticmethod
+    def parse(line: str) -> Optional[IgnoreRule]:
+        """Parse one line of an ignore file (None for blanks and comments)."""
+        line = line.rstrip("\r\n")
+        while line.endswith(" ") and not line.endswith("\\ "):
+            line = line[:-1]
+        if not line or line.startswith("#"):
+            return None
+        negated = line.startswith("!")
+        if negated:
+            line = line[1:]
+        dir_only = line.endswith("/")
+        line = line.rstrip("/")
+        if not line:
+            return None
+        anchored = "/" in line
+        return IgnoreRule(line.lstrip("/"), negated, dir_only, anchored)
+
+    @staticmethod
+    def _compile(rules: List[IgnoreRule]) -> Optional[Tuple[re.Pattern, List[bool]]]:
+        if not rules:
+            return None
+        # Alternatives are tried in order, so putting the last rule first
+        # makes the match the rule that decides
+        rules = rules[::-1]
+        regex = re.compile("|".join(
+            f"({'' if rule.anchored else '(?:.*/)?'}{_ignore_pattern_regex(rule.pattern)})"
+            for rule in rules), re.DOTALL)
+        return regex, [rule.negated for rule in rules]
+
+    def ignores(self, rel: str, is_dir: bool = False) -> bool:
+        """Check a path relative to the folder (its parent folders aren't checked).
+
+        Args:
+            rel: "/"-separated path
+            is_dir: True if the path is a folder
+
+        Returns:
+            True if the path is left out
+        """
+        compiled = self._dirs if is_dir else self._files
+        if compiled is None:
+            return False
+        match = compiled[0].fullmatch(rel)
+        return match is not None and not compiled[1][match.lastindex - 1]
+
+    def is_virtualenv(self, names: Iterable[str]) -> bool:
+        """Check whether a folder listing is that of a virtualenv."""
+        return self.detect_virtualenvs and VIRTUALENV_MARKER in names
+
+    def gitignore_lines(self, prefix: str) -> List[str]:
+        """The rules as .gitignore lines for a folder at `prefix` in a repository."""
+        lines = []
+        for rule in self.rules:
+            path = rule.pattern if rule.anchored else f"**/{rule.pattern}"
+            lines.append(f"{'!' if rule.negated else ''}/{prefix}/{path}"
+                         f"{'/' if rule.dir_only else ''}")
+        return lines
+
+
+_ignore_rules: Dict[str, Tuple[Optional[Tuple[int, int]], IgnoreRules]] = {}
+
+def get_ignore_rules(folder: str) -> IgnoreRules:
+    """Get the compiled rules for a folder: the defaults plus its IGNORE_FILE.
+
+    The rules are compiled once and only again when the ignore file changes.
+
+    Args:
+        folder: Student folder (or its copy in the repository)
+
+    Returns:
+        IgnoreRules for the folder
+    """
+    path = os.path.join(os.path.abspath(folder), IGNORE_FILE)
+    try:
+        st = os.stat(path)
+        key = (st.st_size, st.st_mtime_ns)
+    except OSError:
+        key = None
+    cached = _ignore_rules.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    lines = list(DEFAULT_IGNORE_RULES)
+    if key:
+        try:
+            with open(path, "r", encoding="utf-8", errors="surrogateescape") as f:
+                lines.extend(f)
+        except OSError as e:
+            logger.warning(f"Could not read {path}: {e}")
+    rules = IgnoreRules(lines)
+    _ignore_rules[path] = (key, rules)
+    logger.debug("Compiled %s ignore rules for %s", len(rules.rules), folder)
+    return rules
+
+class FileInfo(NamedTuple):
+    """What a folder scan records about each file."""
+    size: int
+    mtime_ns: int
+
+
+class FolderSnapshot:
+    """Every file and folder under a root, read in one os.scandir pass.
+
+    A save or load used to walk the student's folder three to five times
+    (to check it had files, back it up, copy it and count it). Now the
+    folder is scanned once and each step reads the snapshot instead.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        self.files: Dict[str, FileInfo] = {}  # Relative path ("/"-separated) -> info
+        self.dirs: List[str] = []
+        self.executable: set = set()  # Files with the executable bit, as git records it
+        self.ignored: List[str] = []  # Paths left out by the ignore rules (not what's inside them)
+        self.symlinks: Dict[str, str] = {}  # Relative path -> link target, for links to files or folders
+        self.scanned_at = time.time_ns()
+
+    def is_empty(self) -> bool:
+        """True if there are no files (empty folders don't count)."""
+        return not self.files
+
+    def count_by_type(self) -> Dict[str, int]:
+        """Count files by type, as shown in the student's menu."""
+        counts = {"python": 0, "text": 0, "other": 0, "total": len(self.files),
+                  "dirs": len(self.dirs)}
+        for rel in self.files:
+            if rel.endswith('.py'):
+                counts["python"] += 1
+            elif rel.endswith('.txt'):
+                counts["text"] += 1
+            else:
+                counts["other"] += 1
+        return counts
+
+
+def scan_folder(folder: str, exclude_dirs: Optional[list] = None,
+                rules: Optional[IgnoreRules] = None) -> FolderSnapshot:
+    """Scan a folder once with os.scandir.
+
+    Entry types come from the directory listing itself, so the only
+    extra system call is one stat per file (for its size and mtime).
+    Symlinks to folders are listed as folders but not followed, as
+    os.walk does. Every symlink's target is kept too (even a broken
+    link's), so a commit can store it as a link. Ignored folders are
+    never listed.
+
+    Args:
+        folder: Folder to scan (a missing folder gives an empty snapshot)
+        exclude_dirs: Directory names to skip (default: EXCLUDE_DIRS)
+        rules: Ignore rules (default: the folder's own, from get_ignore_rules())
+
+    Returns:
+        FolderSnapshot of the folder
+    """
+    if exclude_dirs is None:
+        exclude_dirs = EXCLUDE_DIRS
+    if rules is None:
+        rules = get_ignore_rules(folder)
+
+    snapshot = FolderSnapshot(os.path.abspath(folder))
+    pending = [("", snapshot.root)]
+    while pending:
+        rel_dir, path = pending.pop()
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError as e:
+            logger.debug("Could not scan %s: %s", path, e)
+            continue
+        if rel_dir:
+            # Only now is it known whether the folder is a virtualenv
+            if rules.is_virtualenv(entry.name for entry in entries):
+                snapshot.ignored.append(rel_dir)
+                continue
+            snapshot.dirs.append(rel_dir)
+        for entry in entries:
+            rel = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name in exclude_dirs:
+                        continue
+                    if rules.ignores(rel, True):
+                        snapshot.ignored.append(rel)
+                    else:
+                        pending.append((rel, entry.path))
+                elif entry.is_symlink() and entry.is_dir():
+                    if rules.ignores(rel, True):
+                        snapshot.ignored.append(rel)
+                    else:
+                        snapshot.dirs.append(rel)
+                        snapshot.symlinks[rel] = os.readlink(entry.path)
+                elif rules.ignores(rel):
+                    snapshot.ignored.append(rel)
+                else:
+                    if entry.is_symlink():
+                        snapshot.symlinks[rel] = os.readlink(entry.path)
+                    st = entry.stat()
+                    snapshot.files[rel] = FileInfo(st.st_size, st.st_mtime_ns)
+                    if st.st_mode & 0o100:
+                        snapshot.executable.add(rel)
+            except OSError:
+                # Deleted (or a broken link) since the listing
+                continue
+
+    logger.debug("Scanned %s: %s files, %s folders, %s ignored", folder,
+                 len(snapshot.files), len(snapshot.dirs), len(snapshot.ignored))
+    return snapshot
+
+_copy_stats: Dict[str, List[int]] = {strategy: [0, 0] for strategy in COPY_STRATEGIES}
+_copy_unsupported: Dict[Tuple[int, int], set] = {}  # (source device, destination device) -> strategies
+_copy_lock = threading.Lock()
+
+def _copy_reflink(src_fd: int, dest_fd: int):
+    import fcntl
+    fcntl.ioctl(dest_fd, FICLONE, src_fd)
+
+def _copy_range(src_fd: int, dest_fd: int):
+    while os.copy_file_range(src_fd, dest_fd, COPY_CHUNK_SIZE):
+        pass
+
+def _copy_sendfile(src_fd: int, dest_fd: int):
+    offset = 0
+    while True:
+        sent = os.sendfile(dest_fd, src_fd, offset, COPY_CHUNK_SIZE)
+        if not sent:
+            break
+        offset += sent
+
+def _copy_buffered(src_fd: int, dest_fd: int):
+    with open(src_fd, "rb", closefd=False) as src, open(dest_fd, "wb", closefd=False) as dest:
+        shutil.copyfileobj(src, dest, HASH_CHUNK_SIZE)
+
+_COPY_FUNCTIONS = {"reflink": _copy_reflink, "copy_file_range": _copy_range,
+                   "sendfile": _copy_sendfile, "copy": _copy_buffered}
+
+# What a filesystem says when it can't do a kind of copy (rather than the copy failing)
+_COPY_UNSUPPORTED_ERRORS = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL,
+                            errno.ENOSYS, errno.ENOTTY, errno.EBADF, errno.EPERM, errno.EMLINK}
+
+def _copy_strategies(link: bool) -> List[str]:
+    if not ZERO_COPY:
+        return ["copy"]
+    linux = sys.platform.startswith("linux")
+    available = {"reflink": linux, "hardlink": link, "sendfile": linux,
+                 "copy_file_range": linux and hasattr(os, "copy_file_range"), "copy": True}
+    return [strategy for strategy in COPY_STRATEGIES if available[strategy]]
+
+def copy_file(src_path: str, dest_path: str, metadata: bool = True, link: bool = False) -> str:
+    """Copy a file with the cheapest method the filesystem allows.
+
+    In order: a reflink (the copy shares the original's blocks until one
+    is written to), a hard link if allowed, copy_file_range or sendfile
+    (the kernel copies without the data passing through Python), and last
+    an ordinary read and write. A method a pair of filesystems turns down once
+    isn't tried on them again.
+
+    The copy is written beside dest_path and renamed over it, so a file
+    already there (perhaps a hard link to something else) is replaced,
+    never written into.
+
+    Args:
+        src_path: File to copy
+        dest_path: Where to copy it
+        metadata: Copy the mode and times as shutil.copy2 does
+        link: A hard link will do. Only for copies nobody will edit in
+            place, as an edit through either name changes both.
+
+    Returns:
+        The method used (one of COPY_STRATEGIES)
+    """
+    src_st = os.stat(src_path)
+    dest_dir = os.path.dirname(os.path.abspath(dest_path))
+    devices = (src_st.st_dev, os.stat(dest_dir).st_dev)
+    unsupported = _copy_unsupported.get(devices, ())
+    tmp_path = os.path.join(dest_dir, f".{os.path.basename(dest_path)}.{threading.get_ident()}.tmp")
+
+    for strategy in _copy_strategies(link):
+        if strategy in unsupported:
+            continue
+        try:
+            if strategy == "hardlink":
+                os.link(src_path, tmp_path)
+            else:
+                src_fd = os.open(src_path, os.O_RDONLY)
+                try:
+                    dest_fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+                    try:
+                        _COPY_FUNCTIONS[strategy](src_fd, dest_fd)
+                    finally:
+                        os.close(dest_fd)
+                finally:
+                    os.close(src_fd)
+                # Some filesystems claim to copy in the kernel and copy nothing
+                if src_st.st_size and not os.path.getsize(tmp_path) and strategy != "copy":
+                    raise OSError(errno.EOPNOTSUPP, f"{strategy} copied no data")
+                if metadata:
+                    shutil.copystat(src_path, tmp_path)
+            os.replace(tmp_path, dest_path)
+        except OSError as e:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            if strategy == "copy" or e.errno not in _COPY_UNSUPPORTED_ERRORS:
+                raise
+            with _copy_lock:
+                _copy_unsupported.setdefault(devices, set()).add(strategy)
+            logger.debug("%s not available from %s to %s (%s), trying the next way to copy",
+                         strategy, src_path, dest_dir, e)
+            continue
+        with _copy_lock:
+            _copy_stats[strategy][0] += 1
+            _copy_stats[strategy][1] += src_st.st_size
+        return strategy
+    raise OSError(errno.EIO, f"Could not copy {src_path}")
+
+def copy_stats() -> Dict[str, Dict[str, int]]:
+    """Files and bytes copied by each method since the program started."""
+    with _copy_lock:
+        return {strategy: {"files": files, "bytes": size}
+                for strategy, (files, size) in _copy_stats.items()}
+
+def get_state_dir(*parts: str) -> str:
+    """Get (and create) a folder under WORK_DIR for the tool's own state.
+
+    Args:
+        *parts: Optional sub-folders below the state directory
+
+    Returns:
+        Path to the state folder
+    """
+    path = os.path.join(WORK_DIR, STATE_SUBDIR, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def hash_file(path: str) -> str:
+    """Hash a file's contents the same way `git hash-object` does.
+
+    Using git's blob id means the hashes in our manifests can be compared
+    directly with what git has stored.
+
+    Args:
+        path: File to hash
+
+    Returns:
+        Hex SHA-1 of the git blob for this file
+    """
+    digest = hashlib.sha1()
+    digest.update(f"blob {os.path.getsize(path)}\0".encode())
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def get_manifest_path(folder: str) -> str:
+    """Get the path of the manifest file that describes a folder."""
+    key = hashlib.sha1(os.path.abspath(folder).encode()).hexdigest()
+    return os.path.join(get_state_dir("manifests"), f"{key}.json")
+
+def load_manifest(folder: str) -> Dict[str, list]:
+    """Load the saved manifest for a folder.
+
+    Args:
+        folder: Folder the manifest describes
+
+    Returns:
+        Mapping of relative path to [size, mtime_ns, hash] (empty if none saved)
+    """
+    try:
+        with open(get_manifest_path(folder), "r", encoding="utf-8") as f:
+            return json.load(f)["files"]
+    except (OSError, ValueError, KeyError):
+        return {}
+
+def save_manifest(folder: str, manifest: Dict[str, list]):
+    """Save the manifest for a folder (errors are logged, it's only a cache)."""
+    path = get_manifest_path(folder)
+    try:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            # dumps, not dump: the C encoder only runs on whole documents
+            f.write(json.dumps({"folder": os.path.abspath(folder), "files": manifest}))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Could not save manifest for {folder}: {e}")
+
+def update_manifest(folder: str, exclude_dirs: Optional[list] = None,
+                    hint: Optional[Dict[str, list]] = None,
+                    snapshot: Optional[FolderSnapshot] = None) -> Dict[str, list]:
+    """Bring a folder's manifest up to date with what is on disk.
+
+    Files whose size and modification time match the saved manifest keep
+    their hash; only new or changed files are read. Files in `hint` with
+    the same size and modification time are assumed to have the same
+    content (the same quick check rsync uses), which avoids hashing both
+    sides of a copy made with copy2.
+
+    Args:
+        folder: Folder to scan
+        exclude_dirs: Directory names to skip (default: EXCLUDE_DIRS)
+        hint: Manifest of another folder this one is a copy of
+        snapshot: Scan of folder already made with the same exclude_dirs
+
+    Returns:
+        Mapping of relative path to [size, mtime_ns, hash]
+    """
+    if snapshot is None:
+        snapshot = scan_folder(folder, exclude_dirs)
+
+    saved = load_manifest(folder)
+    hint = hint or {}
+    manifest = {}
+    hashed = 0
+    folder = os.path.abspath(folder)
+    for rel, (size, mtime_ns) in snapshot.files.items():
+        for known in (saved.get(rel), hint.get(rel)):
+            if known and known[0] == size and known[1] == mtime_ns:
+                manifest[rel] = [size, mtime_ns, known[2]]
+                break
+        else:
+            try:
+                manifest[rel] = [size, mtime_ns, hash_file(os.path.join(folder, rel))]
+            except OSError:
+                # Deleted since the scan
+                continue
+            hashed += 1
+
+    logger.debug("Manifest for %s: %s files, %s hashed", folder, len(manifest), hashed)
+    if manifest != saved:
+        save_manifest(folder, manifest)
+    return manifest
+
+@traced()
+def sync_folder(src_dir: str, dest_dir: str, exclude_dirs: Optional[list] = None,
+                delete: bool = True,
+                snapshot: Optional[FolderSnapshot] = None, link: bool = False) -> Dict[str, int]:
+    """Make dest_dir match src_dir, copying only files whose content changed.
+
+    Both folders keep a manifest (path -> size, mtime, content hash), so a
+    sync where nothing changed only costs a stat per file.
 
     Args:
         src_dir: Source directory
         dest_dir: Destination directory
         exclude_dirs: List of directory names to exclude (default: ['.git'])
+        delete: Remove files from dest_dir that no longer exist in src_dir
+        snapshot: Scan of src_dir already made with the same exclude_dirs
+        link: Hard links will do for the copies (see copy_file)
 
     Returns:
-        Number of files copied
+        Dictionary with counts of files copied, skipped and deleted, and
+        the bytes copied and skipped
     """
-    if exclude_dirs is None:
-        exclude_dirs = EXCLUDE_DIRS
+    stats = {
+        "copied": 0,
+        "skipped": 0,
+        "deleted": 0,
+        "bytes_copied": 0,
+        "bytes_skipped": 0
+    }
+    dest_dir = os.path.abspath(dest_dir)
+    os.makedirs(dest_dir, exist_ok=True)
+
+    src_manifest = update_manifest(src_dir, exclude_dirs, snapshot=snapshot)
+    dest_manifest = update_manifest(dest_dir, exclude_dirs, hint=src_manifest)
+
+    try:
+        for rel, (size, _, digest) in src_manifest.items():
+            dest_entry = dest_manifest.get(rel)
+            if dest_entry and dest_entry[2] == digest:
+                stats["skipped"] += 1
+                stats["bytes_skipped"] += size
+                continue
+
+            dest_path = os.path.join(dest_dir, rel)
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            copy_file(os.path.join(src_dir, rel), dest_path, link=link)
+            st = os.stat(dest_path)
+            dest_manifest[rel] = [st.st_size, st.st_mtime_ns, digest]
+            stats["copied"] += 1
+            stats["bytes_copied"] += size
+
+        if delete:
+            for rel in [rel for rel in dest_manifest if rel not in src_manifest]:
+                dest_path = os.path.join(dest_dir, rel)
+                os.remove(dest_path)
+                del dest_manifest[rel]
+                stats["deleted"] += 1
+                # Tidy up folders the deletion left empty
+                parent = os.path.dirname(dest_path)
+                while parent != dest_dir and not os.listdir(parent):
+                    os.rmdir(parent)
+                    parent = os.path.dirname(parent)
+    except OSError as e:
+        logger.exception(f"Error syncing files from {src_dir} to {dest_dir}: {e}")
+    finally:
+        save_manifest(dest_dir, dest_manifest)
+
+    trace_add("files_copied", stats["copied"])
+    trace_add("bytes_copied", stats["bytes_copied"])
+    logger.info(
+        f"Synced {src_dir} to {dest_dir}: {stats['copied']} copied "
+        f"({stats['bytes_copied']} bytes), {stats['skipped']} unchanged "
+        f"({stats['bytes_skipped']} bytes), {stats['deleted']} deleted"
+    )
+    return stats
 
-    logger.debug(f"Copying files from {src_dir} to {dest_dir}, excluding {exclude_dirs}")
+def get_student_worktree(safe_name: str) -> str:
+    """Get the path of the git worktree that holds a student's branch."""
+    return os.path.join(WORK_DIR, STATE_SUBDIR, WORKTREES_SUBDIR, safe_name)
 
-    if not os.path.exists(dest_dir):
-        os.makedirs(dest_dir)
-        logger.debug(f"Created destination directory {dest_dir}")
+def worktree_is_valid(worktree: str) -> bool:
+    """Check that a worktree folder is still attached to the repository.
 
-    file_count = 0
-    # Copy all files, preserving directory structure
+    A worktree is left stranded if the repository it belongs to is cloned
+    again; its `.git` file then points at a folder that no longer exists.
+    """
     try:
-        for item in os.listdir(src_dir):
-            src_item = os.path.join(src_dir, item)
-            dest_item = os.path.join(dest_dir, item)
+        with open(os.path.join(worktree, ".git"), "r", encoding="utf-8") as f:
+            gitdir = f.read().strip()
+    except OSError:
+        return False
+    return gitdir.startswith("gitdir: ") and os.path.isdir(gitdir[len("gitdir: "):])
 
-            if os.path.isdir(src_item):
-                if item not in exclude_dirs:
-                    file_count += copy_all_files(src_item, dest_item, exclude_dirs)
-            else:
-                shutil.copy2(src_item, dest_item)
-                file_count += 1
+def ensure_student_worktree(safe_name: str, branch_name: str) -> Optional[str]:
+    """Make sure a student's branch is checked out, up to date, in its own worktree.
 
-        logger.debug(f"Copied {file_count} files from {src_dir} to {dest_dir}")
-        return file_count
-    except Exception as e:
-        logger.exception(f"Error copying files from {src_dir} to {dest_dir}: {e}")
-        return file_count
+    The worktree is created on first use: from the local branch if there is
+    one, otherwise from the remote branch, otherwise as a new branch from
+    main. It only checks out the student's own folder.
+
+    Args:
+        safe_name: Safe name for the student
+        branch_name: The git branch name for this student
+
+    Returns:
+        Path to the worktree, or None if it couldn't be created
+    """
+    session = get_git_session()
+    worktree = get_student_worktree(safe_name)
+
+    if worktree_is_valid(worktree):
+        if session.has_remote_branch(branch_name):
+            success, output = session.pull(branch_name, cwd=worktree)
+            if not success:
+                logger.warning(f"Could not update {branch_name}, keeping local work: {output}")
+        return worktree
+
+    stranded = None
+    if os.path.exists(worktree):
+        # Left behind by a re-clone: keep its files to bring into the new worktree
+        stranded = f"{worktree}.stranded-{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        os.rename(worktree, stranded)
+        logger.warning(f"Worktree {worktree} was detached, moved to {stranded}")
+
+    # Forget worktrees whose folders were deleted, so their branches are free
+    session.git("worktree", "prune")
+    os.makedirs(os.path.dirname(worktree), exist_ok=True)
+    if session.has_local_branch(branch_name):
+        args = [worktree, branch_name]
+    elif session.has_remote_branch(branch_name):
+        args = ["--track", "-b", branch_name, worktree, f"origin/{branch_name}"]
+    else:
+        args = ["-b", branch_name, worktree, MAIN_BRANCH]
+    success, output = session.git("worktree", "add", *args)
+    session.invalidate()
+    if not success:
+        logger.error(f"Could not create worktree for {branch_name}: {output}")
+        return None
+    session.mark_pulled(branch_name)
+
+    if SPARSE_CLONE:
+        session.git("sparse-checkout", "set", "--cone", f"{STUDENTS_SUBDIR}/{safe_name}",
+                    cwd=worktree)
+
+    if stranded:
+        # The stranded copy is deleted next, so its files can simply be linked
+        sync_folder(os.path.join(stranded, STUDENTS_SUBDIR, safe_name),
+                    os.path.join(worktree, STUDENTS_SUBDIR, safe_name), delete=False, link=True)
+        shutil.rmtree(stranded, ignore_errors=True)
+
+    logger.info(f"Created worktree for {branch_name} at {worktree}")
+    return worktree
+
+def link_student_folder(safe_name: str, worktree: str) -> bool:
+    """Make the student's folder a link to their folder inside the worktree.
+
+    A real folder left from the old copy-based layout is migrated: its
+    files are copied into the worktree (local files win over saved ones, so
+    unsaved work is kept), it is backed up, and it is replaced by the link.
+
+    Args:
+        safe_name: Safe name for the student
+        worktree: Path to the student's worktree
 
+    Returns:
+        True if the student folder now points into the worktree
+    """
+    student_folder = os.path.join(WORK_DIR, safe_name)
+    target = os.path.join(worktree, STUDENTS_SUBDIR, safe_name)
+    os.makedirs(target, exist_ok=True)
+
+    if os.path.islink(student_folder):
+        if os.readlink(student_folder) == target:
+            return True
+        os.remove(student_folder)
+
+    # Create the link under a temporary name first, so a filesystem without
+    # links is found out before the old folder is touched
+    tmp_link = f"{student_folder}.link-tmp"
+    try:
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(target, tmp_link)
+    except OSError as e:
+        logger.warning(f"Cannot link {student_folder} to its worktree: {e}")
+        return False
+
+    if os.path.isdir(student_folder):
+        logger.info(f"Moving {student_folder} into worktree {worktree}")
+        sync_folder(student_folder, target, delete=False, link=True)
+        create_backup(student_folder, safe_name)
+        migrated = f"{student_folder}.migrating"
+        os.rename(student_folder, migrated)
+        os.rename(tmp_link, student_folder)
+        shutil.rmtree(migrated, ignore_errors=True)
+    else:
+        os.rename(tmp_link, student_folder)
+    return True
+
+def use_student_worktree(safe_name: str, branch_name: str) -> bool:
+    """Set up the worktree layout for a student, if enabled.
+
+    Returns:
+        True if the student's folder is now their worktree; False means the
+        copy-based layout should be used instead
+    """
+    if not USE_WORKTREES:
+        return False
+    worktree = ensure_student_worktree(safe_name, branch_name)
+    return worktree is not None and link_student_folder(safe_name, worktree)
+
+def student_folder_in_worktree(safe_name: str) -> bool:
+    """Check whether a student's folder is a link into a working worktree."""
+    student_folder = os.path.join(WORK_DIR, safe_name)
+    return (os.path.islink(student_folder)
+            and worktree_is_valid(get_student_worktree(safe_name)))
+
+@traced()
 def pull_student_files(student_name: str, branch_name: str):
     """Pull the latest files for a student and sync them to their folder.
 
@@ -337,23 +3378,37 @@ def pull_student_files(student_name: str, branch_name: str):
     if not os.path.exists(repo_path):
         logger.warning("Repository doesn't exist, setting up")
         print("Setting up code storage... please wait...")
-        if not setup_repository():
+        if not get_app().ensure_repository():
             logger.error("Failed to setup repository")
             return
 
-    # Checkout and pull the student branch
-    run_command(f"git checkout {MAIN_BRANCH}", working_dir=repo_path)  # Start from main
-    run_command("git fetch origin", working_dir=repo_path)  # Get latest branches
+    # With a worktree per student the folder is the checkout itself:
+    # updating the worktree is all there is to do
+    snapshot = None
+    if use_student_worktree(safe_name, branch_name):
+        snapshot = scan_folder(student_folder)
+        if branch_exists_remote(branch_name, repo_path):
+            file_count = len(snapshot.files)
+            if file_count > 0:
+                print(f"Found {file_count} saved files!")
+                logger.info(f"{file_count} files in worktree for {student_name}")
 
-    # Check if branch exists remotely
-    if branch_exists_remote(branch_name, repo_path):
+    # Checkout and pull the student branch
+    elif branch_exists_remote(branch_name, repo_path):
+        session = get_git_session()
+        use_student_sparse_checkout(safe_name)
+        session.checkout(MAIN_BRANCH)  # Start from main
         # Checkout the branch, creating it if needed
-        success, output = run_command(
-            f"git checkout {branch_name} 2>/dev/null || git checkout -b {branch_name} origin/{branch_name}",
-            working_dir=repo_path
-        )
+        if branch_exists_local(branch_name, repo_path):
+            success, output = session.checkout(branch_name)
+        else:
+            success, output = session.checkout(branch_name, create=True,
+                                               start_point=f"origin/{branch_name}")
+            if success:
+                # Just created from the freshly fetched remote branch
+                session.mark_pulled(branch_name)
         if success:
-            run_command(f"git pull origin {branch_name}", working_dir=repo_path)
+            session.pull(branch_name)
             logger.info(f"Checked out and pulled branch {branch_name}")
         else:
             logger.error(f"Failed to checkout branch {branch_name}: {output}")
@@ -363,22 +3418,24 @@ def pull_student_files(student_name: str, branch_name: str):
 
         # Check if repo student folder exists after pull
         if os.path.exists(repo_student_folder):
-            # Count files before copying
-            file_count = sum([len(files) for _, _, files in os.walk(repo_student_folder)])
-
-            # Copy all files from repo to student folder (recursive)
-            copy_all_files(repo_student_folder, student_folder)
+            # Copy changed files from repo to student folder. Files the
+            # student has created here but not saved yet are left alone.
+            stats = sync_folder(repo_student_folder, student_folder, delete=False)
+            file_count = stats["copied"] + stats["skipped"]
 
             if file_count > 0:
                 print(f"Found {file_count} saved files!")
                 logger.info(f"Copied {file_count} files to {student_folder}")
 
     # If there are no files yet, create default ones
-    all_files = []
-    for root, _, files in os.walk(student_folder):
-        all_files.extend([os.path.join(root, f) for f in files])
-
-    if not all_files:
+    if snapshot is None:
+        snapshot = scan_folder(student_folder)
+    index = get_folder_index(safe_name)
+    if index.saved is None:
+        # First time on this laptop: what was just downloaded is what's saved
+        index.update_from_snapshot(snapshot)
+        index.mark_saved()
+    if snapshot.is_empty():
         logger.info("No files found, creating default student folder")
         create_student_folder(student_name)
 
@@ -407,15 +3464,40 @@ def show_welcome_screen() -> Tuple[str, str]:
         safe_name = get_safe_name(student_name)
         branch_name = f"{STUDENT_BRANCH_PREFIX}{safe_name}"
 
-        # Check if this is a new student - ensure repository is setup first
-        if not setup_repository():
-            logger.error("Failed to setup repository during welcome")
-            print("\nCould not set up code storage. Please ask your mentor for help.")
-            continue
+        # A name we already know has a branch: start getting their files
+        # straight away, without waiting for the repository checks
+        app = get_app()
+        if app.start_pull(student_name, branch_name):
+            is_existing_student = True
+        else:
+            # Check if this is a new student - ensure repository is setup first
+            if not app.repo_ready and not app.wait_for_prefetch(timeout=0):
+                # The prefetch is still setting it up, without telling anyone
+                print("Setting up code storage... please wait...")
+            if not app.ensure_repository():
+                logger.error("Failed to setup repository during welcome")
+                print("\nCould not set up code storage. Please ask your mentor for help.")
+                continue
 
-        is_existing_student = check_student_exists(student_name)
+            is_existing_student = check_student_exists(student_name)
+            # Worked out again now the remote's branches are known
+            branch_name = f"{STUDENT_BRANCH_PREFIX}{get_safe_name(student_name)}"
 
         if not is_existing_student:
+            # Probably a typo of a name we know, e.g. "Aofie" for "Aoife"
+            suggestions = get_app().roster().suggest(student_name, limit=1)
+            if suggestions:
+                known_name = find_display_name(suggestions[0])
+                print(f"\nDid you mean {known_name}? (y/n)")
+                if input("> ").strip().lower() == "y":
+                    logger.info(f"Corrected '{student_name}' to '{known_name}'")
+                    student_name = known_name
+                    branch_name = f"{STUDENT_BRANCH_PREFIX}{suggestions[0]}"
+                    get_name_registry().register(student_name)
+                    print(f"\nWelcome back, {student_name}!")
+                    pull_student_files(student_name, branch_name)
+                    break
+
             print("\nThis name doesn't have any saved work yet.")
             print("Is this your first time here? (y/n)")
             first_time = input("> ").strip().lower()
@@ -432,12 +3514,14 @@ def show_welcome_screen() -> Tuple[str, str]:
         else:
             print(f"\nWelcome back, {student_name}!")
             logger.info(f"Returning student: {student_name}")
+            get_name_registry().register(student_name)
             # Pull latest code for returning students
-            pull_student_files(student_name, branch_name)
+            app.finish_pull(student_name, branch_name)
             break
 
     return student_name, branch_name
 
+@traced()
 def setup_student_branch(branch_name: str) -> bool:
     """Setup the student's branch.
 
@@ -449,27 +3533,43 @@ def setup_student_branch(branch_name: str) -> bool:
     """
     logger.info(f"Setting up student branch: {branch_name}")
     repo_path = os.path.join(WORK_DIR, REPO_NAME)
+    safe_name = branch_name[len(STUDENT_BRANCH_PREFIX):]
+
+    # With a worktree per student the branch is always checked out there
+    if use_student_worktree(safe_name, branch_name):
+        logger.info(f"Branch {branch_name} is ready in its worktree")
+        return True
+
+    use_student_sparse_checkout(safe_name)
+
+    # Already on the student's branch (e.g. after pull_student_files), nothing to do
+    session = get_git_session()
+    if session.current_branch() == branch_name:
+        logger.info(f"Branch {branch_name} is ready")
+        return True
 
     # First checkout main branch and update
-    success, output = run_command(f"git checkout {MAIN_BRANCH} && git pull", working_dir=repo_path)
+    success, output = session.checkout(MAIN_BRANCH)
+    if success:
+        success, output = session.pull()
     if not success:
         logger.error(f"Failed to checkout/pull main branch: {output}")
 
     # Check if the branch exists locally
     if branch_exists_local(branch_name, repo_path):
-        logger.debug(f"Branch {branch_name} exists locally")
+        logger.debug("Branch %s exists locally", branch_name)
         # Just checkout the local branch
-        run_command(f"git checkout {branch_name}", working_dir=repo_path)
+        session.checkout(branch_name)
     # Check if the branch exists on remote
     elif branch_exists_remote(branch_name, repo_path):
-        logger.debug(f"Branch {branch_name} exists on remote")
+        logger.debug("Branch %s exists on remote", branch_name)
         # Checkout the existing branch
-        run_command(f"git checkout {branch_name}", working_dir=repo_path)
-        run_command(f"git pull origin {branch_name}", working_dir=repo_path)
+        session.checkout(branch_name)
+        session.pull(branch_name)
     else:
-        logger.debug(f"Branch {branch_name} doesn't exist, creating new")
+        logger.debug("Branch %s doesn't exist, creating new", branch_name)
         # Create a new branch from main
-        run_command(f"git checkout -b {branch_name}", working_dir=repo_path)
+        session.checkout(branch_name, create=True)
 
     logger.info(f"Branch {branch_name} is ready")
     return True
@@ -484,13 +3584,14 @@ def create_student_folder(student_name: str) -> str:
         Path to the created student folder
     """
     logger.info(f"Creating folder for student: {student_name}")
-    safe_name = get_safe_name(student_name)
+    safe_name = get_name_registry().register(student_name)
     student_folder = os.path.join(WORK_DIR, safe_name)
+    get_app().student_added(safe_name)
 
     # Create student folder if it doesn't exist
     try:
         os.makedirs(student_folder, exist_ok=True)
-        logger.debug(f"Created directory: {student_folder}")
+        logger.debug("Created directory: %s", student_folder)
     except Exception as e:
         logger.exception(f"Failed to create student folder: {e}")
         raise
@@ -502,7 +3603,7 @@ def create_student_folder(student_name: str) -> str:
             with open(readme_path, "w") as f:
                 f.write(f"# {student_name}'s Python Projects\n\n")
                 f.write("This folder contains Python projects for Tramore Code Club.\n")
-            logger.debug(f"Created README at {readme_path}")
+            logger.debug("Created README at %s", readme_path)
         except IOError as e:
             logger.exception(f"Failed to create README: {e}")
 
@@ -518,7 +3619,7 @@ def create_student_folder(student_name: str) -> str:
 # Write your code below this line:
 print("Hello, World! My name is {student_name}!")
 """)
-            logger.debug(f"Created default Python file at {default_file}")
+            logger.debug("Created default Python file at %s", default_file)
         except IOError as e:
             logger.exception(f"Failed to create default Python file: {e}")
 
@@ -537,16 +3638,17 @@ def get_student_folder(student_name: str) -> str:
     safe_name = get_safe_name(student_name)
     return os.path.join(WORK_DIR, safe_name)
 
-def count_files_by_type(folder: str) -> Dict[str, int]:
+def count_files_by_type(folder: str, snapshot: Optional[FolderSnapshot] = None) -> Dict[str, int]:
     """Count files by type in a folder and its subdirectories.
 
     Args:
         folder: Path to the folder to analyze
+        snapshot: Scan of the folder already made (scanned now if not given)
 
     Returns:
         Dictionary with counts for different file types
     """
-    logger.debug(f"Counting files in {folder}")
+    logger.debug("Counting files in %s", folder)
     file_counts = {
         "python": 0,
         "text": 0,
@@ -556,23 +3658,470 @@ def count_files_by_type(folder: str) -> Dict[str, int]:
     }
 
     try:
-        for root, dirs, files in os.walk(folder):
-            file_counts["dirs"] += len(dirs)
-            for file in files:
-                file_counts["total"] += 1
-                if file.endswith('.py'):
-                    file_counts["python"] += 1
-                elif file.endswith('.txt'):
-                    file_counts["text"] += 1
-                else:
-                    file_counts["other"] += 1
+        if snapshot is None:
+            snapshot = scan_folder(folder)
+        file_counts = snapshot.count_by_type()
 
-        logger.debug(f"File counts: {file_counts}")
+        logger.debug("File counts: %s", file_counts)
     except Exception as e:
         logger.exception(f"Error counting files in {folder}: {e}")
 
     return file_counts
 
+def get_file_type(name: str) -> str:
+    """The type a file is counted as in the student's menu."""
+    if name.endswith('.py'):
+        return "python"
+    if name.endswith('.txt'):
+        return "text"
+    return "other"
+
+
+class FolderIndex:
+    """Persistent index of a student's folder: type, size and mtime per file.
+
+    The index is saved under the state folder and brought up to date by
+    listing only the folders whose mtime changed (adding, removing or
+    renaming a file changes its folder's mtime). Editing a file in place
+    doesn't, so refresh() also stats the files it knows about, unless an
+    InotifyWatcher is running and reporting exactly what changed.
+
+    Changes are written to a short journal, and the files as they were at
+    the last save are kept so the menu can show unsaved changes. Ignored
+    files and folders (see IgnoreRules) are left out, as they are from a save.
+    """
+
+    def __init__(self, folder: str, path: str):
+        self.folder = os.path.abspath(folder)
+        self.path = path
+        self.files: Dict[str, list] = {}  # rel -> [type, size, mtime_ns]
+        self.dirs: Dict[str, int] = {}  # rel ("" for the folder itself) -> mtime_ns
+        self.saved: Optional[Dict[str, list]] = None  # rel -> [size, mtime_ns] at last save
+        self.saved_at = 0  # time.time_ns() of the scan the last save was made from
+        self.journal: List[list] = []  # [time, event, rel], oldest first
+        self.rules = get_ignore_rules(self.folder)
+        self.rules_fingerprint = ""  # Of the rules the files were listed with
+        self._scanned_at = 0
+        self.watcher: Optional["InotifyWatcher"] = None
+        self._dirty: set = set()
+        self._lock = threading.RLock()
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data["folder"] == self.folder:
+                self.files = data["files"]
+                self.dirs = data["dirs"]
+                self.saved = data["saved"]
+                self.saved_at = data.get("saved_at", 0)
+                self.journal = data["journal"]
+                self.rules_fingerprint = data.get("rules", "")
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def save(self):
+        """Write the index to disk (errors are logged, it's only a cache)."""
+        with self._lock:
+            data = {"folder": self.folder, "files": self.files, "dirs": self.dirs,
+                    "saved": self.saved, "saved_at": self.saved_at, "journal": self.journal,
+                    "rules": self.rules_fingerprint}
+        tmp_path = f"{self.path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(json.dumps(data))
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Could not save folder index for {self.folder}: {e}")
+
+    def _record(self, event: str, rel: str):
+        self.journal.append([time.time(), event, rel])
+        del self.journal[:-FOLDER_INDEX_JOURNAL]
+
+    def _set_file(self, rel: str, size: int, mtime_ns: int) -> bool:
+        old = self.files.get(rel)
+        if old and old[1] == size and old[2] == mtime_ns:
+            return False
+        self.files[rel] = [get_file_type(rel), size, mtime_ns]
+        self._record("modified" if old else "added", rel)
+        return True
+
+    def _remove(self, rel: str) -> bool:
+        """Forget a file, or a folder and everything in it."""
+        changed = False
+        if rel in self.files:
+            del self.files[rel]
+            self._record("deleted", rel)
+            changed = True
+        prefix = f"{rel}/"
+        for name in [f for f in self.files if f.startswith(prefix)]:
+            del self.files[name]
+            self._record("deleted", name)
+            changed = True
+        for name in [d for d in self.dirs if d == rel or d.startswith(prefix)]:
+            del self.dirs[name]
+            changed = True
+        return changed
+
+    def _dir_mtime(self, st: os.stat_result, scan_started_ns: int) -> int:
+        # A folder changed in the same clock tick as the scan could change
+        # again without its mtime moving; store -1 so it is listed next time
+        return -1 if st.st_mtime_ns >= scan_started_ns - 2_000_000_000 else st.st_mtime_ns
+
+    def _scan_dir(self, rel_dir: str) -> bool:
+        """List one folder and update its entries (new subfolders in full)."""
+        path = os.path.join(self.folder, rel_dir) if rel_dir else self.folder
+        scan_started_ns = time.time_ns()
+        try:
+            st = os.stat(path)
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError:
+            return self._remove(rel_dir) if rel_dir else False
+        if rel_dir and self.rules.is_virtualenv(entry.name for entry in entries):
+            return self._remove(rel_dir)
+        self.dirs[rel_dir] = self._dir_mtime(st, scan_started_ns)
+
+        changed = False
+        seen_files, seen_dirs = set(), set()
+        for entry in entries:
+            rel = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name in EXCLUDE_DIRS or self.rules.ignores(rel, True):
+                        continue
+                    seen_dirs.add(rel)
+                    if rel not in self.dirs:
+                        self._scan_dir(rel)
+                        # A new folder is a change, unless it turned out to be a virtualenv
+                        changed = changed or rel in self.dirs
+                elif not (entry.is_symlink() and entry.is_dir()) and not self.rules.ignores(rel):
+                    entry_st = entry.stat()
+                    seen_files.add(rel)
+                    changed = self._set_file(rel, entry_st.st_size, entry_st.st_mtime_ns) or changed
+            except OSError:
+                continue
+
+        prefix = f"{rel_dir}/" if rel_dir else ""
+        for rel in [f for f in self.files if f.startswith(prefix)
+                    and "/" not in f[len(prefix):] and f not in seen_files]:
+            changed = self._remove(rel) or changed
+        for rel in [d for d in self.dirs if d and d.startswith(prefix)
+                    and "/" not in d[len(prefix):] and d not in seen_dirs]:
+            changed = self._remove(rel) or changed
+        return changed
+
+    def _refresh_file(self, rel: str) -> bool:
+        try:
+            st = os.stat(os.path.join(self.folder, rel))
+        except OSError:
+            return self._remove(rel)
+        is_dir = os.path.isdir(os.path.join(self.folder, rel))
+        if self.rules.ignores(rel, is_dir):
+            return self._remove(rel)
+        if is_dir:
+            return self._scan_dir(rel)
+        return self._set_file(rel, st.st_size, st.st_mtime_ns)
+
+    def _check_rules(self):
+        """List every folder again if the ignore rules have changed."""
+        watching = self.watcher is not None and self.watcher.is_alive()
+        if watching and self.rules_fingerprint and IGNORE_FILE not in self._dirty:
+            return  # The watcher reports edits to the ignore file
+        self.rules = get_ignore_rules(self.folder)
+        if self.rules.fingerprint != self.rules_fingerprint:
+            if self.rules_fingerprint:
+                logger.info(f"Ignore rules for {self.folder} changed, listing it again")
+                if watching:
+                    # It isn't watching folders that are no longer ignored
+                    self.watcher.stop()
+                    self.watcher = None
+            self.rules_fingerprint = self.rules.fingerprint
+            self.dirs = {rel: -1 for rel in self.dirs}
+
+    def mark_dirty(self, rel: str):
+        """Note that a path changed (called by the watcher)."""
+        with self._lock:
+            self._dirty.add(rel)
+
+    def refresh(self, check_files: bool = True) -> bool:
+        """Bring the index up to date with the folder.
+
+        Args:
+            check_files: Also stat known files for edits made in place
+                (not needed while a watcher is running)
+
+        Returns:
+            True if anything changed
+        """
+        with self._lock:
+            start = time.perf_counter()
+            self._scanned_at = time.time_ns()
+            self._check_rules()
+            changed = False
+            if self.watcher is not None and self.watcher.is_alive() and self.dirs:
+                dirty, self._dirty = self._dirty, set()
+                for rel in sorted(dirty):
+                    if rel in self.dirs:
+                        changed = self._scan_dir(rel) or changed
+                    else:
+                        changed = self._refresh_file(rel) or changed
+                mode = f"{len(dirty)} watched change(s)"
+            elif not self.dirs:
+                changed = self._scan_dir("")
+                mode = "full scan"
+            else:
+                listed = 0
+                for rel_dir, mtime_ns in list(self.dirs.items()):
+                    if rel_dir not in self.dirs:
+                        continue  # Removed with its parent
+                    path = os.path.join(self.folder, rel_dir) if rel_dir else self.folder
+                    try:
+                        current = os.stat(path).st_mtime_ns
+                    except OSError:
+                        current = None
+                    if current is None or current != mtime_ns:
+                        listed += 1
+                        changed = self._scan_dir(rel_dir) or changed
+                if check_files:
+                    for rel in list(self.files):
+                        try:
+                            st = os.stat(os.path.join(self.folder, rel))
+                        except OSError:
+                            changed = self._remove(rel) or changed
+                            continue
+                        changed = self._set_file(rel, st.st_size, st.st_mtime_ns) or changed
+                mode = f"{listed} of {len(self.dirs)} folder(s) listed"
+            if changed:
+                self.save()
+            logger.debug("Folder index for %s refreshed (%s) in %.1f ms",
+                         self.folder, mode, (time.perf_counter() - start) * 1000)
+            return changed
+
+    def update_from_snapshot(self, snapshot: FolderSnapshot):
+        """Take the files from a scan already made (e.g. for a save)."""
+        with self._lock:
+            for rel in [f for f in self.files if f not in snapshot.files]:
+                self._remove(rel)
+            for rel, (size, mtime_ns) in snapshot.files.items():
+                self._set_file(rel, size, mtime_ns)
+            scan_started_ns = time.time_ns()
+            self._scanned_at = snapshot.scanned_at
+            self.rules = get_ignore_rules(self.folder)
+            self.rules_fingerprint = self.rules.fingerprint
+            dirs = {}
+            for rel_dir in ["", *snapshot.dirs]:
+                path = os.path.join(self.folder, rel_dir) if rel_dir else self.folder
+                try:
+                    dirs[rel_dir] = self._dir_mtime(os.stat(path), scan_started_ns)
+                except OSError:
+                    continue
+            self.dirs = dirs
+            self._dirty.clear()
+            self.save()
+
+    def count_by_type(self) -> Dict[str, int]:
+        """Count files by type, as count_files_by_type does."""
+        with self._lock:
+            counts = {"python": 0, "text": 0, "other": 0, "total": len(self.files),
+                      "dirs": max(0, len(self.dirs) - 1)}
+            for file_type, _, _ in self.files.values():
+                counts[file_type] += 1
+            return counts
+
+    def recent_files(self, limit: int = 3) -> List[str]:
+        """The most recently modified files, newest first."""
+        with self._lock:
+            return sorted(self.files, key=lambda rel: self.files[rel][2], reverse=True)[:limit]
+
+    def unsaved_changes(self) -> Dict[str, List[str]]:
+        """Files added, modified or deleted since the last save."""
+        with self._lock:
+            saved = self.saved or {}
+            changes = {"added": [], "modified": [], "deleted": []}
+            for rel, (_, size, mtime_ns) in self.files.items():
+                if rel not in saved:
+                    changes["added"].append(rel)
+                elif saved[rel] != [size, mtime_ns]:
+                    changes["modified"].append(rel)
+            changes["deleted"] = [rel for rel in saved if rel not in self.files]
+            for files in changes.values():
+                files.sort()
+            return changes
+
+    def is_saved(self) -> bool:
+        """Check quickly whether the folder still matches its last save.
+
+        Only stats are used, so this takes milliseconds even for a large
+        folder. A file modified within two seconds of the save could have
+        changed again without its size or mtime changing, so it always
+        counts as unsaved; the full save that follows settles it.
+        """
+        with self._lock:
+            self.refresh()
+            if not self.files or self.saved is None or any(self.unsaved_changes().values()):
+                return False
+            racy_after = self.saved_at - 2_000_000_000
+            return all(mtime_ns < racy_after for _, _, mtime_ns in self.files.values())
+
+    def mark_saved(self):
+        """Remember the files as of the last refresh or snapshot as saved."""
+        with self._lock:
+            self.saved = {rel: [size, mtime_ns] for rel, (_, size, mtime_ns) in self.files.items()}
+            self.saved_at = self._scanned_at
+            self._record("saved", "")
+            self.save()
+
+
+class InotifyWatcher(threading.Thread):
+    """Reports changes in a student's folder to its FolderIndex as they happen.
+
+    Uses the Linux inotify API through ctypes. Create it with start_folder_watcher(),
+    which returns None where inotify isn't available.
+    """
+
+    _IN_MODIFY = 0x2
+    _IN_ATTRIB = 0x4
+    _IN_CLOSE_WRITE = 0x8
+    _IN_MOVED_FROM = 0x40
+    _IN_MOVED_TO = 0x80
+    _IN_CREATE = 0x100
+    _IN_DELETE = 0x200
+    _IN_DELETE_SELF = 0x400
+    _IN_Q_OVERFLOW = 0x4000
+    _IN_IGNORED = 0x8000
+    _IN_ISDIR = 0x40000000
+    _MASK = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO
+             | _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF)
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self, index: FolderIndex):
+        super().__init__(name="FolderWatcher", daemon=True)
+        import ctypes
+        import ctypes.util
+        self.index = index
+        self._ctypes = ctypes
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._watches: Dict[int, str] = {}
+        self._stopping = threading.Event()
+        self._watch_tree("")
+
+    def _watch_tree(self, rel_dir: str):
+        path = os.path.join(self.index.folder, rel_dir) if rel_dir else self.index.folder
+        rules = self.index.rules
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), self._MASK)
+        if wd < 0:
+            logger.debug("Could not watch %s: errno %s", path, self._ctypes.get_errno())
+            return
+        try:
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError:
+            entries = []
+        if rel_dir and rules.is_virtualenv(entry.name for entry in entries):
+            self._libc.inotify_rm_watch(self._fd, wd)
+            return
+        self._watches[wd] = rel_dir
+        for entry in entries:
+            rel = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            try:
+                if (entry.is_dir(follow_symlinks=False) and entry.name not in EXCLUDE_DIRS
+                        and not rules.ignores(rel, True)):
+                    self._watch_tree(rel)
+            except OSError:
+                continue
+
+    def _handle(self, data: bytes):
+        offset = 0
+        while offset + self._EVENT.size <= len(data):
+            wd, mask, _, length = self._EVENT.unpack_from(data, offset)
+            name = data[offset + self._EVENT.size:offset + self._EVENT.size + length]
+            name = os.fsdecode(name.rstrip(b"\0"))
+            offset += self._EVENT.size + length
+
+            if mask & self._IN_Q_OVERFLOW:
+                # Events were lost: have the next refresh list every folder
+                logger.warning("Folder watcher overflowed, falling back to scanning")
+                self.stop()
+                return
+            rel_dir = self._watches.get(wd)
+            if rel_dir is None:
+                continue
+            if mask & self._IN_IGNORED:
+                del self._watches[wd]
+                continue
+            if not name:
+                continue
+            rel = f"{rel_dir}/{name}" if rel_dir else name
+            if mask & self._IN_ISDIR:
+                if name in EXCLUDE_DIRS or self.index.rules.ignores(rel, True):
+                    continue
+                if mask & (self._IN_CREATE | self._IN_MOVED_TO):
+                    self._watch_tree(rel)
+                # The folder's listing changed
+                self.index.mark_dirty(rel_dir)
+            else:
+                self.index.mark_dirty(rel)
+
+    def run(self):
+        try:
+            while not self._stopping.is_set():
+                ready, _, _ = select.select([self._fd], [], [], 0.5)
+                if ready:
+                    try:
+                        self._handle(os.read(self._fd, 64 * 1024))
+                    except BlockingIOError:
+                        continue
+        except Exception as e:
+            logger.exception(f"Folder watcher error: {e}")
+        finally:
+            os.close(self._fd)
+            logger.debug("Stopped watching %s", self.index.folder)
+
+    def stop(self):
+        """Stop watching; the index goes back to checking folder mtimes."""
+        self._stopping.set()
+
+
+_folder_indexes: Dict[str, FolderIndex] = {}
+
+def get_folder_index(safe_name: str) -> FolderIndex:
+    """Get the index of a student's folder, loading it from disk once per run."""
+    folder = os.path.abspath(os.path.join(WORK_DIR, safe_name))
+    index = _folder_indexes.get(safe_name)
+    if index is None or index.folder != folder:
+        path = os.path.join(get_state_dir(FOLDER_INDEX_SUBDIR), f"{safe_name}.json")
+        index = FolderIndex(folder, path)
+        _folder_indexes[safe_name] = index
+    return index
+
+def start_folder_watcher(safe_name: str) -> Optional[InotifyWatcher]:
+    """Keep a student's folder index live for this session, if inotify is available.
+
+    Returns:
+        The running watcher, or None (the index then checks folder mtimes)
+    """
+    index = get_folder_index(safe_name)
+    if not FOLDER_INDEX_WATCH or not sys.platform.startswith("linux"):
+        return None
+    if index.watcher is not None and index.watcher.is_alive():
+        return index.watcher
+    try:
+        watcher = InotifyWatcher(index)
+    except (OSError, AttributeError) as e:
+        logger.info(f"Not watching {index.folder} ({e}), will check folder mtimes instead")
+        return None
+    # Watching started first, so nothing changed during this check is missed
+    index.refresh()
+    index.watcher = watcher
+    watcher.start()
+    logger.info(f"Watching {index.folder} for changes ({len(watcher._watches)} folder(s))")
+    return watcher
+
 def load_student_code(student_name: str) -> bool:
     """Load the student's code (just print the path without opening editor).
 
@@ -590,8 +4139,10 @@ def load_student_code(student_name: str) -> bool:
         logger.info(f"Student folder doesn't exist, creating: {student_folder}")
         create_student_folder(student_name)
 
-    # Count files by type
-    file_counts = count_files_by_type(student_folder)
+    # Count files by type from the folder index: only changed folders are listed
+    index = get_folder_index(get_safe_name(student_name))
+    index.refresh(check_files=False)
+    file_counts = index.count_by_type()
 
     if file_counts["total"] > 0:
         print("\nYour folder contains:")
@@ -627,29 +4178,849 @@ print("Hello from Tramore Code Club!")
 
     return True
 
-def create_backup(student_folder: str, safe_name: str) -> Optional[str]:
+def get_backup_object_path(digest: str) -> str:
+    """Get the path where a blob with the given hash is stored."""
+    return os.path.join(BACKUP_DIR, BACKUP_OBJECTS_SUBDIR, digest[:2], digest[2:])
+
+def store_backup_object(src_path: str, digest: str,
+                        stat: Optional[Tuple[int, int]] = None) -> Tuple[str, int]:
+    """Copy a file into the backup object store unless it is already there.
+
+    The copy is hashed again once written, so a file that changed while it
+    was being copied is stored under the hash of what was actually saved.
+    That second read is skipped when the file's size and mtime still match
+    the ones it was hashed with and it was last modified well before the
+    copy started (the same check update_manifest trusts).
+
+    Args:
+        src_path: File to store
+        digest: Expected content hash of the file
+        stat: (size, mtime_ns) the file had when digest was worked out
+
+    Returns:
+        Tuple of (hash stored under, bytes written - 0 if already stored)
+    """
+    object_path = get_backup_object_path(digest)
+    if os.path.exists(object_path):
+        return digest, 0
+
+    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+    tmp_path = f"{object_path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    copy_started_ns = time.time_ns()
+    # Never a hard link: the student's next edit would change the backup
+    copy_file(src_path, tmp_path, metadata=False)
+    st = os.stat(src_path)
+    if stat == (st.st_size, st.st_mtime_ns) and st.st_mtime_ns < copy_started_ns - 2_000_000_000:
+        actual = digest
+    else:
+        actual = hash_file(tmp_path)
+    if actual != digest:
+        logger.warning(f"{src_path} changed while backing up, storing new content")
+        object_path = get_backup_object_path(actual)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+    os.chmod(tmp_path, 0o444)
+    os.replace(tmp_path, object_path)
+    return actual, os.path.getsize(object_path)
+
+def list_backups(safe_name: str) -> List[str]:
+    """List a student's backup ids, oldest first.
+
+    Args:
+        safe_name: Safe name for the student
+
+    Returns:
+        Backup ids (timestamps in YYYYmmdd_HHMMSS_ffffff form)
+    """
+    folder = os.path.join(BACKUP_DIR, BACKUP_SNAPSHOTS_SUBDIR, safe_name)
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return []
+    return sorted(name[:-len(".json")] for name in names if name.endswith(".json"))
+
+def load_backup(safe_name: str, backup_id: str) -> Dict[str, list]:
+    """Load the file list of one backup.
+
+    Returns:
+        Mapping of relative path to [size, mtime_ns, hash]
+    """
+    path = os.path.join(BACKUP_DIR, BACKUP_SNAPSHOTS_SUBDIR, safe_name, f"{backup_id}.json")
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)["files"]
+
+@traced()
+def create_backup(student_folder: str, safe_name: str,
+                  snapshot: Optional[FolderSnapshot] = None, prune: bool = True) -> Optional[str]:
     """Create a backup of student files.
 
+    Each unique file content is stored once in the backup object store and
+    the backup itself is a small snapshot listing which content each path
+    had. Only files whose content isn't stored yet are copied, so a backup
+    costs about as much as the changes since the last one.
+
     Args:
         student_folder: Path to student's folder
         safe_name: Safe name for the student
+        snapshot: Scan of the student's folder already made for this save
+        prune: Apply the retention policy afterwards. Pass False when other
+            threads are backing up too: collecting garbage would delete the
+            objects they have stored but not yet listed in a snapshot.
 
     Returns:
-        Path to backup folder if successful, None otherwise
+        Path to the snapshot file if successful, None otherwise
     """
     try:
-        timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_folder = os.path.join(BACKUP_DIR, safe_name, timestamp)
-        os.makedirs(backup_folder, exist_ok=True)
-
-        # Copy entire directory structure to backup
-        file_count = copy_all_files(student_folder, backup_folder)
-        logger.info(f"Created backup at {backup_folder} with {file_count} files")
-        return backup_folder
+        manifest = update_manifest(student_folder, snapshot=snapshot)
+        files = {}
+        stored_bytes = 0
+        for rel, (size, mtime_ns, digest) in manifest.items():
+            digest, written = store_backup_object(os.path.join(student_folder, rel), digest,
+                                                  (size, mtime_ns))
+            stored_bytes += written
+            files[rel] = [size, mtime_ns, digest]
+
+        snapshot_dir = os.path.join(BACKUP_DIR, BACKUP_SNAPSHOTS_SUBDIR, safe_name)
+        os.makedirs(snapshot_dir, exist_ok=True)
+        previous = list_backups(safe_name)
+        if previous and load_backup(safe_name, previous[-1]) == files:
+            snapshot_path = os.path.join(snapshot_dir, f"{previous[-1]}.json")
+            logger.info(f"Files unchanged since backup {previous[-1]}, not adding another")
+            return snapshot_path
+
+        backup_id = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        snapshot_path = os.path.join(snapshot_dir, f"{backup_id}.json")
+        with open(f"{snapshot_path}.tmp", "w", encoding="utf-8") as f:
+            f.write(json.dumps({"student_folder": student_folder, "files": files}))
+        os.replace(f"{snapshot_path}.tmp", snapshot_path)
+        trace_add("bytes_copied", stored_bytes)
+        logger.info(
+            f"Created backup {backup_id} for {safe_name} with {len(files)} files "
+            f"({stored_bytes} new bytes stored)"
+        )
+
+        if prune:
+            prune_backups(safe_name)
+        return snapshot_path
     except Exception as e:
         logger.exception(f"Failed to create backup: {e}")
         return None
 
+def select_backups_to_keep(backup_ids: List[str], keep_last: int, keep_daily: int,
+                           keep_weekly: int) -> set:
+    """Pick which backups a keep-last/daily/weekly retention policy keeps.
+
+    Args:
+        backup_ids: Backup ids (timestamps) in any order
+        keep_last: Number of newest backups to keep
+        keep_daily: Number of days to keep the newest backup of
+        keep_weekly: Number of weeks to keep the newest backup of
+
+    Returns:
+        Set of backup ids to keep
+    """
+    newest_first = sorted(backup_ids, reverse=True)
+    keep = set(newest_first[:keep_last])
+
+    days, weeks = [], []
+    for backup_id in newest_first:
+        when = datetime.datetime.strptime(backup_id[:15], "%Y%m%d_%H%M%S")
+        day = when.date()
+        week = when.isocalendar()[:2]
+        if day not in days and len(days) < keep_daily:
+            days.append(day)
+            keep.add(backup_id)
+        if week not in weeks and len(weeks) < keep_weekly:
+            weeks.append(week)
+            keep.add(backup_id)
+    return keep
+
+def prune_backups(safe_name: str, collect_garbage: bool = True) -> int:
+    """Delete a student's backups that the retention policy no longer keeps.
+
+    Args:
+        safe_name: Safe name for the student
+        collect_garbage: Delete the stored objects that are no longer used
+
+    Returns:
+        Number of backups deleted
+    """
+    backup_ids = list_backups(safe_name)
+    keep = select_backups_to_keep(backup_ids, BACKUP_KEEP_LAST, BACKUP_KEEP_DAILY,
+                                  BACKUP_KEEP_WEEKLY)
+    snapshot_dir = os.path.join(BACKUP_DIR, BACKUP_SNAPSHOTS_SUBDIR, safe_name)
+    removed = 0
+    for backup_id in backup_ids:
+        if backup_id not in keep:
+            os.remove(os.path.join(snapshot_dir, f"{backup_id}.json"))
+            removed += 1
+
+    if removed:
+        logger.info(f"Removed {removed} old backup(s) for {safe_name}")
+        if collect_garbage:
+            collect_backup_garbage()
+    return removed
+
+def collect_backup_garbage() -> int:
+    """Delete stored blobs that no backup refers to any more.
+
+    Returns:
+        Number of blobs deleted
+    """
+    snapshots_root = os.path.join(BACKUP_DIR, BACKUP_SNAPSHOTS_SUBDIR)
+    objects_root = os.path.join(BACKUP_DIR, BACKUP_OBJECTS_SUBDIR)
+    if not os.path.isdir(snapshots_root) or not os.path.isdir(objects_root):
+        return 0
+
+    in_use = set()
+    for safe_name in os.listdir(snapshots_root):
+        for backup_id in list_backups(safe_name):
+            in_use.update(entry[2] for entry in load_backup(safe_name, backup_id).values())
+
+    removed = 0
+    for prefix in os.listdir(objects_root):
+        prefix_dir = os.path.join(objects_root, prefix)
+        for name in os.listdir(prefix_dir):
+            if prefix + name not in in_use:
+                os.remove(os.path.join(prefix_dir, name))
+                removed += 1
+    logger.info(f"Removed {removed} unused backup object(s)")
+    return removed
+
+def restore_backup(safe_name: str, backup_id: Optional[str] = None,
+                   target_dir: Optional[str] = None) -> Optional[str]:
+    """Restore a student's backup into a folder.
+
+    Args:
+        safe_name: Safe name for the student
+        backup_id: Backup to restore (default: the newest)
+        target_dir: Where to restore to (default: a new folder next to the
+            student's folder, so current work is never overwritten)
+
+    Returns:
+        Path to the restored folder, or None if there was nothing to restore
+    """
+    backup_ids = list_backups(safe_name)
+    if backup_id is None and backup_ids:
+        backup_id = backup_ids[-1]
+    if backup_id not in backup_ids:
+        logger.error(f"No backup {backup_id} for {safe_name}")
+        return None
+
+    if target_dir is None:
+        target_dir = os.path.join(WORK_DIR, f"{safe_name}-restored-{backup_id}")
+
+    for rel, (_, mtime_ns, digest) in load_backup(safe_name, backup_id).items():
+        dest_path = os.path.join(target_dir, rel)
+        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+        copy_file(get_backup_object_path(digest), dest_path, metadata=False)
+        os.utime(dest_path, ns=(mtime_ns, mtime_ns))
+
+    logger.info(f"Restored backup {backup_id} for {safe_name} to {target_dir}")
+    return target_dir
+
+class PushQueue:
+    """Branches waiting to be pushed, kept on disk so none are forgotten.
+
+    Each branch appears at most once, however many times it was saved: a
+    push sends all of a branch's commits, so queued saves of the same
+    branch are coalesced into one push.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, float]] = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._entries = json.load(f)["branches"]
+        except (OSError, ValueError, KeyError):
+            self._entries = {}
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"branches": self._entries}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"Could not save upload queue: {e}")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def add(self, branch_name: str):
+        """Queue a branch for pushing, or make an already queued one due now."""
+        with self._lock:
+            entry = self._entries.setdefault(
+                branch_name, {"queued_at": time.time(), "attempts": 0}
+            )
+            entry["next_try"] = time.time()
+            entry["saves"] = entry.get("saves", 0) + 1
+            self._save()
+
+    def saves(self, branch_name: str) -> int:
+        """How many times a queued branch has been added (0 if not queued)."""
+        with self._lock:
+            return self._entries.get(branch_name, {}).get("saves", 0)
+
+    def due(self) -> List[str]:
+        """Branches whose next attempt is due."""
+        now = time.time()
+        with self._lock:
+            return [name for name, entry in self._entries.items() if entry["next_try"] <= now]
+
+    def next_due_in(self) -> Optional[float]:
+        """Seconds until the next attempt, or None if the queue is empty."""
+        with self._lock:
+            if not self._entries:
+                return None
+            return max(0.0, min(e["next_try"] for e in self._entries.values()) - time.time())
+
+    def retry_now(self):
+        """Make every queued branch due immediately, skipping its backoff."""
+        with self._lock:
+            for entry in self._entries.values():
+                entry["next_try"] = time.time()
+            self._save()
+
+    def done(self, branch_name: str, saves: Optional[int] = None):
+        """Remove a branch that was pushed.
+
+        Args:
+            branch_name: The branch
+            saves: saves() from before the push; if the branch was saved
+                again while it was being pushed, it stays queued
+        """
+        with self._lock:
+            entry = self._entries.get(branch_name)
+            if entry is None or (saves is not None and entry.get("saves", 0) != saves):
+                return
+            del self._entries[branch_name]
+            self._save()
+
+    def failed(self, branch_name: str) -> float:
+        """Schedule a retry with exponential backoff.
+
+        Returns:
+            Seconds until the next attempt
+        """
+        with self._lock:
+            entry = self._entries.get(branch_name)
+            if entry is None:
+                return 0.0
+            delay = min(PUSH_RETRY_MAX, PUSH_RETRY_BASE * 2 ** entry["attempts"])
+            entry["attempts"] += 1
+            entry["next_try"] = time.time() + delay
+            self._save()
+            return delay
+
+
+def parse_push_results(output: str) -> Dict[str, bool]:
+    """Read per-branch results from `git push --porcelain` output.
+
+    Returns:
+        Mapping of branch name to whether its push succeeded
+    """
+    results = {}
+    for line in output.splitlines():
+        parts = line.split("\t")
+        if len(parts) < 3 or len(parts[0]) != 1 or ":" not in parts[1]:
+            continue
+        dest = parts[1].split(":", 1)[1]
+        if dest.startswith("refs/heads/"):
+            # Anything but "!" (rejected) means the remote has our commits
+            results[dest[len("refs/heads/"):]] = parts[0] != "!"
+    return results
+
+
+def push_branches(session: GitSession, branches: List[str]) -> Dict[str, bool]:
+    """Push several branches to origin with a single git push.
+
+    Returns:
+        Mapping of branch name to whether it reached the remote
+    """
+    success, output = session.git("push", "--porcelain", "-u", "origin", *branches)
+    results = parse_push_results(output)
+    return {branch: results.get(branch, success) for branch in branches}
+
+
+class PushWorker(threading.Thread):
+    """Background thread that drains the push queue.
+
+    All due branches are sent in one `git push`, failures are retried with
+    exponential backoff, and the menu stays responsive meanwhile.
+    """
+
+    def __init__(self, queue: PushQueue, repo_path: str):
+        super().__init__(name="PushWorker", daemon=True)
+        self.queue = queue
+        # Its own session, so the menu's cached state isn't touched mid-call
+        self.session = GitSession(repo_path)
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+
+    def wake(self):
+        """Check the queue now (e.g. after a save)."""
+        self._wake.set()
+
+    def stop(self):
+        """Ask the thread to finish after its current push."""
+        self._stopping.set()
+        self._wake.set()
+
+    def process_due(self) -> int:
+        """Push every branch that is due.
+
+        Returns:
+            Number of branches pushed
+        """
+        branches = self.queue.due()
+        if not branches:
+            return 0
+        # Waits for the session's setup, which may repair or clone the repository again
+        if not get_app().ensure_repository(quiet=True):
+            for branch in branches:
+                self.queue.failed(branch)
+            logger.warning("Uploads waiting: the repository isn't ready")
+            return 0
+        saves = {branch: self.queue.saves(branch) for branch in branches}
+        with _repo_activity.using():
+            results = push_branches(self.session, branches)
+            self.session.invalidate()
+            refs = self.session.refs() if any(results.values()) else {}
+        pushed = 0
+        for branch in branches:
+            if results[branch]:
+                # Record it before dequeuing, so flush() waiters see both
+                get_git_session().record_push(branch, refs.get(f"refs/heads/{branch}", ""))
+                self.queue.done(branch, saves[branch])
+                pushed += 1
+                logger.info(f"Uploaded {branch}")
+            else:
+                delay = self.queue.failed(branch)
+                logger.warning(f"Upload of {branch} failed, retrying in {delay:.0f}s")
+        return pushed
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                self.process_due()
+            except Exception as e:
+                logger.exception(f"Upload worker error: {e}")
+            self._wake.wait(timeout=self.queue.next_due_in())
+            self._wake.clear()
+
+    def flush(self, timeout: float) -> bool:
+        """Retry everything now and wait for the queue to empty.
+
+        Returns:
+            True if everything was uploaded within the timeout
+        """
+        deadline = time.time() + timeout
+        self.queue.retry_now()
+        self.wake()
+        while len(self.queue) and time.time() < deadline:
+            time.sleep(0.05)
+        return len(self.queue) == 0
+
+
+_push_worker: Optional[PushWorker] = None
+
+def get_push_worker() -> PushWorker:
+    """Get the running upload worker, starting it if needed.
+
+    Uploads queued by an earlier run that didn't finish are sent as soon
+    as the worker starts.
+    """
+    global _push_worker
+    repo_path = os.path.join(WORK_DIR, REPO_NAME)
+    if _push_worker is None or not _push_worker.is_alive() \
+            or _push_worker.session.repo_path != repo_path:
+        queue = PushQueue(os.path.join(get_state_dir(), PUSH_QUEUE_FILE))
+        _push_worker = PushWorker(queue, repo_path)
+        _push_worker.start()
+    return _push_worker
+
+def queue_push(branch_name: str):
+    """Queue a branch for uploading in the background."""
+    worker = get_push_worker()
+    worker.queue.add(branch_name)
+    worker.wake()
+    logger.info(f"Queued {branch_name} for upload ({len(worker.queue)} waiting)")
+
+OBJECT_TYPES = {"40000": "tree", "160000": "commit"}  # Tree entry mode -> object type
+
+def _tree_sort_key(entry: Tuple[str, str, str]) -> str:
+    """Git orders a folder's entries by name, with folders compared as "name/"."""
+    mode, name, _ = entry
+    return name + "/" if mode == "40000" else name
+
+def _tree_id(entries: List[Tuple[str, str, str]]) -> str:
+    """The id git gives a tree of (mode, name, id) entries, already sorted."""
+    body = b"".join(f"{mode} {name}".encode("utf-8", "surrogateescape") + b"\0" + bytes.fromhex(sha)
+                    for mode, name, sha in entries)
+    return hashlib.sha1(b"tree %d\0" % len(body) + body).hexdigest()
+
+def get_link_blob_id(target: str) -> str:
+    """The id git gives the blob of a symlink, which holds the link's target."""
+    data = os.fsencode(target)
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+def build_trees(manifest: Dict[str, list], executable: set,
+                links: Optional[Dict[str, str]] = None
+                ) -> Dict[str, Tuple[str, List[Tuple[str, str, str]]]]:
+    """Work out the git trees for a folder from its manifest, without running git.
+
+    Args:
+        manifest: Relative path -> [size, mtime_ns, blob id], from update_manifest()
+        executable: Relative paths with the executable bit set
+        links: Relative path -> blob id of the target, for symlinks (these
+            are stored as links, as `git add` does, not as the files they
+            point to)
+
+    Returns:
+        {folder: (tree id, entries)}, deepest folders first; "" is the folder itself
+    """
+    links = links or {}
+    entries = [(rel, "100755" if rel in executable else "100644", sha)
+               for rel, (_, _, sha) in manifest.items() if rel not in links]
+    entries.extend((rel, "120000", sha) for rel, sha in links.items())
+    children: Dict[str, List[Tuple[str, str, str]]] = collections.defaultdict(list)
+    for rel, mode, sha in entries:
+        folder, _, name = rel.rpartition("/")
+        children[folder].append((mode, name, sha))
+        # Make sure every folder on the way up is listed
+        while folder:
+            folder = folder.rpartition("/")[0]
+            children.setdefault(folder, [])
+
+    trees = {}
+    for folder in sorted(children, key=lambda f: f.count("/") + bool(f), reverse=True):
+        entries = sorted(children[folder], key=_tree_sort_key)
+        sha = _tree_id(entries)
+        trees[folder] = (sha, entries)
+        if folder:
+            parent, _, name = folder.rpartition("/")
+            children[parent].append(("40000", name, sha))
+    return trees
+
+def _read_tree(session: GitSession, treeish: str, path: str = "") -> List[Tuple[str, str, str]]:
+    """List one tree's entries as (mode, name, id) with `git ls-tree`."""
+    args = ["ls-tree", "-z", treeish]
+    if path:
+        args.append(f"{path}/")
+    success, output = session.git(*args)
+    if not success:
+        return []
+    entries = []
+    for record in output.split("\0"):
+        if record:
+            info, name = record.split("\t", 1)
+            mode, _, sha = info.split()
+            entries.append((mode.lstrip("0"), name.rpartition("/")[2], sha))
+    return entries
+
+def _replace_entry(entries: List[Tuple[str, str, str]], name: str,
+                   sha: Optional[str]) -> List[Tuple[str, str, str]]:
+    """A tree's entries with one folder replaced (or removed when sha is None)."""
+    entries = [entry for entry in entries if entry[1] != name]
+    if sha:
+        entries.append(("40000", name, sha))
+    return sorted(entries, key=_tree_sort_key)
+
+def _commit_cache_path(safe_name: str) -> str:
+    return os.path.join(get_state_dir("commits"), f"{safe_name}.json")
+
+def load_commit_cache(safe_name: str, commit: str) -> dict:
+    """What the student's last plumbing commit contained, if it's still the branch tip.
+
+    Returns:
+        {"objects": ids in the commit's student folder, "root": and
+        "students": entries of the two trees above it}, or {} if unknown
+    """
+    try:
+        with open(_commit_cache_path(safe_name), "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data["commit"] == commit:
+            return {"objects": set(data["objects"]),
+                    "root": [tuple(entry) for entry in data["root"]],
+                    "students": [tuple(entry) for entry in data["students"]]}
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return {}
+
+def save_commit_cache(safe_name: str, commit: str, objects: set, root: list, students: list):
+    """Remember what a commit contained (errors are logged, it's only a cache)."""
+    path = _commit_cache_path(safe_name)
+    try:
+        with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+            f.write(json.dumps({"commit": commit, "objects": sorted(objects),
+                                "root": root, "students": students}))
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        logger.warning(f"Could not save commit cache for {safe_name}: {e}")
+
+@traced()
+def commit_student_tree(safe_name: str, branch_name: str, commit_msg: str,
+                        snapshot: Optional[FolderSnapshot] = None) -> Tuple[str, str]:
+    """Commit a student's folder to their branch with git plumbing.
+
+    The trees are worked out from the folder's manifest of blob ids, so
+    nothing is copied into the clone and no branch is checked out. Only
+    files and folders that changed since the last save are written:
+    `hash-object -w --stdin-paths` for files, one `mktree --batch` for
+    folders. Then `commit-tree` and `update-ref` move the branch, and a
+    checkout of the branch (if there is one) has its index brought up to
+    date.
+
+    Args:
+        safe_name: Safe name for the student
+        branch_name: The git branch name for this student
+        commit_msg: Commit message
+        snapshot: Scan of the student's folder already made
+
+    Returns:
+        Tuple of (status, output) where status is "committed", "unchanged"
+        or "failed"
+    """
+    student_folder = os.path.abspath(os.path.join(WORK_DIR, safe_name))
+    session = get_git_session()
+    if snapshot is None:
+        snapshot = scan_folder(student_folder)
+    manifest = update_manifest(student_folder, snapshot=snapshot)
+
+    # The commit goes on top of the branch, or starts from main for a new student
+    refs = session.refs()
+    ref = f"refs/heads/{branch_name}"
+    old = refs.get(ref, "")
+    parent = (old or refs.get(f"refs/remotes/origin/{branch_name}")
+              or refs.get(f"refs/heads/{MAIN_BRANCH}") or refs.get(f"refs/remotes/origin/{MAIN_BRANCH}"))
+    if not parent:
+        return "failed", f"No commit to start {branch_name} from"
+
+    links = {rel: get_link_blob_id(target) for rel, target in snapshot.symlinks.items()}
+    trees = build_trees(manifest, snapshot.executable, links)
+    student_tree = trees[""][0] if trees else None
+    cache = load_commit_cache(safe_name, parent)
+    if cache:
+        root_entries, students_entries = cache["root"], cache["students"]
+    else:
+        root_entries = _read_tree(session, parent)
+        has_students = any(name == STUDENTS_SUBDIR for _, name, _ in root_entries)
+        students_entries = _read_tree(session, parent, STUDENTS_SUBDIR) if has_students else []
+    if student_tree == next((sha for _, name, sha in students_entries if name == safe_name), None):
+        if not old and session.git("update-ref", ref, parent, "0" * 40)[0]:
+            session.set_ref(ref, parent)
+        return "unchanged", "nothing to commit"
+
+    # Name the folders by their path in the branch, then add the two above
+    trees = {"/".join(filter(None, (STUDENTS_SUBDIR, safe_name, folder))): tree
+             for folder, tree in trees.items()}
+    students_entries = _replace_entry(students_entries, safe_name, student_tree)
+    students_tree = _tree_id(students_entries) if students_entries else None
+    if students_tree:
+        trees[STUDENTS_SUBDIR] = (students_tree, students_entries)
+    root_entries = _replace_entry(root_entries, STUDENTS_SUBDIR, students_tree)
+    trees[""] = (_tree_id(root_entries), root_entries)
+
+    # Only write what's new since the last commit this laptop made.
+    # Writing an object git already has costs little, but asking git
+    # whether it has one would fetch it in a partial clone.
+    known = cache.get("objects", set())
+    blobs = {sha: os.path.join(student_folder, rel)
+             for rel, (_, _, sha) in manifest.items() if sha not in known and rel not in links}
+    new_links = {sha: rel for rel, sha in links.items() if sha not in known and sha not in blobs}
+    if blobs or new_links:
+        # hash-object would read the file a link points to, so each
+        # link's target is written to a file of its own and hashed
+        with tempfile.TemporaryDirectory(prefix="codeclub-links-") as link_dir:
+            for i, (sha, rel) in enumerate(new_links.items()):
+                blobs[sha] = os.path.join(link_dir, str(i))
+                with open(blobs[sha], "wb") as f:
+                    f.write(os.fsencode(snapshot.symlinks[rel]))
+            success, output = session.git("hash-object", "-w", "--stdin-paths",
+                                          input="\n".join(blobs.values()) + "\n")
+        if not success or output.split() != list(blobs):
+            # A file changed after it was hashed
+            return "failed", f"Files changed while saving: {output}"
+
+    new_trees = [folder for folder, (sha, _) in trees.items() if sha not in known]
+    if new_trees:
+        batch = "\0".join(
+            "".join(f"{mode} {OBJECT_TYPES.get(mode, 'blob')} {sha}\t{name}\0"
+                    for mode, name, sha in trees[folder][1])
+            for folder in new_trees)
+        success, output = session.git("mktree", "-z", "--batch", input=batch)
+        if not success or output.split() != [trees[folder][0] for folder in new_trees]:
+            return "failed", f"Unexpected trees from mktree: {output}"
+
+    success, output = session.git("commit-tree", trees[""][0], "-p", parent, "-m", commit_msg)
+    if not success:
+        return "failed", output
+    commit = output.strip()
+    success, output = session.git("update-ref", "-m", "codeclub: save", ref, commit, old or "0" * 40)
+    if not success:
+        session.invalidate()
+        return "failed", output
+    session.set_ref(ref, commit)
+
+    # A checkout of the branch still has the old commit in its index
+    if student_folder_in_worktree(safe_name):
+        # --reset: the files already match the commit, only the index is behind
+        session.git("read-tree", "--reset", commit, cwd=get_student_worktree(safe_name))
+    elif session.current_branch() == branch_name:
+        session.git("read-tree", "-m", "-u", parent, commit)
+
+    objects = {sha for rel, (_, _, sha) in manifest.items() if rel not in links}
+    objects.update(links.values())
+    objects.update(sha for folder, (sha, _) in trees.items()
+                   if folder.startswith(f"{STUDENTS_SUBDIR}/{safe_name}"))
+    save_commit_cache(safe_name, commit, objects, root_entries, students_entries)
+    logger.info(f"Committed {len(blobs)} new files and {len(new_trees)} folders for {safe_name}")
+    return "committed", commit
+
+def update_git_excludes(session: GitSession, safe_name: str, snapshot: FolderSnapshot,
+                        git_cwd: str) -> str:
+    """Make `git add` leave out the files a save leaves out.
+
+    git only reads .gitignore files, so the student's rules are written out
+    as an excludes file for their folder in the repository, along with any
+    virtualenvs the scan found (git can't tell those by their contents).
+    When the file changes, ignored files that were committed before are
+    taken out of the index, so the next commit drops them.
+
+    Args:
+        session: Git session for the repository
+        safe_name: Safe name for the student
+        snapshot: Scan of the student's folder
+        git_cwd: Checkout the student's folder is committed from
+
+    Returns:
+        Path of the excludes file, for core.excludesFile
+    """
+    prefix = f"{STUDENTS_SUBDIR}/{safe_name}"
+    rules = get_ignore_rules(snapshot.root)
+    lines = [f"# Written from {IGNORE_FILE} when saving {safe_name}; edits are lost",
+             *rules.gitignore_lines(prefix)]
+    for rel in snapshot.ignored:
+        if not rules.ignores(rel, True) and not rules.ignores(rel):
+            escaped = re.sub(r"([\\*?\[])", r"\\\1", rel)
+            lines.append(f"/{prefix}/{escaped}/")
+    content = "\n".join(lines) + "\n"
+
+    path = os.path.join(get_state_dir("excludes"), safe_name)
+    try:
+        with open(path, "r", encoding="utf-8", errors="surrogateescape") as f:
+            if f.read() == content:
+                return path
+    except OSError:
+        pass
+
+    if snapshot.ignored:
+        success, output = session.git(
+            "rm", "-r", "--cached", "-q", "--ignore-unmatch",
+            "--pathspec-from-file=-", "--pathspec-file-nul", cwd=git_cwd,
+            input="\0".join(f":(literal){prefix}/{rel}" for rel in snapshot.ignored))
+        if not success:
+            logger.warning(f"Could not untrack ignored files for {safe_name}: {output}")
+            return path
+    try:
+        with open(f"{path}.tmp", "w", encoding="utf-8", errors="surrogateescape") as f:
+            f.write(content)
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        logger.warning(f"Could not write git excludes for {safe_name}: {e}")
+    return path
+
+@traced()
+@_repo_activity.using()
+def commit_student_work(safe_name: str, branch_name: str, commit_msg: str,
+                        snapshot: Optional[FolderSnapshot] = None) -> Tuple[str, str]:
+    """Commit a student's folder to their branch (without pushing).
+
+    With the worktree layout this only runs git in the student's worktree,
+    so several students can be committed at the same time. Otherwise the
+    folder is committed with git plumbing (commit_student_tree), or, with
+    PLUMBING_COMMIT off or if that fails, copied into the shared clone and
+    committed with the branch checked out there.
+
+    Args:
+        safe_name: Safe name for the student
+        branch_name: The git branch name for this student
+        commit_msg: Commit message
+
+    Returns:
+        Tuple of (status, output) where status is "committed", "unchanged"
+        or "failed"
+    """
+    if PLUMBING_COMMIT and not student_folder_in_worktree(safe_name):
+        status, output = commit_student_tree(safe_name, branch_name, commit_msg, snapshot)
+        if status != "failed":
+            return status, output
+        logger.warning(f"Plumbing commit failed, committing from a checkout: {output}")
+
+    repo_path = os.path.join(WORK_DIR, REPO_NAME)
+    student_folder = os.path.join(WORK_DIR, safe_name)
+    session = get_git_session()
+    if snapshot is None:
+        snapshot = scan_folder(student_folder)
+
+    if student_folder_in_worktree(safe_name):
+        # The student folder is the checkout: nothing to copy or switch
+        git_cwd = get_student_worktree(safe_name)
+    else:
+        git_cwd = repo_path
+
+        # Copy files to the repository structure
+        repo_student_folder = os.path.join(repo_path, STUDENTS_SUBDIR, safe_name)
+
+        # Ensure repository structure exists
+        try:
+            os.makedirs(repo_student_folder, exist_ok=True)
+            logger.debug("Ensured repo student folder exists: %s", repo_student_folder)
+        except Exception as e:
+            logger.exception(f"Failed to create repo student folder: {e}")
+            return "failed", str(e)
+
+        # Make the repo copy match the student folder, including deletions.
+        # Not hard links: an editor saving in place would change the clone too.
+        stats = sync_folder(student_folder, repo_student_folder, snapshot=snapshot)
+        logger.info(f"Copied {stats['copied']} changed files to repository")
+
+        # Make sure we're on the right branch
+        use_student_sparse_checkout(safe_name)
+        success, output = session.checkout(
+            branch_name, create=not session.has_local_branch(branch_name)
+        )
+        if not success:
+            logger.error(f"Failed to checkout branch: {output}")
+
+    # Stage changes in the student's folder, leaving out what the save ignored
+    excludes = update_git_excludes(session, safe_name, snapshot, git_cwd)
+    success, output = session.git("-c", f"core.excludesFile={excludes}",
+                                  "add", f"{STUDENTS_SUBDIR}/{safe_name}", cwd=git_cwd)
+    if not success:
+        logger.error(f"Failed to stage changes: {output}")
+        return "failed", output
+
+    # Commit changes
+    success, output = session.git("commit", "-m", commit_msg, cwd=git_cwd)
+    session.invalidate()
+
+    if not success:
+        # Check if it's just because there are no changes
+        if "nothing to commit" in output.lower():
+            logger.info(f"No changes to commit for {safe_name}")
+            return "unchanged", output
+        logger.error(f"Commit failed: {output}")
+        return "failed", output
+    return "committed", output
+
+@traced()
 def save_work(student_name: str, branch_name: str) -> bool:
     """Save the student's work to GitHub.
 
@@ -661,94 +5032,186 @@ def save_work(student_name: str, branch_name: str) -> bool:
         True if save was successful
     """
     logger.info(f"Saving work for student '{student_name}' to branch '{branch_name}'")
-    repo_path = os.path.join(WORK_DIR, REPO_NAME)
     safe_name = get_safe_name(student_name)
     student_folder = get_student_folder(student_name)
 
-    # Check if there are any files
-    all_files = []
-    for root, _, files in os.walk(student_folder):
-        all_files.extend([os.path.join(root, f) for f in files])
+    # Nothing changed since the last save: skip the backup and git entirely
+    start = time.perf_counter()
+    if get_folder_index(safe_name).is_saved():
+        print("\nYour code is already saved!")
+        logger.info(f"No changes since last save for {student_name} "
+                    f"(checked in {(time.perf_counter() - start) * 1000:.1f} ms)")
+        return True
 
-    if not all_files:
+    # Scan the folder once; the backup, copy and count below all use it
+    snapshot = scan_folder(student_folder)
+    if snapshot.is_empty():
         print("\nNo files found to save.")
         logger.warning(f"No files to save for {student_name}")
         return False
 
     # Create a backup first
-    backup_path = create_backup(student_folder, safe_name)
+    backup_path = create_backup(student_folder, safe_name, snapshot)
     if backup_path:
         logger.info(f"Backup created at {backup_path}")
     else:
         logger.warning("Backup creation failed, but continuing with save")
 
-    # Copy files to the repository structure
-    repo_student_folder = os.path.join(repo_path, STUDENTS_SUBDIR, safe_name)
-
-    # Ensure repository structure exists
-    try:
-        os.makedirs(repo_student_folder, exist_ok=True)
-        logger.debug(f"Ensured repo student folder exists: {repo_student_folder}")
-    except Exception as e:
-        logger.exception(f"Failed to create repo student folder: {e}")
-        return False
-
-    # Copy all files from student folder to repo (recursive)
-    file_count = copy_all_files(student_folder, repo_student_folder)
-    logger.info(f"Copied {file_count} files to repository")
-
-    # Add all changes
     print("\nSaving your code...")
 
-    # Make sure we're on the right branch
-    success, output = run_command(
-        f"git checkout {branch_name} 2>/dev/null || git checkout -b {branch_name}",
-        working_dir=repo_path
-    )
-    if not success:
-        logger.error(f"Failed to checkout branch: {output}")
-
-    # Stage changes in the student's folder
-    success, output = run_command(f"git add {STUDENTS_SUBDIR}/{safe_name}", working_dir=repo_path)
-    if not success:
-        print("Could not prepare your code for saving.")
-        logger.error(f"Failed to stage changes: {output}")
-        return False
-
     # Create a commit message with student name
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
     commit_msg = f"Update from {student_name} on {timestamp}"
 
-    # Commit changes
-    success, output = run_command(f"git commit -m \"{commit_msg}\"", working_dir=repo_path)
-
-    if not success:
-        # Check if it's just because there are no changes
-        if "nothing to commit" in output.lower():
-            print("Your code is already saved!")
-            logger.info("No changes to commit")
-            return True
-        else:
-            print(f"Could not save your code. Error: {output}")
-            logger.error(f"Commit failed: {output}")
-            return False
-
-    # Push changes to GitHub on student's branch
-    print("Uploading your code to safe storage...")
-    success, output = run_command(f"git push -u origin {branch_name}", working_dir=repo_path)
-    if not success:
-        print("Could not upload your code.")
-        print("Don't worry! Your code is saved on this computer.")
-        print(f"Error: {output}")
-        logger.error(f"Push failed: {output}")
+    status, output = commit_student_work(safe_name, branch_name, commit_msg, snapshot)
+    index = get_folder_index(safe_name)
+    index.update_from_snapshot(snapshot)
+    if status != "failed":
+        index.mark_saved()
+    if status == "unchanged":
+        print("Your code is already saved!")
+        return True
+    if status == "failed":
+        print(f"Could not save your code. Error: {output}")
         return False
 
+    # Push changes to GitHub on student's branch in the background
+    queue_push(branch_name)
+
     print("\nYour code has been saved successfully!")
-    file_counts = count_files_by_type(student_folder)
+    print("It will be uploaded to safe storage in the background.")
+    file_counts = index.count_by_type()
     print(f"Saved {file_counts['total']} file(s) in total.")
     logger.info(f"Successfully saved {file_counts['total']} files for {student_name}")
     return True
 
+def find_student_folders() -> List[str]:
+    """Find every student folder on this laptop.
+
+    Returns:
+        Safe names of the student folders under WORK_DIR, sorted
+    """
+    safe_names = []
+    for entry in os.scandir(WORK_DIR):
+        name = entry.name
+        # Skip our own state, the shared clone (and any copy the repair
+        # ladder left beside it), restored backups and half-made links
+        if (name.startswith(".") or name == REPO_NAME or name.startswith(f"{REPO_NAME}.")
+                or "-restored-" in name or name.endswith((".link-tmp", ".migrating"))):
+            continue
+        if entry.is_dir():
+            safe_names.append(name)
+    return sorted(safe_names)
+
+@traced()
+def save_all_students() -> int:
+    """Save every student's folder on this laptop, for mentors at the end of a session.
+
+    Each changed folder is backed up and committed to its student branch.
+    Students with their own worktree are handled in parallel on a thread
+    pool; old backups are pruned once the pool is done, and all branches
+    then go up in a single git push.
+
+    Returns:
+        Process exit code (0 if every student was saved and uploaded)
+    """
+    start = time.perf_counter()
+    logger.info("Saving all students")
+    if not get_app().ensure_repository():
+        print("Could not set up code storage.")
+        return 1
+
+    safe_names = find_student_folders()
+    if not safe_names:
+        print("No student folders found.")
+        return 0
+
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
+    branches = {name: f"{STUDENT_BRANCH_PREFIX}{name}" for name in safe_names}
+
+    # Students with nothing new aren't touched, so their folders aren't
+    # moved into worktrees and their branches aren't fetched
+    results = {name: ("unchanged", "") for name in safe_names if get_folder_index(name).is_saved()}
+    changed = [name for name in safe_names if name not in results]
+
+    # Worktrees are created one at a time: they change the shared clone
+    parallel, serial = [], []
+    for name in changed:
+        (parallel if use_student_worktree(name, branches[name]) else serial).append(name)
+
+    def save_one(name: str) -> Tuple[str, str]:
+        folder = os.path.join(WORK_DIR, name)
+        snapshot = scan_folder(folder)
+        if snapshot.is_empty():
+            return "empty", ""
+        create_backup(folder, name, snapshot, prune=False)
+        result = commit_student_work(name, branches[name],
+                                     f"End-of-session save for {name} on {timestamp}", snapshot)
+        index = get_folder_index(name)
+        index.update_from_snapshot(snapshot)
+        if result[0] != "failed":
+            index.mark_saved()
+        return result
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SAVE_ALL_WORKERS) as pool:
+        for name, result in zip(parallel, pool.map(save_one, parallel)):
+            results[name] = result
+    # The copy layout shares one working copy, so those go one by one
+    for name in serial:
+        results[name] = save_one(name)
+
+    # Every snapshot is written now, so no stored object can be mistaken for garbage
+    if sum(prune_backups(name, collect_garbage=False) for name in changed):
+        collect_backup_garbage()
+
+    # Push every branch with unsent commits, including ones saved earlier
+    session = get_git_session()
+    unsent = set(find_unsent_branches())
+    to_push = [branches[name] for name in safe_names
+               if results[name][0] == "committed"
+               or (results[name][0] == "unchanged" and branches[name] in unsent)]
+    pushed = push_branches(session, to_push) if to_push else {}
+    for branch, ok in pushed.items():
+        if ok:
+            session.record_push(branch)
+        else:
+            # Keep it queued so the next launch uploads it
+            PushQueue(os.path.join(get_state_dir(), PUSH_QUEUE_FILE)).add(branch)
+
+    exit_code = 0
+    for name in safe_names:
+        status, output = results[name]
+        upload = pushed.get(branches[name])
+        if status == "failed" or upload is False:
+            exit_code = 1
+        note = {True: "uploaded", False: "upload failed, queued", None: ""}[upload]
+        print(f"{name:<30} {status:<10} {note}")
+        if status == "failed":
+            print(f"    {output.strip()}")
+
+    elapsed = time.perf_counter() - start
+    print(f"\nSaved {len(safe_names)} student(s) in {elapsed:.1f}s")
+    logger.info(f"Saved {len(safe_names)} students in {elapsed:.2f}s")
+    session.log_summary()
+    return exit_code
+
+def show_folder_summary(safe_name: str):
+    """Print file counts, recent edits and unsaved changes from the folder index."""
+    try:
+        index = get_folder_index(safe_name)
+        index.refresh()
+        counts = index.count_by_type()
+        if not counts["total"]:
+            return
+        print(f"\nYour folder: {counts['python']} Python, {counts['text']} text, "
+              f"{counts['other']} other file(s)")
+        print(f"Recently edited: {', '.join(index.recent_files())}")
+        unsaved = sum(len(files) for files in index.unsaved_changes().values())
+        if index.saved is not None:
+            print(f"Unsaved changes: {unsaved} file(s)" if unsaved else "All changes saved")
+    except Exception as e:
+        logger.warning(f"Could not show folder summary: {e}")
+
 def show_main_menu(student_name: str) -> str:
     """Show the main menu and get student choice.
 
@@ -762,29 +5225,182 @@ def show_main_menu(student_name: str) -> str:
     print("="*50)
     print(f"          HELLO {student_name.upper()}!          ")
     print("="*50)
+    waiting = len(_push_worker.queue) if _push_worker else 0
+    if waiting:
+        print(f"\n({waiting} save(s) waiting to upload)")
+    show_folder_summary(get_safe_name(student_name))
     print("\nWhat would you like to do today?")
     print("\n1. Load My Code")
     print("2. Save My Code")
     print("3. Exit")
     print("\nType a number and press Enter:")
 
-    choice = input("> ").strip()
-    logger.debug(f"User selected menu option: {choice}")
+    if _maintenance:
+        _maintenance.idle()
+    try:
+        choice = input("> ").strip()
+    finally:
+        if _maintenance:
+            _maintenance.busy()
+    logger.debug("User selected menu option: %s", choice)
     return choice
 
-def main():
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse the mentor command-line options.
+
+    With no options the program runs the interactive student menu.
+    """
+    parser = argparse.ArgumentParser(description="Tramore Code Club folder manager")
+    parser.add_argument("--list-backups", metavar="NAME",
+                        help="list the backups kept for a student")
+    parser.add_argument("--restore", metavar="NAME",
+                        help="restore a student's backup into a new folder")
+    parser.add_argument("--backup-id", help="backup to restore (default: newest)")
+    parser.add_argument("--to", metavar="FOLDER", help="folder to restore into")
+    parser.add_argument("--save-all", action="store_true",
+                        help="save and upload every student folder on this laptop")
+    parser.add_argument("--profile", nargs="*", metavar="TRACE",
+                        help="summarise timings from trace files (default: this laptop's)")
+    parser.add_argument("--fleet-coordinator", action="store_true",
+                        help="run the classroom coordinator on this (mentor's) laptop")
+    parser.add_argument("--port", type=int, default=FLEET_PORT,
+                        help="port for --fleet-coordinator")
+    parser.add_argument("--slots", type=int, default=FLEET_SLOTS,
+                        help="laptops allowed to clone or fetch at once")
+    parser.add_argument("--mirror", metavar="FOLDER",
+                        help="keep a classroom git mirror in FOLDER for --fleet-coordinator")
+    parser.add_argument("--maintenance", action="store_true",
+                        help="tidy up the repository (pack refs and objects, write the "
+                             "commit-graph, delete stale branches)")
+    parser.add_argument("--budget", type=float, default=MAINTENANCE_EXIT_BUDGET,
+                        help="seconds --maintenance may take")
+    parser.add_argument("--debug", action="store_true",
+                        help="write debug messages (every git command and folder scan) to the log")
+    return parser.parse_args(argv)
+
+def load_trace(paths: List[str]) -> List[Dict]:
+    """Read spans from trace files, skipping lines that aren't valid JSON."""
+    records = []
+    for path in paths:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except OSError as e:
+            logger.warning(f"Could not read trace {path}: {e}")
+    return records
+
+def summarize_trace(records: List[Dict]) -> Dict[Tuple[str, str], Dict[str, float]]:
+    """Timing statistics per laptop and operation.
+
+    Returns:
+        Mapping of (host, operation) to count, failed, p50, p95, max and
+        total (all times in milliseconds)
+    """
+    timings: Dict[Tuple[str, str], List[float]] = collections.defaultdict(list)
+    failures: Dict[Tuple[str, str], int] = collections.Counter()
+    for record in records:
+        key = (record.get("host", "?"), record.get("name", "?"))
+        timings[key].append(float(record.get("ms", 0)))
+        if not record.get("ok", True):
+            failures[key] += 1
+    return {
+        key: {
+            "count": len(values),
+            "failed": failures[key],
+            "p50": _percentile(values, 50),
+            "p95": _percentile(values, 95),
+            "max": max(values),
+            "total": sum(values),
+        }
+        for key, values in timings.items()
+    }
+
+def run_profile_command(paths: List[str]) -> int:
+    """Print p50/p95 per operation from the trace history (--profile).
+
+    Returns:
+        Process exit code
+    """
+    if not paths:
+        paths = [f"{get_trace_path()}.1", get_trace_path()]
+    summary = summarize_trace(load_trace([p for p in paths if os.path.exists(p)]))
+    if not summary:
+        print("No timings recorded yet.")
+        return 1
+    for host in sorted({host for host, _ in summary}):
+        print(f"\n{host}")
+        print(f"  {'operation':<28} {'count':>6} {'failed':>6} {'p50 ms':>9} "
+              f"{'p95 ms':>9} {'max ms':>9} {'total s':>8}")
+        rows = [(name, stats) for (h, name), stats in summary.items() if h == host]
+        for name, stats in sorted(rows, key=lambda row: row[1]["total"], reverse=True):
+            print(f"  {name:<28} {stats['count']:>6} {stats['failed']:>6} {stats['p50']:>9.1f} "
+                  f"{stats['p95']:>9.1f} {stats['max']:>9.1f} {stats['total'] / 1000:>8.2f}")
+    return 0
+
+def run_backup_command(args: argparse.Namespace) -> int:
+    """Run --list-backups or --restore.
+
+    Returns:
+        Process exit code
+    """
+    if args.list_backups:
+        safe_name = get_safe_name(args.list_backups)
+        backup_ids = list_backups(safe_name)
+        if not backup_ids:
+            print(f"No backups found for {args.list_backups}.")
+            return 1
+        for backup_id in backup_ids:
+            print(f"{backup_id}  {len(load_backup(safe_name, backup_id))} file(s)")
+        return 0
+
+    safe_name = get_safe_name(args.restore)
+    restored = restore_backup(safe_name, args.backup_id, args.to)
+    if not restored:
+        print(f"No backup found for {args.restore}.")
+        return 1
+    print(f"Restored to {restored}")
+    return 0
+
+def main(argv: Optional[List[str]] = None):
     """Main entry point for the application."""
+    args = parse_args(argv)
+    get_app().start(logging.DEBUG if args.debug else None)
+    if not args.maintenance:
+        # Before anything touches the repository
+        mark_session_started()
+    if args.list_backups or args.restore:
+        sys.exit(run_backup_command(args))
+    if args.profile is not None:
+        sys.exit(run_profile_command(args.profile))
+    if args.save_all:
+        sys.exit(save_all_students())
+    if args.fleet_coordinator:
+        sys.exit(run_fleet_coordinator(args.port, args.slots, args.mirror))
+    if args.maintenance:
+        sys.exit(run_maintenance_command(args.budget))
+
     logger.info("=" * 50)
     logger.info("Starting Tramore Code Club application")
     logger.info("=" * 50)
 
     try:
+        # Get the repository ready while the student types their name
+        get_app().prefetch()
+
+        # Send anything a previous session didn't manage to upload
+        if os.path.exists(os.path.join(WORK_DIR, REPO_NAME)):
+            get_push_worker()
+
         # Get student name and branch name
         student_name, branch_name = show_welcome_screen()
         logger.info(f"Student logged in: {student_name}, branch: {branch_name}")
 
-        # Setup repository quietly
-        if not setup_repository():
+        # Setup repository quietly (already done at the welcome screen)
+        if not get_app().ensure_repository():
             print("\nCould not set up code storage. Please ask your mentor for help.")
             logger.error("Failed to setup repository in main")
             input("\nPress Enter to exit...")
@@ -793,6 +5409,10 @@ def main():
         # Setup student's branch
         if not setup_student_branch(branch_name):
             logger.error(f"Failed to setup branch {branch_name}")
+        get_git_session().log_summary()
+        start_folder_watcher(get_safe_name(student_name))
+        if MAINTENANCE_ENABLED:
+            get_maintenance().protected.add(branch_name)
 
         while True:
             choice = show_main_menu(student_name)
@@ -814,6 +5434,12 @@ def main():
             elif choice == "3":
                 # Exit
                 logger.info("User selected: Exit")
+                if _push_worker and len(_push_worker.queue):
+                    print("\nUploading your saved code...")
+                    if not _push_worker.flush(PUSH_FLUSH_TIMEOUT):
+                        print("Your code is saved on this computer and will be "
+                              "uploaded next time.")
+                finish_maintenance()
                 print("\nThank you for coding today!")
                 print("See you next time at Tramore Code Club!")
                 time.sleep(1)